@@ -1,50 +1,130 @@
-import asyncio, zlib, sys
-from typing import Callable, Dict, List, Tuple
+import asyncio, sys, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Mapping, Optional, Set, Tuple
+from types import MappingProxyType
 
 sys.path.append("../util/") # absolute path to util's folder
-from util import printflush, Z_WBITS, Z_END_PATTERN
+from util import printflush, encode_varint, Z_WBITS
+from framing import FRAMINGS, create_parser
+from fec import FecEncoder
+from codec import Codec, TrainedDictionary, get_codec, inflate_memory, zlib_pool, DICT_SAMPLES
+from adaptive import AdaptiveCompressor, AdaptiveDecompressor, CompressionStats, LoadMonitor, FLAG_RAW, ADAPTIVE_MIN_SIZE, ADAPTIVE_ENTROPY
 
+RING_SIZE = 1024 # publications kept per topic
+SEND_WINDOW = pow(2, 20) # bytes buffered in QUIC per subscriber session
+DRAIN_INTERVAL = 0.01
+TRANSFER_WINDOW = 4 * pow(2, 20) # bytes of a streamed publication kept while it arrives
+OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest', 'conflate', 'disconnect')
+POOL_ASSIGNMENTS = ('round-robin', 'publisher')
+DELIVERIES = ('stream', 'datagram')
+FEC_DELAY = 0.005 # a partial FEC group gets its parity after this long without datagrams
+OFFLOAD_THRESHOLD = pow(2, 16) # publications this large are (de)compressed in worker threads
+STATS_INTERVAL = 10 # seconds between two exports of the topics' compression stats
+MAX_CONTEXTS = 0 # compression contexts of all the topics, 0 for no limit
+TOPIC_SEPARATOR = '/'
 
-class SubscriberQueue:
-    def __init__(self, queue: asyncio.Queue[Dict]) -> None:
-        self.id = None
-        self.queue = queue
+OVERFLOW = MappingProxyType({'type': 'webtransport.stream.overflow'})
 
-    def bindId(self, id: int) -> None:
-        self.id = id
 
-    def getId(self) -> int:
-        return self.id
+def publication(data: bytes, outputs: Dict['Group', bytes] = None, transfer: 'Transfer' = None, publisher: int = None, keyframes: Set['Group'] = None) -> Mapping:
+    # read-only message created once per publish and shared by reference
+    # by every subscriber it is delivered to, only its variants are filled later;
+    # keyframes are the groups whose output can be decompressed from scratch
+    return MappingProxyType({'type': 'webtransport.stream.pubs', 'data': data, 'outputs': outputs, 'transfer': transfer, 'publisher': publisher, 'time': time.monotonic(), 'variants': {}, 'keyframes': keyframes})
 
-    def setId(self, id: int) -> None:
-        self.id = id
 
-    def getQueue(self) -> asyncio.Queue[Dict]:
-        return self.queue
+def get_variant(message: Mapping, key: Tuple[str, int], encode: Callable[[bytes], bytes]) -> bytes:
+    # stateless encodings of a publication keyed by (codec, dictionary version),
+    # encoded on first demand and shared by every subscriber wanting the same one
+    variants = message['variants']
+    data = variants.get(key)
+    if data is None:
+        data = variants[key] = encode(message['data'])
+    return data
+
+
+def raw_frame(data: bytes) -> bytes:
+    # adaptive message sent uncompressed
+    return bytes((FLAG_RAW,)) + data
+
+
+def stateless_encoding(codec: Codec, adaptive: bool) -> Optional[Tuple[Tuple[str, int], Callable[[bytes], bytes]]]:
+    # variant key and encoder of the publications sent to a compressed
+    # subscriber that cannot use a context, None when the codec has none
+    if adaptive:
+        return ('raw', 0), raw_frame
+    if codec.stateless is not None:
+        name, encode = codec.stateless
+        return (name, 0), encode
+    return None
 
 
 class Group:
-    def __init__(self, wbits: int = Z_WBITS) -> None:
-        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, wbits)
-        self.wbits = wbits
+    def __init__(self, id: int, codec: Codec, level: int, keyframe_bytes: int = 0, keyframe_interval: float = 0.0, adaptive: bool = False, min_size: int = ADAPTIVE_MIN_SIZE, max_entropy: float = ADAPTIVE_ENTROPY, settings: Dict[str, int] = {}) -> None:
+        self.compressor = AdaptiveCompressor(codec, level, adaptive, min_size, max_entropy, settings)
+        self.id = id
+        # groups of a topic are kept per codec, level and framing of the outputs
+        self.key = (codec.name, level, adaptive)
+        self.stateless = stateless_encoding(codec, adaptive) # sent to members waiting for a keyframe
+        self.window = self.compressor.window
         self.bytes = 0
         self.members = 0
-        self.output = None
+        self.merged = None # sequence of the last publication compressed before merging
+        self.into = None
+        # with keyframes, joiners wait for the next context reset instead of
+        # getting a group of their own, see PS.assign_group()
+        self.keyframe_bytes = keyframe_bytes
+        self.keyframe_interval = keyframe_interval
+        self.keyframed = 0 # bytes compressed when the context was last reset
+        self.keyframed_at = time.monotonic()
+        self.reset = False # the next publication is a keyframe
+        self.waiting = 0 # members waiting for a keyframe
+        self.pending = 0 # compressions running in a worker thread
+
+    def compress(self, message: bytes, reset: bool = False) -> bytes:
+        if reset:
+            self.keyframed = self.bytes + len(message)
+            self.keyframed_at = time.monotonic()
+        self.reset = reset
+        data = self.compressor.compress(message, reset)
+        if self.compressor.decision == 'compressed':
+            # raw messages are not part of the context
+            self.bytes += len(message)
+        return data
+
+    def hasKeyframes(self) -> bool:
+        return bool(self.keyframe_bytes or self.keyframe_interval)
+
+    def isKeyframeDue(self) -> bool:
+        # only while a joiner waits, no more than once per interval
+        if not self.waiting:
+            return False
+        if not self.hasKeyframes():
+            # joiners forced into group 0 by the cap on contexts
+            return True
+        if self.keyframe_bytes and self.bytes - self.keyframed >= self.keyframe_bytes:
+            return True
+        return bool(self.keyframe_interval) and time.monotonic() - self.keyframed_at >= self.keyframe_interval
 
-    def compress(self, message: str) -> None:
-        data = self.compressor.compress(message)
-        data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
-        self.bytes += len(message)
-        self.output = data
+    def addWaiter(self) -> None:
+        self.waiting += 1
 
-    def getOutput(self) -> bytes:
-        return self.output
+    def deleteWaiter(self) -> None:
+        self.waiting -= 1
+
+    def resolve(self, seq: int = None) -> 'Group':
+        # group whose output carries publication seq (or the latest one)
+        group = self
+        while group.merged is not None and (seq is None or seq > group.merged):
+            group = group.into
+        return group
 
     def isMergeable(self) -> bool:
-        return self.bytes > pow(2, abs(self.wbits))
+        return self.window is not None and self.bytes > self.window
 
     def isNew(self) -> bool:
-        return self.bytes == 0
+        return self.bytes == 0 and not self.pending
 
     def isEmpty(self) -> bool:
         return self.members == 0
@@ -55,106 +135,790 @@ class Group:
     def deleteMember(self) -> None:
         self.members -= 1
 
+    def release(self) -> None:
+        # a context still used by a worker thread is left to the garbage collector
+        if not self.pending:
+            self.compressor.release()
+
+
+class Transfer:
+    # a publication relayed to the subscribers while it is still arriving,
+    # only the last window bytes are kept and readers left behind are cut off
+    def __init__(self, window: int = TRANSFER_WINDOW) -> None:
+        self.chunks: Deque[bytes] = deque()
+        self.base = 0 # offset of the first chunk kept
+        self.size = 0 # bytes received so far
+        self.window = window
+        self.ended = False
+        self.aborted = False
+        self.readers = 0
+        self.seq = None # slot of the ring it was published in
+        self.event = asyncio.Event()
+
+    def append(self, data: bytes, ended: bool) -> None:
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+            while len(self.chunks) > 1 and self.size - self.base > self.window:
+                self.base += len(self.chunks.popleft())
+        self.ended = ended
+        self.trim()
+        self.event.set()
+        self.event.clear()
+
+    def trim(self) -> None:
+        # a finished publication that was cut is useless once its readers are done,
+        # a whole one stays in the ring like any other publication
+        if self.ended and self.base > 0 and self.readers == 0:
+            self.chunks.clear()
+
+    def addReader(self) -> None:
+        self.readers += 1
+
+    def deleteReader(self) -> None:
+        self.readers -= 1
+        self.trim()
+
+    def abort(self) -> None:
+        self.aborted = True
+        self.chunks.clear()
+        self.event.set()
+        self.event.clear()
+
+    def read(self, offset: int) -> Optional[List[bytes]]:
+        # chunks after offset, None once the reader has been cut off
+        if self.aborted or offset < self.base:
+            return None
+        chunks = []
+        pos = self.size
+        for chunk in reversed(self.chunks):
+            if pos <= offset:
+                break
+            pos -= len(chunk)
+            chunks.append(chunk)
+        chunks.reverse()
+        return chunks
+
+    def isDone(self, offset: int) -> bool:
+        return self.ended and offset == self.size
+
+    async def wait(self) -> None:
+        await self.event.wait()
+
+
+class StreamPool:
+    # a few keep-alive streams shared by all the publications of a session,
+    # messages are framed and a slow stream only holds back its own share
+    def __init__(self, size: int, assign: str = POOL_ASSIGNMENTS[0]) -> None:
+        self.size = size
+        self.assign = assign
+        self.turn = -1
+
+    def pick(self, publisher: Optional[int]) -> int:
+        # hashing by publisher keeps each publisher's messages in order
+        if self.assign == 'publisher' and publisher is not None:
+            return publisher % self.size
+        self.turn = (self.turn + 1) % self.size
+        return self.turn
+
+
+class DatagramPacker:
+    # small publications of a session gathered into one datagram for at most
+    # delay seconds, each one as [topic id] length data
+    def __init__(self, delay: float) -> None:
+        self.parts: List[bytes] = []
+        self.size = 0
+        self.delay = delay
+        self.deadline = 0.0
+
+    def prefix(self, data: bytes, header: Optional[bytes]) -> bytes:
+        return (header or b"") + encode_varint(len(data))
+
+    def fits(self, size: int, limit: int) -> bool:
+        return self.size + size <= limit
+
+    def add(self, prefix: bytes, data: bytes) -> None:
+        if not self.parts:
+            self.deadline = asyncio.get_running_loop().time() + self.delay
+        self.parts.append(prefix)
+        self.parts.append(data)
+        self.size += len(prefix) + len(data)
+
+    def timeout(self) -> float:
+        return self.deadline - asyncio.get_running_loop().time()
+
+    def flush(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts.clear()
+        self.size = 0
+        return data
+
+    def count(self) -> int:
+        return len(self.parts) // 2
+
+
+class Ring:
+    def __init__(self, size: int = RING_SIZE) -> None:
+        self.slots: List[Optional[Mapping]] = [None] * size
+        self.size = size
+        self.head = 0 # sequence of the next publication
+        self.event = asyncio.Event()
+
+    def append(self, message: Mapping) -> int:
+        seq = self.head
+        self.slots[seq % self.size] = message
+        self.head += 1
+        # one wake-up for every idle subscriber, none per publication and subscriber
+        self.event.set()
+        self.event.clear()
+        return seq
+
+    def get(self, seq: int) -> Mapping:
+        return self.slots[seq % self.size]
+
+    def drop(self, seq: int) -> None:
+        # an empty publication takes the slot, the cursors skip it
+        if self.tail() <= seq < self.head:
+            message = self.slots[seq % self.size]
+            self.slots[seq % self.size] = publication(None, publisher=message['publisher'])
+
+    def tail(self) -> int:
+        return max(0, self.head - self.size)
+
+    async def wait(self) -> None:
+        await self.event.wait()
+
+
+class SubscriberCursor:
+    # a single-topic session sends untagged publications on its own streams
+    key = None
+    header = None
+    publisher = None # publisher of the last publication returned by next()
+    expires = None # monotonic time after which the last publication is stale
+    ttl = 0.0 # seconds a publication may take to be delivered, 0 for no limit
+    latest = False # a newer publication supersedes the one still in flight
+    dictionary = None # trained dictionary of the topic, see bindDictionary()
+    reliable = False # the last publication carries a dictionary and must not be reset
+    stateless = None # (variant key, encoder) of a compressed subscriber left without a context
+
+    def __init__(self, ring: Ring, maxsize: int = RING_SIZE, overflow: str = 'drop-oldest') -> None:
+        self.ring = ring
+        self.seq = ring.head
+        self.group: Optional[Group] = None
+        self.first: Optional[bytes] = None
+        self.maxsize = min(maxsize, ring.size)
+        self.overflow = overflow
+        self.drops = 0
+        self.skipped = 0 # streamed publications it could not take, counted in drops too
+        self.overflowed = False
+        self.stop = None # drop-newest: end of the backlog kept when the cursor fell behind
+        self.resume = None # drop-newest: head when the cursor fell behind
+        self.waiting = False # joined a group that is past its first publication
+
+    def bindGroup(self, group: Group) -> None:
+        self.group = group
+
+    def waitKeyframe(self) -> None:
+        # publications go out as stored blocks until the group's next keyframe
+        self.waiting = True
+        self.group.addWaiter()
+
+    def stopWaiting(self) -> None:
+        if self.waiting:
+            self.waiting = False
+            self.group.deleteWaiter()
+
+    def bindDictionary(self, dictionary: TrainedDictionary) -> None:
+        # publications compressed once with the topic's dictionary
+        self.dictionary = dictionary
+        self.version = 0 # dictionary version shipped to the subscriber
+
+    def encode(self, message: Mapping) -> bytes:
+        version = self.dictionary.version
+        data = get_variant(message, ('zstd', version), self.dictionary.encode)
+        self.reliable = bool(version) and version != self.version
+        if self.reliable:
+            # the dictionary goes along with the first publication that needs it
+            self.version = version
+            data = self.dictionary.export() + data
+        return data
+
+    def getGroup(self) -> Optional[Group]:
+        return None if self.group is None else self.group.resolve()
+
+    def lag(self) -> int:
+        return self.ring.head - self.seq
+
+    def countDrop(self) -> None:
+        self.drops += 1
+
+    def countSkip(self) -> None:
+        self.drops += 1
+        self.skipped += 1
+
+    async def wait(self) -> None:
+        await self.ring.wait()
+
+    def check(self) -> None:
+        if self.overflowed:
+            return
+        if self.stop is not None and self.seq >= self.stop:
+            self.drops += self.resume - self.seq
+            self.seq = self.resume
+            self.stop = self.resume = None
+        lag = self.lag()
+        if lag > self.maxsize and self.stop is None:
+            if self.overflow == 'drop-oldest':
+                self.drops += lag - self.maxsize
+                self.seq = self.ring.head - self.maxsize
+            elif self.overflow == 'conflate':
+                self.drops += lag - 1
+                self.seq = self.ring.head - 1
+            elif self.overflow == 'drop-newest':
+                self.stop = self.seq + self.maxsize
+                self.resume = self.ring.head
+            else:
+                self.overflowed = True
+        if self.seq < self.ring.tail():
+            # overwritten while a drop-newest backlog was being sent
+            self.drops += self.ring.tail() - self.seq
+            self.seq = self.ring.tail()
+
+    def next(self) -> 'Optional[bytes | Transfer]':
+        if self.first is not None:
+            data, self.first = self.first, None
+            return data
+        ring = self.ring
+        if self.stop is not None or ring.head - self.seq > self.maxsize:
+            # behind by more than maxsize, which is at most the ring's size:
+            # a cursor within it has nothing to drop
+            self.check()
+        while not self.overflowed and self.seq < ring.head:
+            seq = self.seq
+            self.seq += 1
+            message = ring.slots[seq % ring.size]
+            if message['data'] is None and message['transfer'] is None:
+                # dropped from the ring
+                continue
+            if message['transfer'] is not None:
+                if self.group is None and self.dictionary is None and self.stateless is None:
+                    return message['transfer']
+                # a compressed stream cannot take a publication in pieces
+                self.countSkip()
+                continue
+            self.publisher = message['publisher']
+            self.expires = message['time'] + self.ttl if self.ttl else None
+            if self.dictionary is not None:
+                return self.encode(message)
+            if self.stateless is not None:
+                return get_variant(message, *self.stateless)
+            if self.group is None:
+                return message['data']
+            self.group = self.group.resolve(seq)
+            if self.waiting:
+                if self.group not in (message['keyframes'] or ()):
+                    return get_variant(message, *self.group.stateless)
+                self.stopWaiting()
+            return message['outputs'][self.group]
+        return None
+
+
+class Subscription:
+    # a session following several topics: one cursor per topic and a
+    # round-robin list of the topics with publications waiting
+    def __init__(self, maxsize: int = RING_SIZE, overflow: str = 'drop-oldest') -> None:
+        self.cursors: Dict[str, SubscriberCursor] = {}
+        self.ready: Deque[str] = deque()
+        self.scheduled: Set[str] = set()
+        self.event = asyncio.Event()
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.overflowed = False
+        self.ids: Dict[str, int] = {} # topic ids of a control channel session
+        self.headers: Dict[str, bytes] = {}
+        self.key = None # topic of the last publication returned by next()
+        self.header = None
+        self.publisher = None
+        self.expires = None
+        self.latest = False
+        self.reliable = False
+
+    def assignId(self, topic: str) -> int:
+        # ids are kept for the whole session, 0 is the control stream
+        if topic not in self.ids:
+            self.ids[topic] = len(self.ids) + 1
+            self.headers[topic] = encode_varint(self.ids[topic])
+        return self.ids[topic]
+
+    def notify(self, topic: str) -> None:
+        if topic not in self.scheduled:
+            self.scheduled.add(topic)
+            self.ready.append(topic)
+        self.event.set()
+
+    def check(self) -> None:
+        for cursor in self.cursors.values():
+            cursor.check()
+            self.overflowed |= cursor.overflowed
+
+    def next(self) -> 'Optional[bytes | Transfer]':
+        while self.ready:
+            topic = self.ready[0]
+            cursor = self.cursors[topic]
+            data = cursor.next()
+            if data is not None:
+                self.key = topic
+                self.header = self.headers.get(topic)
+                self.publisher = cursor.publisher
+                self.expires = cursor.expires
+                self.latest = cursor.latest
+                self.reliable = cursor.reliable
+                self.ready.rotate(-1)
+                return data
+            if cursor.overflowed:
+                self.overflowed = True
+                return None
+            self.ready.popleft()
+            self.scheduled.discard(topic)
+        return None
+
+    async def wait(self) -> None:
+        self.event.clear()
+        await self.event.wait()
+
+    def lag(self) -> int:
+        return max((cursor.lag() for cursor in self.cursors.values()), default=0)
+
+    def countDrop(self) -> None:
+        # drop of the publication returned by the last next()
+        if self.key in self.cursors:
+            self.cursors[self.key].drops += 1
+
+    def countSkip(self) -> None:
+        if self.key in self.cursors:
+            self.cursors[self.key].countSkip()
+
+    @property
+    def drops(self) -> int:
+        return sum(cursor.drops for cursor in self.cursors.values())
+
+    @property
+    def skipped(self) -> int:
+        return sum(cursor.skipped for cursor in self.cursors.values())
+
+
+class TopicNode:
+    def __init__(self) -> None:
+        self.children: Dict[str, TopicNode] = {}
+        self.topic: Optional[str] = None
+
+
+class TopicIndex:
+    # topic levels trie, MQTT-style filters are resolved against it when a
+    # subscription starts and the matching subscriptions of every concrete
+    # topic are kept up to date, so a publication only does a dict lookup
+    def __init__(self) -> None:
+        self.root = TopicNode()
+        self.matches: Dict[str, Set[Subscription]] = {}
+
+    @staticmethod
+    def isFilter(topic: str) -> bool:
+        return any(level in ('+', '#') for level in topic.split(TOPIC_SEPARATOR))
+
+    @staticmethod
+    def isValid(filter: str) -> bool:
+        levels = filter.split(TOPIC_SEPARATOR)
+        for i, level in enumerate(levels):
+            if ('#' in level and (level != '#' or i != len(levels) - 1)) or ('+' in level and level != '+'):
+                return False
+        return True
+
+    def add_topic(self, topic: str) -> None:
+        node = self.root
+        for level in topic.split(TOPIC_SEPARATOR):
+            node = node.children.setdefault(level, TopicNode())
+        node.topic = topic
+        self.matches.setdefault(topic, set())
+
+    def resolve(self, filter: str) -> List[str]:
+        result = []
+        self._resolve(self.root, filter.split(TOPIC_SEPARATOR), 0, result)
+        return result
+
+    def _resolve(self, node: TopicNode, levels: List[str], i: int, result: List[str]) -> None:
+        if i == len(levels):
+            if node.topic is not None:
+                result.append(node.topic)
+            return
+        level = levels[i]
+        if level == '#':
+            # matches the parent level too, as in MQTT
+            self._collect(node, result)
+        elif level == '+':
+            for child in node.children.values():
+                self._resolve(child, levels, i + 1, result)
+        elif level in node.children:
+            self._resolve(node.children[level], levels, i + 1, result)
+
+    def _collect(self, node: TopicNode, result: List[str]) -> None:
+        if node.topic is not None:
+            result.append(node.topic)
+        for child in node.children.values():
+            self._collect(child, result)
+
+    def subscribe(self, topic: str, subscription: Subscription) -> None:
+        self.matches[topic].add(subscription)
+
+    def unsubscribe(self, topic: str, subscription: Subscription) -> None:
+        self.matches[topic].discard(subscription)
+
+
+class Topic:
+    def __init__(self, options: Dict[str, str] = {}) -> None:
+        self.options = options
+        self.groups: Dict[Tuple[str, int, bool], Dict[int, Group]] = {}
+        self.dictionary: Optional[TrainedDictionary] = None
+        self.stats = CompressionStats()
+        self.cursors: Set[SubscriberCursor] = set()
+        self.ring = Ring(int(options.get('ring', RING_SIZE)))
+        self.lock = asyncio.Lock() # publications are compressed one at a time, in order
+        self.offload = int(options.get('offload', OFFLOAD_THRESHOLD)) # 0 keeps compression inline
+
 
 class PS:
-    def __init__(self, db):
+    def __init__(self, db, max_contexts: int = MAX_CONTEXTS):
         self.db = db
-        self.groups: Dict[int, Group] = {}
-        self.queues: List[SubscriberQueue] = []
-        self.topics: Dict[str, Tuple[Dict[int, Group], List[SubscriberQueue], Dict]] = {}
+        self.topics: Dict[str, Topic] = {}
+        self.index = TopicIndex()
+        self.publishers = 0
+        self.publications = 0 # publications compressed by at least one group
+        self.compressions = 0 # compress calls of those publications
+        self.load = LoadMonitor() # adaptive groups compress faster while the broker is loaded
+        self.reporter = None
+        self.contexts = 0 # live groups of all the topics
+        self.max_contexts = max_contexts
+        self.inflaters = 0 # zlib decompressors of the publishers
 
     async def fill_topics(self):
-        topics = await self.db.get_topics()
+        # preloaded together, before the broker accepts its first session
+        topics, options, _ = await asyncio.gather(self.db.get_topics(), self.db.get_topic_options(), self.db.load_acl())
+        self.db.start_refresher()
         for topic in topics:
-            self.topics[topic] = ({},[],{})
+            self.topics[topic] = Topic(options.get(topic, {}))
+            self.index.add_topic(topic)
+
+    def get_option(self, topic: str, params: Dict, name: str, default: str = None) -> str:
+        # CONNECT query parameters override the per-topic options of the database
+        value = params.get(name)
+        if value is None and topic in self.topics:
+            value = self.topics[topic].options.get(name)
+        return default if value is None else value
     
-    async def check_publisher(self, user, password, topic):
+    def new_publisher(self) -> int:
+        # publisher id carried by the publications of a session
+        self.publishers += 1
+        return self.publishers
+
+    async def check_publisher(self, user, password, topic, capability=None):
+        # a capability token grants without the database, which still decides what it does not grant
+        if capability is not None and capability.allows('publish', topic):
+            return True
         return await self.db.check_publisher(user, password, topic)
 
-    async def check_subscriber(self, user, password, topic):
+    async def check_subscriber(self, user, password, topic, capability=None):
+        if capability is not None and capability.allows('subscribe', topic):
+            return True
         return await self.db.check_subscriber(user, password, topic)
 
-    def assign_group(self, topic: str, compressor: bool) -> Tuple[int, Group]:
-        if compressor:
-            d = self.topics[topic][0]
-            dlen = len(d)
-            if dlen == 0:
-                d[0] = Group()
-            for item in d.items():
-                if item[1].isNew():
-                    return (item[0], item[1])
-            d[item[0]+1] = Group()
-            return (item[0]+1, d[item[0]+1])
+    def isFull(self) -> bool:
+        return bool(self.max_contexts) and self.contexts >= self.max_contexts
+
+    def admits(self, codec: Optional[Codec], params: Dict) -> bool:
+        # once the contexts run out, subscribers of codecs that can neither
+        # reset their context nor be written without one are refused
+        if codec is None or not self.isFull():
+            return True
+        return codec.keyframes or stateless_encoding(codec, params.get('adaptive') == '1') is not None
+
+    def assign_group(self, topic: str, codec: Optional[Codec], level: Optional[int] = None, adaptive: bool = False) -> Optional[Group]:
+        # None for a compressed subscriber means there is no context left for it
+        if codec is not None:
+            level = codec.level if level is None else level
+            groups = self.topics[topic].groups
+            d = groups.get((codec.name, level, adaptive), {})
+            if len(d) == 0:
+                if self.isFull():
+                    return None
+                d = groups[(codec.name, level, adaptive)] = {0: self.create_group(topic, 0, codec, level, adaptive)}
+            if d[0].hasKeyframes():
+                return d[0]
+            for group in d.values():
+                if group.isNew():
+                    return group
+            if self.isFull():
+                # joiners wait for a keyframe of group 0, see Group.isKeyframeDue()
+                return d[0] if codec.keyframes else None
+            id = max(d) + 1
+            d[id] = self.create_group(topic, id, codec, level, adaptive)
+            return d[id]
         else:
-            return (None, None)
-
-    def merge2group0(self, topic: str, subscriber: SubscriberQueue) -> None:
-        id = subscriber.getId()
-        subscriber.setId(0)
-        self.topics[topic][0][id].deleteMember()
-        self.topics[topic][0][0].addMember()
-        printflush("%s: MERGED SUB ID_GROUP=%d TOTAL_MEMBERS=%d GP0_MEMBERS=%d" % (topic, id, self.topics[topic][0][id].members, self.topics[topic][0][0].members))
-        if self.topics[topic][0][id].isEmpty():
-            self.topics[topic][0].pop(id, None)
-            printflush("%s: DELETED ID_GROUP=%d" % (topic, id))
+            return None
+
+    def create_group(self, topic: str, id: int, codec: Codec, level: int, adaptive: bool) -> Group:
+        options = self.topics[topic].options
+        keyframe_bytes = keyframe_interval = 0
+        if codec.keyframes and id == 0:
+            # keyframe_bytes or keyframe_interval (ms): every joiner shares group 0
+            keyframe_bytes = int(options.get('keyframe_bytes', 0))
+            keyframe_interval = float(options.get('keyframe_interval', 0)) / 1000
+        # adaptive groups skip compressing publications under min_size bytes or
+        # over max_entropy bits per byte
+        min_size = int(options.get('min_size', ADAPTIVE_MIN_SIZE))
+        max_entropy = float(options.get('max_entropy', ADAPTIVE_ENTROPY))
+        # memory budget of a context, e.g. zlib's wbits and memlevel
+        settings = {name: int(options[name]) for name in codec.settings if name in options}
+        self.contexts += 1
+        self.start_monitor()
+        return Group(id, codec, level, keyframe_bytes, keyframe_interval, adaptive, min_size, max_entropy, settings)
+
+    def release_group(self, group: Group) -> None:
+        self.contexts -= 1
+        group.release()
+
+    def merge2group0(self, topic: str, group: Group, seq: int) -> None:
+        # members keep reading the group's output up to seq and group 0's afterwards
+        groups = self.topics[topic].groups[group.key]
+        groups.pop(group.id)
+        if 0 not in groups:
+            group.id = 0
+            groups[0] = group
+            printflush("%s: PROMOTED GROUP TO ID_GROUP=0 TOTAL_MEMBERS=%d" % (topic, group.members))
+            return
+        group.merged = seq
+        group.into = groups[0]
+        groups[0].members += group.members
+        self.release_group(group)
+        printflush("%s: MERGED ID_GROUP=%d TOTAL_MEMBERS=%d GP0_MEMBERS=%d %s" % (topic, group.id, group.members, groups[0].members, self.compression_stats()))
+        printflush("%s: DELETED ID_GROUP=%d" % (topic, group.id))
         return
 
-    def new_subscriber(self, topic: str, subscriber: SubscriberQueue, compressor: bool) -> None:
+    def new_subscriber(self, topic: str, subscriber: SubscriberCursor, codec: Optional[Codec], params: Dict = {}, trained: bool = False) -> None:
         if topic in self.topics:
-            id,group = self.assign_group(topic, compressor)
-            if id is not None and group is not None:
-                subscriber.bindId(id)
+            ring = self.topics[topic].ring
+            if trained:
+                dictionary = self.get_dictionary(topic)
+                dictionary.addMember()
+                subscriber.bindDictionary(dictionary)
+            subscriber.ttl = float(self.get_option(topic, params, 'ttl', 0)) / 1000 # ms
+            subscriber.latest = self.get_option(topic, params, 'latest') == '1'
+            level = self.get_option(topic, params, 'level')
+            adaptive = params.get('adaptive') == '1' # changes the framing, never a topic option
+            group = self.assign_group(topic, codec, None if level is None else int(level), adaptive)
+            if group is None and codec is not None:
+                subscriber.stateless = stateless_encoding(codec, adaptive)
+                printflush("%s: NEW SUBSCRIBER --> NO CONTEXT LEFT %s" % (topic, self.compression_stats()))
+            if group is not None:
+                subscriber.bindGroup(group)
                 group.addMember()
-                printflush("%s: NEW SUBSCRIBER --> ID_GROUP=%d TOTAL_MEMBERS=%d" % (topic, id, group.members))
-            self.topics[topic][1].append(subscriber)
-            if len(self.topics[topic][2]) != 0:
-                self.copy_first_message(group, subscriber, self.topics[topic][2].copy())
+                if not group.isNew():
+                    subscriber.waitKeyframe()
+                printflush("%s: NEW SUBSCRIBER --> ID_GROUP=%d TOTAL_MEMBERS=%d %s" % (topic, group.id, group.members, self.compression_stats()))
+            self.topics[topic].cursors.add(subscriber)
+            if ring.head > 0:
+                self.copy_first_message(group, subscriber, ring)
         return
 
-    def copy_first_message(self, group: Group, subscriber: SubscriberQueue, message: Dict):
-        raw_data = message['data']
+    def copy_first_message(self, group: Group, subscriber: SubscriberCursor, ring: Ring):
         if group is None:
-            subscriber.getQueue().put_nowait(message.copy())
-        else:
-            group.compress(raw_data)
-            message['data'] = group.getOutput()
-            subscriber.getQueue().put_nowait(message.copy())
+            subscriber.seq = ring.head - 1
+        elif subscriber.waiting:
+            subscriber.seq = ring.head - 1
+        elif ring.get(ring.head - 1)['data'] is not None:
+            subscriber.first = group.compress(ring.get(ring.head - 1)['data'])
         return
 
-    def delete_subscriber(self, topic: str, subscriber: SubscriberQueue) -> None:
+    def delete_subscriber(self, topic: str, subscriber: SubscriberCursor) -> None:
         if topic in self.topics:
-            id = subscriber.getId()
-            if id is not None:
-                group = self.topics[topic][0][id]
+            subscriber.stopWaiting()
+            group = subscriber.getGroup()
+            if group is not None:
                 group.deleteMember()
-                if group.isEmpty():
-                    self.topics[topic][0].pop(id, None)
-            self.topics[topic][1].remove(subscriber) 
+                groups = self.topics[topic].groups.get(group.key, {})
+                if group.isEmpty() and groups.get(group.id) is group:
+                    groups.pop(group.id)
+                    self.release_group(group)
+                    if not groups:
+                        self.topics[topic].groups.pop(group.key)
+            if subscriber.dictionary is not None:
+                subscriber.dictionary.deleteMember()
+            self.topics[topic].cursors.discard(subscriber)
+        return
+
+    def new_subscription(self, topic: str, subscription: Subscription, codec: Optional[Codec] = None, params: Dict = {}, trained: bool = False) -> None:
+        if topic in self.topics and topic not in subscription.cursors:
+            cursor = SubscriberCursor(self.topics[topic].ring, subscription.maxsize, subscription.overflow)
+            subscription.cursors[topic] = cursor
+            self.new_subscriber(topic, cursor, codec, params, trained)
+            self.index.subscribe(topic, subscription)
+            if cursor.lag() or cursor.first is not None:
+                subscription.notify(topic)
         return
 
-    def copy(self, topic: str, message: Dict) -> None:
+    def delete_subscription(self, topic: str, subscription: Subscription) -> None:
+        cursor = subscription.cursors.pop(topic, None)
+        if cursor is not None:
+            self.delete_subscriber(topic, cursor)
+            self.index.unsubscribe(topic, subscription)
+            subscription.scheduled.discard(topic)
+            if topic in subscription.ready:
+                subscription.ready.remove(topic)
+        return
+
+    def copy(self, topic: str, data: bytes, publisher: int = None, compressed: Tuple[Dict[Group, bytes], Set[Group]] = None) -> None:
         if topic in self.topics:
-            message['type'] = 'webtransport.stream.pubs'
-            raw_data = message['data']
-            self.topics[topic][2].update({'type':message['type'], 'data':message['data']})
-            gpdict = self.topics[topic][0]
-            qlist = self.topics[topic][1]
-            for gp in gpdict.values():
-                gp.compress(raw_data)
-            for sub in qlist:
-                id = sub.getId()
-                if id is not None:
-                    message['data'] = gpdict[id].getOutput()
-                    sub.getQueue().put_nowait(message.copy())
-                    if id != 0 and gpdict[id].isMergeable():
-                        self.merge2group0(topic, sub)
-                else:
-                    message['data'] = raw_data
-                    sub.getQueue().put_nowait(message.copy())
+            groups = self.topics[topic].groups
+            outputs = None
+            keyframes = None
+            if groups:
+                # publications are transcoded: every codec and level has its own groups,
+                # compressed holds the outputs and keyframes already done by publish()
+                outputs, keyframes = compressed or ({}, set())
+                for d in groups.values():
+                    for gp in d.values():
+                        if gp in outputs:
+                            continue
+                        if gp.reset:
+                            keyframes.add(gp)
+                        outputs[gp] = gp.compress(data, gp.isKeyframeDue())
+                stats = self.topics[topic].stats
+                for gp, output in outputs.items():
+                    stats.record(gp.compressor.decision, len(data), len(output), gp.compressor.elapsed)
+                self.publications += 1
+                self.compressions += len(outputs)
+            ring = self.topics[topic].ring
+            if ring.head:
+                # variants are only cached for the latest publication
+                ring.get(ring.head - 1)['variants'].clear()
+            seq = ring.append(publication(data, outputs, publisher=publisher, keyframes=keyframes or None))
+            for sub in self.index.matches[topic]:
+                sub.notify(topic)
+            dictionary = self.topics[topic].dictionary
+            if dictionary is not None and dictionary.members:
+                dictionary.countPublication()
+                if dictionary.isDue():
+                    self.train_dictionary(topic)
+            for d in list(groups.values()):
+                for id, gp in list(d.items()):
+                    if id != 0 and gp.isMergeable():
+                        self.merge2group0(topic, gp, seq)
         return
 
+    async def publish(self, topic: str, data: bytes, publisher: int = None) -> None:
+        # copy() compressing large publications in worker threads, one job per
+        # group; groups that appear meanwhile are compressed inline by copy()
+        if topic not in self.topics:
+            return
+        t = self.topics[topic]
+        async with t.lock:
+            compressed = None
+            if t.groups:
+                # levels only change between two publications
+                loaded = self.load.isLoaded()
+                for d in t.groups.values():
+                    for gp in d.values():
+                        t.stats.countChange(gp.compressor.adjust(loaded))
+            if t.groups and t.offload and len(data) >= t.offload:
+                loop = asyncio.get_running_loop()
+                groups = [gp for d in t.groups.values() for gp in d.values()]
+                keyframes = {gp for gp in groups if gp.reset}
+                jobs = []
+                for gp in groups:
+                    gp.pending += 1
+                    jobs.append(loop.run_in_executor(get_executor(), gp.compress, data, gp.isKeyframeDue()))
+                try:
+                    compressed = (dict(zip(groups, await asyncio.gather(*jobs))), keyframes)
+                finally:
+                    for gp in groups:
+                        gp.pending -= 1
+            self.copy(topic, data, publisher, compressed)
+
+    def start_monitor(self) -> None:
+        # samples the load for the adaptive groups and exports the compression stats
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # groups created outside the broker's loop, as in the benchmarks
+            return
+        self.load.start()
+        if self.reporter is None or self.reporter.done():
+            self.reporter = asyncio.ensure_future(self.report_stats())
+
+    async def report_stats(self) -> None:
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            for name, topic in self.topics.items():
+                if topic.stats.hasChanged():
+                    printflush("%s: COMPRESSION %s LAG=%.1fms CPU=%.0f%%" % (name, topic.stats.report(), self.load.lag * 1e3, self.load.cpu * 100))
+
+    def compression_stats(self) -> str:
+        memory = sum(gp.compressor.memory() for topic in self.topics.values() for d in topic.groups.values() for gp in d.values())
+        memory += zlib_pool.memory() + self.inflaters * inflate_memory(Z_WBITS)
+        return "CONTEXTS=%d COMPRESS_PER_PUB=%.2f ZLIB_MEMORY=%dKB POOLED=%d" % (self.contexts, self.compressions / max(self.publications, 1), memory // 1024, zlib_pool.count)
+
+    def get_dictionary(self, topic: str) -> TrainedDictionary:
+        if self.topics[topic].dictionary is None:
+            level = self.topics[topic].options.get('level')
+            self.topics[topic].dictionary = TrainedDictionary() if level is None else TrainedDictionary(int(level))
+        return self.topics[topic].dictionary
+
+    def train_dictionary(self, topic: str) -> None:
+        # trained on the latest publications kept in the ring
+        ring = self.topics[topic].ring
+        messages = (ring.get(seq) for seq in range(max(ring.tail(), ring.head - DICT_SAMPLES), ring.head))
+        samples = [message['data'] for message in messages if message['data'] is not None]
+        dictionary = self.topics[topic].dictionary
+        if dictionary.train(samples):
+            printflush("%s: TRAINED DICTIONARY VERSION=%d SAMPLES=%d" % (topic, dictionary.version, len(samples)))
+
+    def open_transfer(self, topic: str, window: int, publisher: int = None) -> Optional[Transfer]:
+        # cut-through publication: subscribers start relaying it before it ends
+        if topic in self.topics:
+            transfer = Transfer(window)
+            transfer.seq = self.topics[topic].ring.append(publication(None, transfer=transfer, publisher=publisher))
+            for sub in self.index.matches[topic]:
+                sub.notify(topic)
+            return transfer
+        return None
+
+    def abort_transfer(self, topic: str, transfer: Transfer) -> None:
+        # the publisher reset its stream: the relays stop, later readers never see it
+        transfer.abort()
+        ring = self.topics[topic].ring
+        if ring.get(transfer.seq)['transfer'] is transfer:
+            ring.drop(transfer.seq)
+
 
 ps = None
+executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(thread_name_prefix='compression')
+    return executor
+
+
+def codec_allowed(name: Optional[str], params: Dict, trained: bool = False) -> bool:
+    # the pattern framing relies on the zlib sync flush trailer, the other
+    # codecs need framing=varint unless messages have streams of their own
+    if name is None:
+        return True
+    codec = get_codec(name)
+    if params.get('adaptive') == '1' and params.get('framing') != 'varint' and not trained:
+        # raw messages have no sync flush trailer to find them by
+        return False
+    return codec is not None and (codec.name == 'zlib' or params.get('framing') == 'varint' or trained)
 
 
 async def publisher(scope: Dict, params: Dict, queue: asyncio.Queue, send: Callable) -> None:
@@ -163,85 +927,433 @@ async def publisher(scope: Dict, params: Dict, queue: asyncio.Queue, send: Calla
 
     user = scope['user']
     password = scope['password']
+    capability = scope.get('capability')
     topic = params.get('topic')
     comp = params.get('compression')
+    codec = get_codec(comp)
 
-    if comp == 'zlib':
-        decompressor = zlib.decompressobj(Z_WBITS)
+    if codec is not None:
+        decompressor = AdaptiveDecompressor(codec.createDecompressor(), params.get('adaptive') == '1')
     else:
         decompressor = None
 
-    if (await ps.check_publisher(user, password, topic)):
+    streaming = params.get('streaming') == '1'
+    window = int(ps.get_option(topic, params, 'transfer_window', TRANSFER_WINDOW))
+    offload = int(ps.get_option(topic, params, 'offload', OFFLOAD_THRESHOLD))
+
+    if params.get('framing', 'pattern') not in FRAMINGS or (streaming and decompressor is not None) or not codec_allowed(comp, params):
+        await send({"type": "webtransport.close"})
+    elif (await ps.check_publisher(user, password, topic, capability)):
         await send({"type": "webtransport.accept"})
 
-        orig_data = b''
+        parser = create_parser(params.get('framing'))
+        transfers: Dict[int, Transfer] = {}
+        source = ps.new_publisher()
+        inflater = codec is not None and codec.name == 'zlib'
+        ps.inflaters += inflater
         while(True):
             message = await queue.get()
             if message.get('data') is not None:
-                if decompressor is not None:
-                    orig_data += message['data']
-                    while(orig_data):
-                        index = orig_data.find(Z_END_PATTERN)
-                        if index != -1:
-                            index += len(Z_END_PATTERN)
-                            cdata = orig_data[0:index]
-                            dec = decompressor.decompress(cdata)
-                            dec += decompressor.flush()
-                            orig_data = orig_data[index:]
-                            message['data'] = dec
-                            ps.copy(topic, message.copy())
+                if streaming and message['stream'] not in transfers and message['end']:
+                    # the whole publication came in one batch: encoded for every subscriber like any other
+                    await ps.publish(topic, bytes(message['data']), source)
+                    await asyncio.sleep(0)
+                elif streaming:
+                    if message['stream'] not in transfers:
+                        # more than one batch: relayed while it arrives
+                        transfers[message['stream']] = ps.open_transfer(topic, window, source)
+                    transfer = transfers[message['stream']]
+                    if transfer is not None:
+                        transfer.append(message['data'], message['end'])
+                    if message['end']:
+                        transfers.pop(message['stream'])
+                elif decompressor is not None:
+                    parser.feed(message['data'])
+                    for frame in parser:
+                        if offload and len(frame) >= offload:
+                            dec = await asyncio.get_running_loop().run_in_executor(get_executor(), decompressor.decompress, frame)
                         else:
-                            break
+                            dec = decompressor.decompress(frame)
+                        await ps.publish(topic, dec, source)
+                        # let the subscribers walk the ring between publications
+                        await asyncio.sleep(0)
                 else:
-                    ps.copy(topic, message.copy())
+                    await ps.publish(topic, message['data'], source)
+                    await asyncio.sleep(0)
+            elif message['type'] == 'webtransport.stream.reset':
+                if (transfer := transfers.pop(message['stream'], None)) is not None:
+                    ps.abort_transfer(topic, transfer)
+            elif message['type'] == 'webtransport.stream.end':
+                break
+        for transfer in transfers.values():
+            if transfer is not None:
+                ps.abort_transfer(topic, transfer)
+        ps.inflaters -= inflater
     else:
         await send({"type": "webtransport.refuse"})
     return
 
 
+async def relay(transfer: Transfer, header: Optional[bytes], send: Callable, backlog: Callable, window: int) -> bool:
+    # forward a streamed publication chunk by chunk on its own outgoing stream
+    chunk = {"type": "webtransport.stream.chunk", "stream": transfer, "header": header, "data": None, "end": False}
+    offset = 0
+    transfer.addReader()
+    try:
+        while True:
+            if backlog() > window:
+                await asyncio.sleep(DRAIN_INTERVAL)
+                continue
+            chunks = transfer.read(offset)
+            if chunks is None:
+                if offset:
+                    await send({"type": "webtransport.stream.reset", "stream": transfer})
+                return False
+            if chunks or transfer.isDone(offset):
+                # everything received since the last wake-up goes out in one write
+                chunk["data"] = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+                offset += len(chunk["data"])
+                chunk["end"] = transfer.isDone(offset)
+                await send(chunk)
+                if chunk["end"]:
+                    return True
+            await transfer.wait()
+    finally:
+        transfer.deleteReader()
+
+
+async def deliver(subscriber: 'SubscriberCursor | Subscription', send: Callable, outgoing: Dict, backlog: Callable, window: int, queue: asyncio.Queue, pool: Optional[StreamPool] = None, datagram: Optional[Callable] = None, packer: Optional[DatagramPacker] = None, fec: Optional[FecEncoder] = None) -> None:
+    # with datagram, publications that fit in one datagram skip the streams
+    # and the send window, the rest fall back to outgoing
+    unreliable = {"data": None, "type": 'webtransport.datagram.send', "count": 1}
+    loop = asyncio.get_running_loop()
+    parity_due = 0.0
+    reported = False # skipped streamed publications, logged once
+
+    async def send_datagram(data: bytes, count: int) -> None:
+        nonlocal parity_due
+        if fec is not None:
+            if not fec.isPending():
+                parity_due = loop.time() + FEC_DELAY
+            data = fec.encode(data)
+        unreliable["data"] = data
+        unreliable["count"] = count
+        await send(unreliable)
+        if fec is not None and fec.isFull():
+            await send_parity()
+
+    async def send_parity() -> None:
+        unreliable["data"] = fec.flush()
+        unreliable["count"] = 0
+        await send(unreliable)
+
+    async def flush() -> None:
+        count = packer.count()
+        await send_datagram(packer.flush(), count)
+
+    while True:
+        if backlog() > window:
+            # stop feeding QUIC while the session is behind, the cursor
+            # keeps its place in the ring meanwhile
+            subscriber.check()
+            if subscriber.overflowed:
+                break
+            await asyncio.sleep(DRAIN_INTERVAL)
+            continue
+        data = subscriber.next()
+        if subscriber.skipped and not reported:
+            reported = True
+            printflush("SUBSCRIBER %s SKIPS STREAMED PUBLICATIONS: COMPRESSED AND POOLED SESSIONS ONLY TAKE THEM WHOLE" % (outgoing.get("user")))
+        if data is None:
+            if subscriber.overflowed:
+                break
+            if packer is not None and packer.size:
+                # publications arriving meanwhile wait in the ring, they are
+                # packed together once the oldest packed one is due
+                if packer.timeout() > 0:
+                    await asyncio.sleep(packer.timeout())
+                else:
+                    await flush()
+                continue
+            if fec is not None and fec.isPending():
+                # a partial group gets its parity when no publication follows soon
+                try:
+                    await asyncio.wait_for(subscriber.wait(), max(parity_due - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    await send_parity()
+                continue
+            await subscriber.wait()
+            continue
+        if isinstance(data, Transfer):
+            if packer is not None and packer.size:
+                await flush()
+            if pool is not None:
+                # pooled streams need the length of every message up front
+                subscriber.countSkip()
+            elif not await relay(data, subscriber.header, send, backlog, window):
+                subscriber.countDrop()
+            continue
+        if subscriber.expires is not None and subscriber.expires <= time.monotonic() and not subscriber.reliable:
+            # went stale while it waited in the ring
+            subscriber.countDrop()
+            continue
+        if datagram is not None:
+            limit = datagram() - (0 if fec is None else fec.overhead())
+            if packer is not None:
+                prefix = packer.prefix(data, subscriber.header)
+                if len(prefix) + len(data) <= limit:
+                    if not packer.fits(len(prefix) + len(data), limit):
+                        await flush()
+                    packer.add(prefix, data)
+                    continue
+            elif len(data) + len(subscriber.header or b"") <= limit:
+                await send_datagram(data if subscriber.header is None else subscriber.header + data, 1)
+                continue
+        if packer is not None and packer.size:
+            # what was packed before goes out first
+            await flush()
+        outgoing["data"] = data
+        outgoing["header"] = subscriber.header
+        outgoing["stream"] = subscriber.key if pool is None else pool.pick(subscriber.publisher)
+        # a stream of its own can be reset once stale or superseded,
+        # unless it carries a dictionary
+        outgoing["expires"] = None if subscriber.reliable else subscriber.expires
+        outgoing["latest"] = subscriber.latest and not subscriber.reliable
+        await send(outgoing)
+    queue.put_nowait(OVERFLOW)
+
+
+async def control(scope: Dict, params: Dict, queue: asyncio.Queue, send: Callable) -> None:
+    # one session for many topics: the client sends SUB <topic|filter> and
+    # UNSUB <topic|filter> lines on its own stream, the broker answers
+    # SUBACK <id> <topic>, SUBNACK <filter> and UNSUBACK <id> <topic> on the
+    # control stream (id 0) and tags every publication with the topic id
+    user = scope['user']
+    password = scope['password']
+    capability = scope.get('capability')
+    backlog = scope['backlog']
+    codec = get_codec(params.get('compression'))
+    # dictionary=1: stateless zstd with the trained dictionaries of the topics
+    trained = codec is not None and codec.name == 'zstd' and params.get('dictionary') == '1'
+    if trained:
+        codec = None
+    compressor = codec is not None
+
+    maxsize = int(params.get('queue', RING_SIZE))
+    window = int(params.get('window', SEND_WINDOW))
+    overflow = params.get('overflow', OVERFLOW_POLICIES[0])
+    framing = params.get('framing', 'pattern')
+    delivery = params.get('delivery', DELIVERIES[0])
+    pack = float(params.get('pack', 0))
+    k = int(params.get('fec', 0))
+    if overflow not in OVERFLOW_POLICIES or framing not in FRAMINGS or delivery not in DELIVERIES or not codec_allowed(params.get('compression'), params, trained):
+        await send({"type": "webtransport.close"})
+        return
+    if compressor and delivery == 'datagram':
+        # a lost datagram would break the decompression context
+        await send({"type": "webtransport.close"})
+        return
+    if compressor:
+        overflow = 'disconnect'
+
+    await send({"type": "webtransport.accept"})
+    me = Subscription(maxsize, overflow)
+    reply = {"type": "webtransport.keepstream.send", "stream": 0, "header": encode_varint(0), "data": None}
+
+    async def subscribe(filter: str) -> None:
+        topics = ps.index.resolve(filter) if TopicIndex.isValid(filter) else []
+        accepted = 0
+        for name in topics:
+            if name not in me.cursors and ps.admits(codec, params) and (await ps.check_subscriber(user, password, name, capability)):
+                id = me.assignId(name)
+                reply["data"] = ("SUBACK %d %s\n" % (id, name)).encode()
+                await send(reply)
+                ps.new_subscription(name, me, codec, params, trained)
+                accepted += 1
+        if accepted == 0:
+            reply["data"] = ("SUBNACK %s\n" % filter).encode()
+            await send(reply)
+
+    async def unsubscribe(filter: str) -> None:
+        for name in ps.index.resolve(filter) if TopicIndex.isValid(filter) else []:
+            if name in me.cursors:
+                ps.delete_subscription(name, me)
+                if compressor:
+                    # the next SUB starts a new stream and decompression context
+                    await send({"type": "webtransport.keepstream.close", "stream": name})
+                reply["data"] = ("UNSUBACK %d %s\n" % (me.ids[name], name)).encode()
+                await send(reply)
+
+    for filter in params.get('topic', '').split(','):
+        if filter:
+            await subscribe(filter)
+
+    if compressor:
+        outgoing = {"data": None, "type": 'webtransport.keepstream.send', "user": user}
+    else:
+        outgoing = {"data": None, "type": 'webtransport.stream.send', "user": user}
+    datagram = scope['datagram'] if delivery == 'datagram' else None
+    packer = DatagramPacker(pack / 1000) if datagram is not None and pack > 0 else None
+    fec = FecEncoder(k) if datagram is not None and k > 0 else None
+    task = asyncio.ensure_future(deliver(me, send, outgoing, backlog, window, queue, datagram=datagram, packer=packer, fec=fec))
+    parser = create_parser(framing) if framing == 'varint' else None
+    commands = bytearray()
+    while True:
+        message = await queue.get()
+        if message['type'] == 'webtransport.stream.receive':
+            # commands are newline terminated, and also framed with framing=varint
+            if parser is not None:
+                parser.feed(message['data'])
+                for frame in parser:
+                    commands += frame
+            else:
+                commands += message['data']
+            while (index := commands.find(b'\n')) != -1:
+                line = commands[:index].decode().strip()
+                del commands[:index+1]
+                command, _, filter = line.partition(' ')
+                if command == 'SUB':
+                    await subscribe(filter)
+                elif command == 'UNSUB':
+                    await unsubscribe(filter)
+        elif message['type'] == 'webtransport.stream.overflow':
+            printflush("CONTROL: DISCONNECTED SUBSCRIBER %s LAG=%d DROPPED=%d STREAMED_SKIPPED=%d DATAGRAMS_DROPPED=%d STREAMS_RESET=%d" % (user, me.lag(), me.drops, me.skipped, scope['dropped'](), scope['resets']()))
+            break
+        elif message['type'] == 'webtransport.stream.end':
+            if me.drops or scope['dropped']() or scope['resets']():
+                printflush("CONTROL: CLOSED SUBSCRIBER %s DROPPED=%d STREAMED_SKIPPED=%d DATAGRAMS_DROPPED=%d STREAMS_RESET=%d" % (user, me.drops, me.skipped, scope['dropped'](), scope['resets']()))
+            break
+    task.cancel()
+    for name in list(me.cursors):
+        ps.delete_subscription(name, me)
+
+
 async def subscriber(scope: Dict, params: Dict, queue: asyncio.Queue, send: Callable) -> None:
     message = await queue.get()
     assert message["type"] == "webtransport.connect"
 
+    if params.get('channel') == 'control':
+        await control(scope, params, queue, send)
+        return
+
     user = scope['user']
     password = scope['password']
+    capability = scope.get('capability')
+    backlog = scope['backlog']
     topic = params.get('topic')
     comp = params.get('compression')
 
-    compressor = False
+    codec = get_codec(comp)
+    # only a client that sent dictionary=1 decodes the stateless dictionary frames
+    trained = codec is not None and codec.name == 'zstd' and params.get('dictionary') == '1'
+    if trained:
+        # publications are compressed once per topic, see TrainedDictionary
+        codec = None
+    compressor = codec is not None
     sendtype = 'webtransport.stream.send'
-    if comp == 'zlib':
-        compressor = True
+    if compressor:
         sendtype = 'webtransport.keepstream.send'
 
-    if (await ps.check_subscriber(user, password, topic)):
-        await send({"type": "webtransport.accept"})
-        me = SubscriberQueue(queue)
-        ps.new_subscriber(topic, me, compressor)
+    wildcard = topic is not None and TopicIndex.isFilter(topic)
+    if wildcard:
+        topics = []
+        if TopicIndex.isValid(topic) and not compressor:
+            for name in ps.index.resolve(topic):
+                if (await ps.check_subscriber(user, password, name, capability)):
+                    topics.append(name)
+        allowed = len(topics) > 0
+    else:
+        allowed = topic in ps.topics and (await ps.check_subscriber(user, password, topic, capability))
 
-        # echo back received data
+    if allowed:
+        maxsize = int(ps.get_option(topic, params, 'queue', RING_SIZE))
+        window = int(ps.get_option(topic, params, 'window', SEND_WINDOW))
+        overflow = ps.get_option(topic, params, 'overflow', OVERFLOW_POLICIES[0])
+        # pooled streams frame every message, only a client that asked for them parses it
+        streams = int(params.get('streams', 0))
+        assign = ps.get_option(topic, params, 'assign', POOL_ASSIGNMENTS[0])
+        delivery = params.get('delivery')
+        if delivery is None:
+            # the topic's default, as long as the subscriber's codec can take it
+            delivery = ps.get_option(topic, params, 'delivery', DELIVERIES[0])
+            if compressor and delivery == 'datagram':
+                delivery = DELIVERIES[0]
+        # ms a datagram waits for more publications, the client unpacks them only if it asked for it
+        pack = float(params.get('pack', 0)) if params.get('delivery') == 'datagram' else 0
+        # datagrams protected by each parity datagram, the accept tells the client
+        k = int(ps.get_option(topic, params, 'fec', 0)) if delivery == 'datagram' else 0
+        if overflow not in OVERFLOW_POLICIES or params.get('framing', 'pattern') not in FRAMINGS or delivery not in DELIVERIES or not codec_allowed(comp, params, trained):
+            await send({"type": "webtransport.close"})
+            return
+        if compressor and delivery == 'datagram':
+            await send({"type": "webtransport.close"})
+            return
+        if not ps.admits(codec, params):
+            # no compression context left for the codec
+            await send({"type": "webtransport.close"})
+            return
+        if streams and (compressor or wildcard or assign not in POOL_ASSIGNMENTS or params.get('framing') != 'varint'):
+            # raw messages on pooled streams are delimited by their length
+            await send({"type": "webtransport.close"})
+            return
+        if compressor and overflow != 'disconnect':
+            # a compressed stream cannot skip messages without
+            # breaking the subscriber's decompression context
+            overflow = 'disconnect'
+
+        await send({"type": "webtransport.accept", "fec": k})
+        if wildcard:
+            # publications are tagged with the topic id, announced with
+            # SUBACK <id> <topic> on the control stream as in control()
+            me = Subscription(maxsize, overflow)
+            reply = {"type": "webtransport.keepstream.send", "stream": 0, "header": encode_varint(0), "data": None}
+            for name in topics:
+                reply["data"] = ("SUBACK %d %s\n" % (me.assignId(name), name)).encode()
+                await send(reply)
+                ps.new_subscription(name, me, params=params, trained=trained)
+            printflush("%s: NEW SUBSCRIPTION --> TOPICS=%d" % (topic, len(topics)))
+        else:
+            me = SubscriberCursor(ps.topics[topic].ring, maxsize, overflow)
+            ps.new_subscriber(topic, me, codec, params, trained)
+
+        pool = None
+        if streams:
+            pool = StreamPool(streams, assign)
+            sendtype = 'webtransport.keepstream.send'
+
+        # the outgoing message is reused: send() consumes it before returning
+        outgoing = {"data": None, "type": sendtype, "user": user}
+        datagram = scope['datagram'] if delivery == 'datagram' else None
+        packer = DatagramPacker(pack / 1000) if datagram is not None and pack > 0 else None
+        fec = FecEncoder(k) if datagram is not None and k > 0 else None
+        task = asyncio.ensure_future(deliver(me, send, outgoing, backlog, window, queue, pool, datagram, packer, fec))
         while True:
             message = await queue.get()
-            if message['type'] == 'webtransport.stream.pubs':
-                data = message.get('data')
-                await send({
-                        "data": data,
-                        "type": sendtype,
-                        "user": user,
-                })
+            if message['type'] == 'webtransport.stream.overflow':
+                printflush("%s: DISCONNECTED SUBSCRIBER %s LAG=%d DROPPED=%d STREAMED_SKIPPED=%d DATAGRAMS_DROPPED=%d STREAMS_RESET=%d" % (topic, user, me.lag(), me.drops, me.skipped, scope['dropped'](), scope['resets']()))
+                break
             elif message['type'] == 'webtransport.stream.end':
-                ps.delete_subscriber(topic, me)
+                if me.drops or scope['dropped']() or scope['resets']():
+                    printflush("%s: CLOSED SUBSCRIBER %s DROPPED=%d STREAMED_SKIPPED=%d DATAGRAMS_DROPPED=%d STREAMS_RESET=%d" % (topic, user, me.drops, me.skipped, scope['dropped'](), scope['resets']()))
                 break
+        task.cancel()
+        if wildcard:
+            for name in list(me.cursors):
+                ps.delete_subscription(name, me)
+        else:
+            ps.delete_subscriber(topic, me)
     else:
         await send({"type": "webtransport.refuse"})
     return
 
 
-async def init(db: 'SQLDatabase'):
+async def init(db: 'SQLDatabase', max_contexts: int = MAX_CONTEXTS):
     global ps
     if ps is None:
-        ps = PS(db)
+        ps = PS(db, max_contexts)
+        start = time.perf_counter()
         await ps.fill_topics()
+        printflush("PRELOAD TOPICS=%d USERS=%d ROLES=%d TIME=%.3fs" % (len(ps.topics), len(db.acl.passwords), len(db.acl.roles), time.perf_counter() - start))
     print("INIT DONE!")
 
 
@@ -1,12 +1,14 @@
-import argparse, asyncio, importlib, logging, time, sys, aioquic, signal
+import argparse, asyncio, importlib, inspect, logging, os, time, sys, aioquic, signal
 import aiosqlite as sql
 from collections import deque
 from email.utils import formatdate
 from typing import Callable, Deque, Dict, List, Optional, Union
+from urllib.parse import unquote
 
 from aioquic.asyncio import QuicConnectionProtocol, serve
 from aioquic.h0.connection import H0_ALPN, H0Connection
-from aioquic.h3.connection import H3_ALPN, H3Connection
+from aioquic.buffer import size_uint_var
+from aioquic.h3.connection import H3_ALPN, H3Connection, ErrorCode
 from aioquic.h3.events import (
     DatagramReceived,
     DataReceived,
@@ -15,43 +17,179 @@ from aioquic.h3.events import (
     WebTransportStreamDataReceived,
 )
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import DatagramFrameReceived, ProtocolNegotiated, QuicEvent, ConnectionTerminated
+from aioquic.quic.events import DatagramFrameReceived, ProtocolNegotiated, QuicEvent, ConnectionTerminated, StreamReset
 from aioquic.quic.logger import QuicFileLogger
+from aioquic.quic.packet_builder import PACKET_MAX_SIZE
+from aioquic.quic.stream import QuicStreamSender
 from aioquic.tls import SessionTicket
 
+sys.path.append("../util/") # absolute path to util's folder
+from util import printflush
+from framing import frame_header
+from reassembly import Reassembler, REASSEMBLY_LIMIT
+from acl import AclCache, AuthCoalescer, ACL_PRELOAD, ACL_REFRESH, ROLE_SCHEMA
+from tokens import TokenVerifier, ALGORITHMS, load_key
+
 try:
     import uvloop
 except ImportError:
     uvloop = None
 
+started = time.perf_counter() # time-to-ready counts from here, once the modules are imported
+reassembly_limit = REASSEMBLY_LIMIT
+AIOQUIC_VERSION = tuple(int(part) for part in aioquic.__version__.split('.')[:2])
+verifier: Optional[TokenVerifier] = None # capability tokens, the database only without them
+STREAM_BATCH = pow(2, 14) # bytes of a streamed publication passed on to the application at once
+DATAGRAM_QUEUE = 64 # datagrams waiting for congestion window before new ones are dropped
+PACKET_OVERHEAD = 48 # short header, AEAD tag and DATAGRAM frame header of a 1-RTT packet
+
 
 AsgiApplication = Callable
 HttpConnection = Union[H0Connection, H3Connection]
 
 SERVER_NAME = "aioquic/" + aioquic.__version__
 
+# every change to the ACL tables is logged by triggers, the broker applies the
+# perms rows changed since its last refresh and reloads everything otherwise
+ACL_CHANGES = ROLE_SCHEMA + """
+CREATE TABLE IF NOT EXISTS aclchanges (seq INTEGER PRIMARY KEY AUTOINCREMENT, clientid INTEGER, topicid INTEGER);
+CREATE TRIGGER IF NOT EXISTS aclchanges_perms_insert AFTER INSERT ON perms BEGIN INSERT INTO aclchanges(clientid, topicid) VALUES (NEW.clientid, NEW.topicid); END;
+CREATE TRIGGER IF NOT EXISTS aclchanges_perms_update AFTER UPDATE ON perms BEGIN INSERT INTO aclchanges(clientid, topicid) VALUES (OLD.clientid, OLD.topicid), (NEW.clientid, NEW.topicid); END;
+CREATE TRIGGER IF NOT EXISTS aclchanges_perms_delete AFTER DELETE ON perms BEGIN INSERT INTO aclchanges(clientid, topicid) VALUES (OLD.clientid, OLD.topicid); END;
+""" + "".join(
+    "CREATE TRIGGER IF NOT EXISTS aclchanges_%s_%s AFTER %s ON %s BEGIN INSERT INTO aclchanges(clientid, topicid) VALUES (NULL, NULL); END;\n" % (table, event.lower(), event, table)
+    for table in ('clients', 'topics', 'roles', 'rolemembers', 'rolegrants') for event in ('INSERT', 'UPDATE', 'DELETE'))
+
+
+def drop_unsent(sender: QuicStreamSender) -> None:
+    # aioquic before 1.0 keeps sending the data of a reset stream past the final
+    # size of its RESET_STREAM. The data never sent is dropped, the buffer and
+    # its offsets are left alone so lost frames below the final size are
+    # retransmitted from the right bytes until the reset is acknowledged
+    if AIOQUIC_VERSION >= (1, 0):
+        return
+    if sender._buffer_stop > sender.highest_offset:
+        sender._pending.subtract(sender.highest_offset, sender._buffer_stop)
+    if sender._buffer_fin is not None and sender._buffer_fin > sender.highest_offset:
+        sender._pending_eof = False
+    sender.buffer_is_empty = len(sender._pending) == 0 and not sender._pending_eof
 
 
 class SQLDatabase:
     def __init__(
         self,
         dbpath: str,
+        preload: int = ACL_PRELOAD,
     ) -> None:
         self.dbpath = dbpath
+        self.preload = preload
         self.connection = None
         return
 
     async def connect(self) -> None:
         self.connection = await sql.connect(self.dbpath)
         assert isinstance(self.connection, sql.Connection)
+        self.acl = None
+        self.loader = None
+        self.coalescer = AuthCoalescer(self.fetch_perms)
+        self.refresher = None
+        self.data_version = None
+        self.changes = None # last aclchanges row applied, None without the change log
+        try:
+            await self.connection.executescript(ACL_CHANGES)
+            await self.connection.commit()
+        except sql.OperationalError:
+            # read-only database: every change reloads the whole ACL
+            pass
+
+    async def load_acl(self) -> None:
+        # snapshot of the ACL tables, refreshed in the background afterwards
+        acl = self.acl or AclCache()
+        self.data_version = await self.fetch_value("PRAGMA data_version")
+        try:
+            self.changes = await self.fetch_value("SELECT COALESCE(MAX(seq), 0) FROM aclchanges")
+        except sql.OperationalError:
+            self.changes = None
+        try:
+            members = await self.fetch_rows("SELECT roles.name, rolemembers.clients FROM rolemembers INNER JOIN roles ON rolemembers.roleid=roles.id")
+            grants = await self.fetch_rows("SELECT roles.name, rolegrants.topics, rolegrants.subscribe, rolegrants.publish FROM rolegrants INNER JOIN roles ON rolegrants.roleid=roles.id")
+        except sql.OperationalError:
+            # read-only database created without roles
+            members = grants = []
+        clients = await self.fetch_rows("SELECT id, user, password FROM clients")
+        topics = await self.fetch_rows("SELECT id, name FROM topics")
+        if await self.fetch_value("SELECT COUNT(*) FROM (SELECT 1 FROM perms LIMIT ?)", (self.preload + 1,)) > self.preload:
+            # too many to hold them all, the users' rows are loaded when they connect
+            perms = None
+        else:
+            perms = await self.fetch_rows("SELECT clientid, topicid, subscribe, publish FROM perms")
+        acl.load(clients, topics, perms, members, grants)
+        self.acl = acl
+        if self.changes:
+            # the rows of the snapshot are not needed anymore
+            await self.connection.execute("DELETE FROM aclchanges WHERE seq<=?", (self.changes,))
+            await self.connection.commit()
+
+    def start_refresher(self) -> None:
+        if self.refresher is None or self.refresher.done():
+            self.refresher = asyncio.ensure_future(self.refresh_acl())
+
+    async def refresh_acl(self) -> None:
+        while True:
+            await asyncio.sleep(ACL_REFRESH)
+            try:
+                await self.update_acl()
+            except sql.Error as e:
+                logging.getLogger("broker").warning("ACL refresh failed: %s", e)
+
+    async def update_acl(self) -> None:
+        # PRAGMA data_version changes when another connection commits
+        version = await self.fetch_value("PRAGMA data_version")
+        if version == self.data_version:
+            return
+        self.data_version = version
+        if self.changes is None:
+            await self.load_acl()
+            return
+        changes = await self.fetch_rows("SELECT seq, clientid, topicid FROM aclchanges WHERE seq>? ORDER BY seq", (self.changes,))
+        if not changes:
+            return
+        if any(clientid is None for _, clientid, _ in changes):
+            await self.load_acl()
+            return
+        for _, clientid, topicid in changes:
+            user = self.acl.clients.get(clientid)
+            if user is not None and not self.acl.hasPerms(user):
+                continue
+            rows = await self.fetch_rows("SELECT subscribe, publish FROM perms WHERE clientid=? AND topicid=?", (clientid, topicid))
+            self.acl.setPerm(clientid, topicid, rows[0] if rows else None)
+        self.changes = changes[-1][0]
+        await self.connection.execute("DELETE FROM aclchanges WHERE seq<=?", (self.changes,))
+        await self.connection.commit()
+
+    async def fetch_perms(self, users: List[str]) -> None:
+        # the perms rows of a batch of users, in one query
+        perms = await self.fetch_rows("SELECT perms.clientid, perms.topicid, perms.subscribe, perms.publish FROM perms INNER JOIN clients ON perms.clientid=clients.id WHERE clients.user IN (%s)" % ",".join("?" * len(users)), tuple(users))
+        self.acl.loadPerms(users, perms)
+
+    async def fetch_rows(self, sql_query: str, parameters: tuple = ()) -> List[tuple]:
+        async with self.connection.execute_fetchall(sql_query, parameters) as dbresult:
+            return list(dbresult)
+
+    async def fetch_value(self, sql_query: str, parameters: tuple = ()):
+        return (await self.fetch_rows(sql_query, parameters))[0][0]
 
     async def check_permissions(self, rol: str, user: str, password: str, topic: str) -> bool:
-        result = False
-        sql_query = "SELECT " + rol + " FROM perms INNER JOIN clients on perms.clientid=clients.id INNER JOIN topics on perms.topicid=topics.id WHERE clients.user=? AND clients.password=? AND topics.name=?"
-        async with self.connection.execute_fetchall(sql_query, (user, password, topic)) as dbresult:
-            if dbresult:
-                result = bool(dbresult[0])
-        return result
+        # answered by the in-memory ACL, changes take up to ACL_REFRESH seconds
+        if self.acl is None:
+            # the checks of a connection storm share the first load
+            if self.loader is None or self.loader.done():
+                self.loader = asyncio.ensure_future(self.load_acl())
+            await self.loader
+        self.start_refresher()
+        if not self.acl.hasPerms(user):
+            await self.coalescer.wait(user)
+        return self.acl.check(rol, user, password, topic)
     
     async def get_topics(self) -> List[str]:
         result = []
@@ -61,6 +199,18 @@ class SQLDatabase:
                 result = [item[0] for item in dbresult]
         return result
 
+    async def get_topic_options(self) -> Dict[str, Dict[str, str]]:
+        result = {}
+        sql_query = "SELECT topics.name, topicopts.name, topicopts.value FROM topicopts INNER JOIN topics on topicopts.topicid=topics.id"
+        try:
+            async with self.connection.execute_fetchall(sql_query) as dbresult:
+                for topic, name, value in dbresult:
+                    result.setdefault(topic, {})[name] = value
+        except sql.OperationalError:
+            # databases created without per-topic options
+            pass
+        return result
+
     async def check_publisher(self, user: str, password: str, topic: str) -> bool:
         return await self.check_permissions('publish', user, password, topic)
 
@@ -68,6 +218,8 @@ class SQLDatabase:
         return await self.check_permissions('subscribe', user, password, topic)
     
     async def close(self) -> None:
+        if self.refresher is not None:
+            self.refresher.cancel()
         if self.connection is not None:
             await self.connection.close()
 
@@ -90,28 +242,88 @@ class WebTransportHandler:
         self.database: asyncio.Queue[Dict] = asyncio.Queue()
         self.scope = scope
         self.stream_id = stream_id
-        self.ustream_id = None
+        self.kstreams: Dict = {} # keep-alive outgoing streams by key
+        self.pstreams: Dict = {} # outgoing streams of publications relayed in chunks
+        self.ostreams = set()
         self.transmit = transmit
         self.autoremove = autoremove
-        self.compression = False
-        self.partial_pkts = {}
+        self.keepstream = False # incoming streams are kept open (compressed or control data)
+        self.framing = None # framing of the messages on outgoing keep-alive streams
+        self.streaming = False # incoming publications are passed on chunk by chunk
+        self.datagram_drops = 0
+        self.latest: Dict = {} # stream of the last message by key, for latest-value-wins
+        self.resets = 0 # message streams reset because they were stale or superseded
+        self.reassembler = Reassembler(reassembly_limit, self.stop_stream)
+        self.scope['backlog'] = self.backlog
+        self.scope['datagram'] = self.max_datagram
+        self.scope['dropped'] = self.dropped
+        self.scope['resets'] = self.count_resets
+
+    def backlog(self) -> int:
+        # bytes written to the session's outgoing streams and not yet acknowledged
+        size = 0
+        for stream_id in list(self.ostreams):
+            stream = self.connection._quic._streams.get(stream_id)
+            if stream is None:
+                self.ostreams.discard(stream_id)
+            else:
+                size += len(stream.sender._buffer)
+        return size
+
+    def max_datagram(self) -> int:
+        # largest payload sent as a datagram: one DATAGRAM frame must fit
+        # in a single packet, otherwise it would stall every datagram behind it
+        quic = self.connection._quic
+        if not quic._remote_max_datagram_frame_size:
+            return 0
+        size = min(quic._remote_max_datagram_frame_size, PACKET_MAX_SIZE - PACKET_OVERHEAD)
+        return size - size_uint_var(self.stream_id)
+
+    def dropped(self) -> int:
+        return self.datagram_drops
+
+    def count_resets(self) -> int:
+        return self.resets
+
+    def cancel_stream(self, stream_id: int) -> None:
+        # the message expired or a newer one superseded it: reset its stream
+        # if it is still unacknowledged instead of retransmitting it
+        stream = self.connection._quic._streams.get(stream_id)
+        if self.closed or stream is None or stream.sender.is_finished or stream.sender._reset_error_code is not None:
+            return
+        self.connection._quic.reset_stream(stream_id, ErrorCode.H3_REQUEST_CANCELLED)
+        drop_unsent(stream.sender)
+        self.ostreams.discard(stream_id)
+        self.resets += 1
+        self.transmit()
+
+    def stop_stream(self, stream_id: int) -> None:
+        # the message no longer fits in the session's reassembly limit
+        self.connection._quic.stop_stream(stream_id, ErrorCode.H3_EXCESSIVE_LOAD)
+        self.transmit()
 
     def process_pkt(self, event):
-        if not self.compression:
-            partial_event_data = self.partial_pkts.get(event.stream_id)
-            if not event.stream_ended:
-                if not partial_event_data:
-                    self.partial_pkts.update({event.stream_id: event.data})
-                else:
-                    partial_event_data += event.data
-                    self.partial_pkts.update({event.stream_id: partial_event_data})
+        data = event.data
+        if self.streaming:
+            data = self.reassembler.add(event.stream_id, data, event.stream_ended, STREAM_BATCH)
+            if data is None:
+                return
+            self.queue.put_nowait(
+                {
+                    "data": data,
+                    "end": event.stream_ended,
+                    "stream": event.stream_id,
+                    "type": "webtransport.stream.receive",
+                }
+            )
+            return
+        if not self.keepstream:
+            data = self.reassembler.add(event.stream_id, data, event.stream_ended)
+            if data is None:
                 return
-            if partial_event_data:
-                event.data = partial_event_data + event.data
-                self.partial_pkts.pop(event.stream_id)
         self.queue.put_nowait(
             {
-                "data": event.data,
+                "data": data,
                 "stream": event.stream_id,
                 "type": "webtransport.stream.receive",
             }
@@ -129,8 +341,18 @@ class WebTransportHandler:
                     )
                 elif isinstance(event, WebTransportStreamDataReceived):
                     self.process_pkt(event)
+                elif isinstance(event, StreamReset):
+                    self.reassembler.discard(event.stream_id)
+                    if self.streaming:
+                        self.queue.put_nowait(
+                            {
+                                "stream": event.stream_id,
+                                "type": "webtransport.stream.reset",
+                            }
+                        )
                 elif isinstance(event, ConnectionTerminated) or (isinstance(event, DataReceived) and  event.stream_ended == True):
                     self.closed = True
+                    self.reassembler.clear()
                     self.queue.put_nowait(
                     {
                         "type": "webtransport.stream.end",
@@ -148,8 +370,10 @@ class WebTransportHandler:
         list = self.scope.get('query_string').decode().split('&')
         for item in list:
             key, val = item.split('=')
-            params.update([(key, val)])
-        self.compression = (params.get('compression', '') == 'zlib')
+            params.update([(key, unquote(val))])
+        self.keepstream = (params.get('compression') is not None or params.get('channel', '') == 'control')
+        self.framing = params.get('framing', 'pattern')
+        self.streaming = not self.keepstream and params.get('streaming', '') == '1'
         try:
             await app(db, self.scope, params, self.queue, self.send)
         except Exception as e:
@@ -174,6 +398,9 @@ class WebTransportHandler:
                 (b"date", formatdate(time.time(), usegmt=True).encode()),
                 (b"sec-webtransport-http3-draft", b"draft02"),
             ]
+            if message.get("fec"):
+                # datagrams protected by parity, the client decodes them
+                headers.append((b"fec", str(message["fec"]).encode()))
             self.connection.send_headers(stream_id=self.stream_id, headers=headers)
 
             # consume backlog
@@ -192,25 +419,65 @@ class WebTransportHandler:
                 )
             end_stream = True
         elif message["type"] == "webtransport.datagram.send":
-            self.connection.send_datagram(flow_id=self.stream_id, data=message["data"])
+            if len(self.connection._quic._datagrams_pending) >= DATAGRAM_QUEUE:
+                # the path is congested, a datagram queued now would arrive stale
+                self.datagram_drops += message.get("count", 1)
+            elif message.get("header"):
+                self.connection.send_datagram(flow_id=self.stream_id, data=message["header"] + message["data"])
+            else:
+                self.connection.send_datagram(flow_id=self.stream_id, data=message["data"])
         elif message["type"] == "webtransport.stream.send":
             stream_id = self.connection.create_webtransport_stream(self.stream_id, True)
+            self.ostreams.add(stream_id)
+            if message.get("header"):
+                self.connection._quic.send_stream_data(stream_id=stream_id, data=message["header"])
             self.connection._quic.send_stream_data(
                 stream_id=stream_id, data=message["data"], end_stream=True
             )
-
-            message["stream"]=stream_id
-            message["type"]="webtransport.stream.send"
-
+            if message.get("latest"):
+                previous = self.latest.get(message.get("stream"))
+                if previous is not None:
+                    self.cancel_stream(previous)
+                self.latest[message.get("stream")] = stream_id
+            if message.get("expires"):
+                asyncio.get_running_loop().call_later(message["expires"] - time.monotonic(), self.cancel_stream, stream_id)
+        elif message["type"] == "webtransport.stream.chunk":
+            stream_id = self.pstreams.get(message["stream"])
+            if stream_id is None:
+                stream_id = self.connection.create_webtransport_stream(self.stream_id, True)
+                self.pstreams[message["stream"]] = stream_id
+                self.ostreams.add(stream_id)
+                if message.get("header"):
+                    self.connection._quic.send_stream_data(stream_id=stream_id, data=message["header"])
+            self.connection._quic.send_stream_data(
+                stream_id=stream_id, data=message["data"], end_stream=message["end"]
+            )
+            if message["end"]:
+                self.pstreams.pop(message["stream"])
+        elif message["type"] == "webtransport.stream.reset":
+            stream_id = self.pstreams.pop(message["stream"], None)
+            if stream_id is not None:
+                self.connection._quic.reset_stream(stream_id, ErrorCode.H3_REQUEST_CANCELLED)
         elif message["type"] == "webtransport.keepstream.send":
-            if not self.ustream_id:
-                self.ustream_id = self.connection.create_webtransport_stream(self.stream_id, True)
+            key = message.get("stream")
+            stream_id = self.kstreams.get(key)
+            if stream_id is None:
+                stream_id = self.connection.create_webtransport_stream(self.stream_id, True)
+                self.kstreams[key] = stream_id
+                self.ostreams.add(stream_id)
+                # the header of a keep-alive stream is only sent when it is opened
+                if message.get("header"):
+                    self.connection._quic.send_stream_data(stream_id=stream_id, data=message["header"])
+            prefix = frame_header(message["data"], self.framing)
+            if prefix:
+                self.connection._quic.send_stream_data(stream_id=stream_id, data=prefix)
             self.connection._quic.send_stream_data(
-                stream_id=self.ustream_id, data=message["data"], end_stream=False
+                stream_id=stream_id, data=message["data"], end_stream=False
             )
-
-            message["stream"]=self.ustream_id
-            message["type"]="webtransport.keepstream.send"
+        elif message["type"] == "webtransport.keepstream.close":
+            stream_id = self.kstreams.pop(message.get("stream"), None)
+            if stream_id is not None:
+                self.connection._quic.send_stream_data(stream_id=stream_id, data=b"", end_stream=True)
 
         if data or end_stream:
             self.connection.send_data(
@@ -235,6 +502,7 @@ class HttpServerProtocol(QuicConnectionProtocol):
         if isinstance(event, HeadersReceived) and event.stream_id not in self._handlers:
             user = None
             password = None
+            capability = None
             authority = None
             headers = []
             http_version = "0.9" if isinstance(self._http, H0Connection) else "3"
@@ -253,6 +521,11 @@ class HttpServerProtocol(QuicConnectionProtocol):
                     raw_path = value
                 elif header == b":protocol":
                     protocol = value.decode()
+                elif header == b"authorization" and verifier is not None and value.startswith(b"Bearer "):
+                    # checked here, the application asks the database only for what it does not grant;
+                    # a bearer that is not UTF-8 is rejected like any invalid token
+                    capability = verifier.verify(value[7:].decode(errors='replace'))
+                    headers.append((header, value))
                 elif header and not header.startswith(b":"):
                     headers.append((header, value))
 
@@ -274,6 +547,7 @@ class HttpServerProtocol(QuicConnectionProtocol):
                     "client": client,
                     "user": user,
                     "password": password,
+                    "capability": capability,
                     "headers": headers,
                     "http_version": http_version,
                     "method": method,
@@ -320,6 +594,11 @@ class HttpServerProtocol(QuicConnectionProtocol):
             handlers = self._handlers.copy()
             for handler in handlers.values():
                 handler.http_event_received(event)
+        elif isinstance(event, StreamReset) and isinstance(self._http, H3Connection):
+            # the HTTP layer drops resets, the session owning the stream gets them here
+            stream = self._http._stream.get(event.stream_id)
+            if stream is not None and stream.session_id in self._handlers:
+                self._handlers[stream.session_id].http_event_received(event)
 
         #  pass event to the HTTP layer
         if self._http is not None:
@@ -350,28 +629,56 @@ def exit_program(signum, frame):
     close_event.set()
 
 
+def signal_ready(ready_file: Optional[str], preload: float) -> None:
+    # the harness polls ready_file instead of waiting a fixed time
+    elapsed = time.perf_counter() - started
+    printflush("READY TIME_TO_READY=%.3fs PRELOAD=%.3fs" % (elapsed, preload))
+    if ready_file:
+        with open(ready_file + ".tmp", "w") as file:
+            file.write("%.3f\n" % (elapsed))
+        os.replace(ready_file + ".tmp", ready_file)
+
+
 async def main(
     host: str,
     port: int,
     configuration: QuicConfiguration,
     session_ticket_store: SessionTicketStore,
-    retry: bool
+    retry: bool,
+    db: SQLDatabase,
+    init_application: Callable,
+    max_contexts: int,
+    ready_file: Optional[str],
 ) -> None:
-    
+    # one loop from the database connection to the last session, so that
+    # what is preloaded stays bound to the loop that serves it
     close_task = asyncio.create_task(close_event.wait())
-    server = await serve(
-        host,
-        port,
-        configuration=configuration,
-        create_protocol=HttpServerProtocol,
-        session_ticket_fetcher=session_ticket_store.pop,
-        session_ticket_handler=session_ticket_store.add,
-        retry=retry,
-    )
     try:
-        await close_task
+        start = time.perf_counter()
+        await db.connect()
+        if 'max_contexts' in inspect.signature(init_application).parameters:
+            await init_application(db, max_contexts=max_contexts)
+        else:
+            # applications without a compression context limit only take the database
+            if max_contexts:
+                logging.getLogger("broker").warning("--max-contexts ignored: the application's init does not take it")
+            await init_application(db)
+        server = await serve(
+            host,
+            port,
+            configuration=configuration,
+            create_protocol=HttpServerProtocol,
+            session_ticket_fetcher=session_ticket_store.pop,
+            session_ticket_handler=session_ticket_store.add,
+            retry=retry,
+        )
+        signal_ready(ready_file, time.perf_counter() - start)
+        try:
+            await close_task
+        finally:
+            server.close()
     finally:
-        server.close()
+        await db.close()
 
 
 if __name__ == "__main__":
@@ -442,6 +749,47 @@ if __name__ == "__main__":
         help="send a retry for new connections",
     )
 
+    parser.add_argument(
+        "--max-reassembly",
+        type=int,
+        default=REASSEMBLY_LIMIT,
+        help="bytes a session may hold in partially received streams (defaults to %d)" % REASSEMBLY_LIMIT,
+    )
+
+    parser.add_argument(
+        "--max-contexts",
+        type=int,
+        default=0,
+        help="compression contexts the application keeps for all the topics, new subscribers share or go without one past it (defaults to 0, no limit)",
+    )
+
+    parser.add_argument(
+        "--acl-preload",
+        type=int,
+        default=ACL_PRELOAD,
+        help="perms rows loaded at startup, past it the rows of the users are loaded in batches as they connect (defaults to %d)" % ACL_PRELOAD,
+    )
+
+    parser.add_argument(
+        "--token-algorithm",
+        type=str,
+        choices=ALGORITHMS,
+        default='hs256',
+        help="signature of the capability tokens: hs256 (shared secret) or ed25519 (defaults to hs256)",
+    )
+
+    parser.add_argument(
+        "--token-key",
+        type=str,
+        help="file with the HMAC secret or the Ed25519 public key (PEM) the tokens are verified with, without it only user:password is accepted",
+    )
+
+    parser.add_argument(
+        "--ready-file",
+        type=str,
+        help="file written with the time-to-ready once the broker accepts sessions, removed when it stops",
+    )
+
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="increase logging verbosity"
     )
@@ -461,7 +809,10 @@ if __name__ == "__main__":
     application = getattr(module, attr_str)
     init_application = getattr(module, "init")
 
-    db = SQLDatabase(args.db)
+    db = SQLDatabase(args.db, args.acl_preload)
+    reassembly_limit = args.max_reassembly
+    if args.token_key:
+        verifier = TokenVerifier(args.token_algorithm, load_key(args.token_key))
 
     # create QUIC logger
     if args.quic_log:
@@ -490,12 +841,13 @@ if __name__ == "__main__":
     if uvloop is not None:
         uvloop.install()
 
+    if args.ready_file and os.path.exists(args.ready_file):
+        # left by a previous run
+        os.remove(args.ready_file)
+
     try:
         close_event = asyncio.Event()
         signal.signal(signal.SIGINT, exit_program)
-        asyncio.run(db.connect(), debug=True)
-        asyncio.run(init_application(db), debug=True)
-        sys.stdout.flush()
         asyncio.run(
             main(
                 host=args.host,
@@ -503,7 +855,12 @@ if __name__ == "__main__":
                 configuration=configuration,
                 session_ticket_store=SessionTicketStore(),
                 retry=args.retry,
+                db=db,
+                init_application=init_application,
+                max_contexts=args.max_contexts,
+                ready_file=args.ready_file,
             ), debug=True
         )
     finally:
-        asyncio.run(db.close())
+        if args.ready_file and os.path.exists(args.ready_file):
+            os.remove(args.ready_file)
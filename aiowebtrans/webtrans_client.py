@@ -1,4 +1,4 @@
-import argparse, asyncio, logging, ssl, time, importlib, signal, zlib, sys, aioquic
+import argparse, asyncio, logging, ssl, time, importlib, signal, sys, aioquic
 from collections import deque
 from typing import Callable, Deque, Dict, List, Union, cast
 from urllib.parse import urlparse
@@ -16,7 +16,7 @@ from aioquic.h3.events import (
     DatagramReceived
 )
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import QuicEvent, DatagramFrameReceived, ProtocolNegotiated, ConnectionTerminated, PingAcknowledged
+from aioquic.quic.events import QuicEvent, DatagramFrameReceived, ProtocolNegotiated, ConnectionTerminated, PingAcknowledged, StreamReset
 from aioquic.quic.logger import QuicFileLogger
 from aioquic.tls import CipherSuite
 
@@ -27,9 +27,15 @@ except ImportError:
     uvloop = None
 
 sys.path.append("../util/") # absolute path to util's folder
-from util import printflush, Z_WBITS, Z_END_PATTERN
+from util import printflush, decode_varint
+from framing import create_parser, frame_header
+from reassembly import Reassembler
+from fec import FecDecoder
+from codec import get_codec, DictionaryDecompressor
+from adaptive import AdaptiveCompressor, AdaptiveDecompressor, CompressionStats, LoadMonitor, ADAPTIVE_MIN_SIZE, ADAPTIVE_ENTROPY
 
 logger = logging.getLogger("client")
+load = LoadMonitor() # adaptive publishers compress faster while the client is loaded
 
 AsgiApplication = Callable
 
@@ -72,7 +78,7 @@ class NEvent(asyncio.Event):
     
 
 class Service:
-    def __init__(self, user: str|None, password: str|None, host: str, port: int, path: str, params: Dict, is_pub: bool) -> None:
+    def __init__(self, user: str|None, password: str|None, host: str, port: int, path: str, params: Dict, is_pub: bool, token: str|None = None) -> None:
 
         module_str, attr_str = params.get('app').split(":", maxsplit=1)
         spec=importlib.util.spec_from_file_location(module_str, module_str)
@@ -96,7 +102,7 @@ class Service:
             params.update([('client', 'subscriber')])
 
         if user is None:
-            self.authority = host + ":" + port
+            self.authority = host + ":" + str(port)
         else:
             self.authority = user + ":" + password + "@" + host + ":" + str(port)
         
@@ -115,11 +121,37 @@ class Service:
             self.full_path += "?" + parsed.query
         self.protocol = "webtransport"
         self.is_pub = is_pub
+        self.token = token # capability token, sent as a bearer authorization
         self.compression = params.get('compression')
+        self.codec = get_codec(self.compression)
+        self.level = int(params['level']) if 'level' in params else None
+        # subscribers of publications compressed with trained dictionaries
+        self.trained = not is_pub and self.codec is not None and self.codec.name == 'zstd' and params.get('dictionary') == '1'
+        # every message starts with a flags byte, small or random ones are not compressed
+        self.adaptive = params.get('adaptive') == '1' and self.codec is not None and not self.trained
+        self.min_size = int(params.get('min_size', ADAPTIVE_MIN_SIZE))
+        self.max_entropy = float(params.get('max_entropy', ADAPTIVE_ENTROPY))
+        # memory budget of the publisher's context, e.g. zlib's wbits and memlevel
+        self.settings = {name: int(params[name]) for name in self.codec.settings if name in params} if self.codec is not None else {}
         self.topic = params.get('topic')
+        self.control = params.get('channel') == 'control'
+        # control channel and wildcard sessions get publications tagged with the topic id
+        self.tagged = self.control or (not is_pub and self.topic is not None and any(level in ('+', '#') for level in self.topic.split('/')))
+        self.framing = params.get('framing', 'pattern')
+        self.pool = int(params.get('streams', 0)) > 0
+        self.packed = params.get('delivery') == 'datagram' and float(params.get('pack', 0)) > 0
+        self.fec = int(params.get('fec', 0)) if params.get('delivery') == 'datagram' else 0
         
 
 
+class TaggedStream:
+    def __init__(self) -> None:
+        self.id = None
+        self.buffer = bytearray()
+        self.decompressor = None
+        self.parser = None
+
+
 class WebTransportHandler:
     def __init__(
         self,
@@ -143,49 +175,188 @@ class WebTransportHandler:
         self.app_task = None
         self.close_event = asyncio.Event()
         self.compressor = self.decompressor = None
-        self.partial_pkts = {}
-
-        if self.service.compression is not None and self.service.compression == 'zlib':
+        self.reassembler = Reassembler(on_drop=self.stop_stream)
+        self.parsers: Dict = {} # framing parsers of pooled incoming streams
+        self.streams: Dict[int, TaggedStream] = {}
+        self.topic_ids: Dict[int, str] = {}
+        self.orphans: Dict[int, List[Dict]] = {}
+        self.fec = FecDecoder() if self.service.fec > 0 else None
+        self.dictionary = DictionaryDecompressor() if self.service.trained else None
+        self.stats = CompressionStats()
+
+        if self.service.codec is not None and not self.service.trained:
             if service.is_pub:
-                self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, Z_WBITS)
+                self.compressor = AdaptiveCompressor(self.service.codec, self.service.level, self.service.adaptive, self.service.min_size, self.service.max_entropy, self.service.settings)
+                if self.service.adaptive:
+                    load.start()
+            elif not service.tagged:
+                # tagged sessions keep one decompressor per topic stream
+                self.decompressor = AdaptiveDecompressor(self.service.codec.createDecompressor(), self.service.adaptive)
+
+    def process_tagged_pkt(self, event):
+        # control channel or wildcard session: every incoming stream starts with the topic id,
+        # 0 is the control stream, compressed topics keep their stream open
+        stream = self.streams.get(event.stream_id)
+        if stream is None:
+            stream = self.streams[event.stream_id] = TaggedStream()
+        data = event.data
+        if stream.id is None:
+            stream.buffer += data
+            stream.id, pos = decode_varint(stream.buffer)
+            if stream.id is None:
+                if event.stream_ended:
+                    self.streams.pop(event.stream_id)
+                return
+            data = bytes(stream.buffer[pos:])
+            stream.buffer.clear()
+            if stream.id != 0 and self.service.codec is not None and not self.service.trained:
+                stream.decompressor = AdaptiveDecompressor(self.service.codec.createDecompressor(), self.service.adaptive)
+            if stream.decompressor is not None or (stream.id == 0 and self.service.framing == 'varint'):
+                stream.parser = create_parser(self.service.framing)
+        if stream.parser is not None:
+            stream.parser.feed(data)
+            for frame in stream.parser:
+                if stream.id == 0:
+                    self.process_control(bytes(frame).decode().strip())
+                else:
+                    data = stream.decompressor.decompress(frame)
+                    self.stats.record(stream.decompressor.decision, len(data), len(frame), stream.decompressor.elapsed)
+                    self.deliver_tagged(stream.id, data)
+        elif stream.id == 0:
+            stream.buffer += data
+            while (index := stream.buffer.find(b'\n')) != -1:
+                self.process_control(stream.buffer[:index].decode())
+                del stream.buffer[:index+1]
+        elif (data := self.reassembler.add(event.stream_id, data, event.stream_ended)) is not None:
+            self.deliver_tagged(stream.id, data)
+        if event.stream_ended:
+            self.streams.pop(event.stream_id)
+
+    def process_control(self, line: str) -> None:
+        words = line.split(' ')
+        if words[0] == 'SUBACK':
+            id = int(words[1])
+            self.topic_ids[id] = words[2]
+            # publications may overtake the SUBACK on their own streams
+            for message in self.orphans.pop(id, []):
+                message["topic"] = words[2]
+                self.queue.put_nowait(message)
+        elif words[0] == 'UNSUBACK':
+            self.topic_ids.pop(int(words[1]), None)
+
+    def deliver_tagged(self, id: int, data: bytes) -> None:
+        message = {
+            "data": data,
+            "topic": self.topic_ids.get(id),
+            "type": "webtransport.stream.receive",
+        }
+        if message["topic"] is None:
+            self.orphans.setdefault(id, []).append(message)
+        else:
+            self.queue.put_nowait(message)
+
+    async def subscribe(self, topic: str) -> None:
+        await self.send({"type": "webtransport.keepstream.send", "data": ("SUB %s\n" % topic).encode()})
+
+    async def unsubscribe(self, topic: str) -> None:
+        await self.send({"type": "webtransport.keepstream.send", "data": ("UNSUB %s\n" % topic).encode()})
+
+    def stop_stream(self, stream_id: int) -> None:
+        self.connection._quic.stop_stream(stream_id, ErrorCode.H3_EXCESSIVE_LOAD)
+        self.transmit()
+
+    def process_pool_pkt(self, event):
+        # pooled streams stay open and carry many framed messages
+        parser = self.parsers.get(event.stream_id)
+        if parser is None:
+            parser = self.parsers[event.stream_id] = create_parser(self.service.framing)
+        parser.feed(event.data)
+        for frame in parser:
+            self.queue.put_nowait(
+                {
+                    "data": bytes(frame),
+                    "stream": event.stream_id,
+                    "type": "webtransport.stream.receive",
+                }
+            )
+        if event.stream_ended:
+            self.parsers.pop(event.stream_id)
+
+    def process_datagram(self, data: bytes) -> None:
+        if self.service.packed:
+            self.process_packed_datagram(data)
+        elif self.service.tagged:
+            # datagrams of a tagged session start with the topic id
+            id, pos = decode_varint(data)
+            if id is not None:
+                self.deliver_tagged(id, data[pos:])
+        else:
+            self.queue.put_nowait(
+                {
+                    "data": data,
+                    "type": "webtransport.datagram.receive",
+                }
+            )
+
+    def process_packed_datagram(self, data: bytes) -> None:
+        # several publications per datagram, each one as [topic id] length data
+        pos = 0
+        while pos < len(data):
+            id = None
+            if self.service.tagged:
+                id, pos = decode_varint(data, pos)
+            length, pos = decode_varint(data, pos)
+            if length is None or pos + length > len(data):
+                break
+            if self.service.tagged:
+                self.deliver_tagged(id, data[pos:pos+length])
             else:
-                self.decompressor = zlib.decompressobj(Z_WBITS)
+                self.queue.put_nowait(
+                    {
+                        "data": data[pos:pos+length],
+                        "type": "webtransport.datagram.receive",
+                    }
+                )
+            pos += length
 
     def process_pkt(self, event):
+        data = event.data
         if self.decompressor is None:
-            partial_event_data = self.partial_pkts.get(event.stream_id)
-            if not event.stream_ended:
-                if not partial_event_data:
-                    self.partial_pkts.update({event.stream_id: event.data})
-                else:
-                    partial_event_data += event.data
-                    self.partial_pkts.update({event.stream_id: partial_event_data})
+            data = self.reassembler.add(event.stream_id, data, event.stream_ended)
+            if data is None:
                 return
-            if partial_event_data:
-                event.data = partial_event_data + event.data
-                self.partial_pkts.pop(event.stream_id)
         self.queue.put_nowait(
             {
-                "data": event.data,
+                "data": data,
                 "stream": event.stream_id,
                 "type": "webtransport.stream.receive",
             }
         )
-            
+
     def http_event_received(self, event: Union[QuicEvent, H3Event]) -> None:
         if not self.closed:
             if self.accepted:
-                if isinstance(event, DatagramReceived):
-                    self.queue.put_nowait(
-                        {
-                            "data": event.data,
-                            "type": "webtransport.datagram.receive",
-                        }
-                    )
+                if isinstance(event, DatagramReceived) and self.fec is not None:
+                    for data in self.fec.decode(event.data):
+                        self.process_datagram(data)
+                elif isinstance(event, DatagramReceived):
+                    self.process_datagram(event.data)
                 elif isinstance(event, WebTransportStreamDataReceived):
-                    self.process_pkt(event)
+                    if self.service.tagged:
+                        self.process_tagged_pkt(event)
+                    elif self.service.pool:
+                        self.process_pool_pkt(event)
+                    else:
+                        self.process_pkt(event)
+                elif isinstance(event, StreamReset):
+                    self.streams.pop(event.stream_id, None)
+                    self.parsers.pop(event.stream_id, None)
+                    self.reassembler.discard(event.stream_id)
                 elif isinstance(event, ConnectionTerminated) or (isinstance(event, DataReceived) and  event.stream_ended == True):
                     self.closed = True
+                    self.streams.clear()
+                    self.parsers.clear()
+                    self.reassembler.clear()
                     self.close_event.set()
                     self.queue.put_nowait(
                     {
@@ -209,6 +380,8 @@ class WebTransportHandler:
         try:
             if self.service.is_pub:
                 await self.service.application(self.send, self.close_event, self.service.data, {"topic": self.service.topic})
+            elif self.service.control:
+                await self.service.application(self.receive, {"topic": self.service.topic, "subscribe": self.subscribe, "unsubscribe": self.unsubscribe})
             else:
                 await self.service.application(self.receive, {"topic": self.service.topic})
         finally:
@@ -216,28 +389,25 @@ class WebTransportHandler:
             await self.autoremove(self.stream_id)
 
     async def receive(self) -> Dict:
-        orig_data = b''
+        parser = create_parser(self.service.framing)
         while(True):
             message = await self.queue.get()
             if message.get('data') is not None and self.decompressor is not None:
-                orig_data += message['data']
-                while(orig_data):
-                    index = orig_data.find(Z_END_PATTERN)
-                    if index != -1:
-                        index += len(Z_END_PATTERN)
-                        cdata = orig_data[0:index]
-                        try:
-                            dec = self.decompressor.decompress(cdata)
-                            dec += self.decompressor.flush()
-                        except:
-                            import traceback
-                            traceback.print_exc(file=sys.stdout)
-                            sys.stdout.flush()
-                        orig_data = orig_data[index:]
-                        message['data'] = dec
-                        yield message
-                    else:
-                        break
+                parser.feed(message['data'])
+                for frame in parser:
+                    try:
+                        dec = self.decompressor.decompress(frame)
+                        self.stats.record(self.decompressor.decision, len(dec), len(frame), self.decompressor.elapsed)
+                    except:
+                        import traceback
+                        traceback.print_exc(file=sys.stdout)
+                        sys.stdout.flush()
+                    message['data'] = dec
+                    yield message
+            elif message.get('data') is not None and self.dictionary is not None:
+                message['data'] = self.dictionary.decompress(message['data'])
+                if message['data'] is not None:
+                    yield message
             else:
                 yield message
 
@@ -246,8 +416,9 @@ class WebTransportHandler:
         if data is not None and self.compressor is not None:
             if message["type"] == "webtransport.stream.send":
                 message["type"] = "webtransport.keepstream.send"
+            self.stats.countChange(self.compressor.adjust(load.isLoaded()))
             data = self.compressor.compress(message['data'])
-            data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.stats.record(self.compressor.decision, len(message['data']), len(data), self.compressor.elapsed)
         end_stream = False
 
         if message["type"] == "webtransport.accept":
@@ -280,6 +451,9 @@ class WebTransportHandler:
         elif message["type"] == "webtransport.keepstream.send":
             if not self.ustream_id:
                 self.ustream_id = self.connection.create_webtransport_stream(self.stream_id, True)
+            prefix = frame_header(data, self.service.framing)
+            if prefix:
+                self.connection._quic.send_stream_data(stream_id=self.ustream_id, data=prefix)
             self.connection._quic.send_stream_data(
                 stream_id=self.ustream_id, data=data, end_stream=False
             )
@@ -302,6 +476,10 @@ class WebTransportHandler:
 
 
     async def finish(self) -> None:
+        if self.fec is not None:
+            logger.info("FEC recovered %d datagrams", self.fec.recovered)
+        if self.stats.hasChanged():
+            logger.info("%s: compression %s", self.service.topic, self.stats.report())
         self.queue.put_nowait(
             {
                 "type": "webtransport.stream.end",
@@ -352,6 +530,9 @@ class HttpClientProtocol(QuicConnectionProtocol):
                         handler = self._handlers[event.stream_id]
                         request_waiter = self._request_waiter.pop(event.stream_id)
                         request_waiter.set_result(event)
+                        if handler.fec is None and any(name == b'fec' for name, _ in event.headers):
+                            # the topic's default redundancy, announced by the broker
+                            handler.fec = FecDecoder()
                         handler.activate()
                         handler.app_task = asyncio.ensure_future(handler.run_asgi())
                         self.keepalive_active = True
@@ -387,6 +568,10 @@ class HttpClientProtocol(QuicConnectionProtocol):
             handlers = self._handlers.copy()
             for handler in handlers.values():
                 handler.http_event_received(event)
+        elif isinstance(event, StreamReset) and isinstance(self._http, H3Connection):
+            stream = self._http._stream.get(event.stream_id)
+            if stream is not None and stream.session_id in self._handlers:
+                self._handlers[stream.session_id].http_event_received(event)
 
         if self._http is not None:
             for http_event in self._http.handle_event(event):
@@ -424,15 +609,18 @@ class HttpClientProtocol(QuicConnectionProtocol):
         )
         self._handlers[stream_id] = handler
 
+        headers = [
+            (b":method", b"CONNECT"),
+            (b":scheme", service.scheme.encode()),
+            (b":authority", service.authority.encode()),
+            (b":path", service.full_path.encode()),
+            (b":protocol", service.protocol.encode()),
+        ]
+        if service.token is not None:
+            headers.append((b"authorization", b"Bearer " + service.token.encode()))
         self._http.send_headers(
             stream_id=stream_id,
-            headers=[
-                (b":method", b"CONNECT"),
-                (b":scheme", service.scheme.encode()),
-                (b":authority", service.authority.encode()),
-                (b":path", service.full_path.encode()),
-                (b":protocol", service.protocol.encode()),
-            ],
+            headers=headers,
         )
 
         waiter = self._loop.create_future()
@@ -550,6 +738,12 @@ if __name__ == "__main__":
         help="auth password"
     )
 
+    parser.add_argument(
+        "--token", 
+        type=str, 
+        help="capability token, instead of or besides --user and --password"
+    )
+
     parser.add_argument(
         "--host", 
         type=str, 
@@ -661,10 +855,10 @@ if __name__ == "__main__":
             subdicts.append(newdict)
 
     for item in pubdicts:
-        services.append(Service(args.user, args.password, args.host, args.port, args.path, item, True))
+        services.append(Service(args.user, args.password, args.host, args.port, args.path, item, True, args.token))
 
     for item in subdicts:
-        services.append(Service(args.user, args.password, args.host, args.port, args.path, item, False))
+        services.append(Service(args.user, args.password, args.host, args.port, args.path, item, False, args.token))
 
     logging.basicConfig(
         format="%(asctime)s %(levelname)s %(name)s %(message)s",
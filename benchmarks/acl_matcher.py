@@ -0,0 +1,62 @@
+import argparse, asyncio, os, random, shutil, sys, tempfile, time
+
+sys.path.append("../util/") # absolute path to util's folder
+sys.path.append("../sqlite/") # absolute path to sqlite's folder
+sys.path.append("../aiowebtrans/") # absolute path to aiowebtrans' folder
+from dbupdate import create_topics_and_perms, create_topics_and_roles
+from webtrans_broker import SQLDatabase
+
+
+DATABASE = "../sqlite/database.db" # schema of the clients, topics and perms tables
+
+
+async def checks(dbpath: str, users: list, topics: list, n: int) -> None:
+    db = SQLDatabase(dbpath)
+    await db.connect()
+    start = time.perf_counter()
+    await db.load_acl()
+    load = time.perf_counter() - start
+    pairs = [(random.choice(users), random.choice(topics)) for _ in range(n)]
+    for name in ("cold", "warm"):
+        # cold: first check of every (user, topic), warm: the same checks again
+        latencies = []
+        allowed = 0
+        for user, topic in pairs:
+            start = time.perf_counter()
+            allowed += await db.check_permissions('subscribe', user, '1234', topic)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print("  %s: checks=%d allowed=%d p50=%.1fus p99=%.1fus" % (
+            name, n, allowed, latencies[n//2]*1e6, latencies[int(n*0.99)]*1e6))
+    print("  load=%.3fs hits=%d misses=%d" % (load, db.acl.hits, db.acl.misses))
+    db.refresher.cancel()
+    await db.connection.close()
+
+
+def run(name: str, create, nt: int, hosts: int, clients: int, n: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        dbpath = os.path.join(tmp, "acl.db")
+        shutil.copy(DATABASE, dbpath)
+        start = time.perf_counter()
+        create(dbpath, nt, hosts, clients, hosts, clients, '1234')
+        print("%s: topics=%d clients=%d generated in %.2fs" % (name, nt, 2 * hosts * clients, time.perf_counter() - start))
+        users = ["h%s%d_%d" % (side, random.randint(1, hosts), random.randint(1, clients)) for side in "ps" for _ in range(100)]
+        topics = ["topic%0*d" % (len(str(nt)), random.randint(1, nt)) for _ in range(100)]
+        asyncio.run(checks(dbpath, users, topics, n))
+
+
+def main(topics: int, hosts: int, clients: int, perms_topics: int, n: int) -> None:
+    run("roles", create_topics_and_roles, topics, hosts, clients, n)
+    # perms grow with clients * topics, hence the smaller default
+    run("perms", create_topics_and_perms, perms_topics, hosts, clients, n)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ACL generation time and check latency, with roles and with perms rows")
+    parser.add_argument("--topics", type=int, default=10000, help="topics of the role ACL")
+    parser.add_argument("--hosts", type=int, default=50, help="publisher and subscriber hosts")
+    parser.add_argument("--clients", type=int, default=100, help="clients per host")
+    parser.add_argument("--perms-topics", type=int, default=100, help="topics of the perms ACL")
+    parser.add_argument("--checks", type=int, default=10000, help="permission checks per pass")
+    args = parser.parse_args()
+    main(args.topics, args.hosts, args.clients, args.perms_topics, args.checks)
@@ -0,0 +1,67 @@
+import argparse, asyncio, os, random, shutil, sys, tempfile, time
+
+sys.path.append("../util/") # absolute path to util's folder
+sys.path.append("../sqlite/") # absolute path to sqlite's folder
+sys.path.append("../aiowebtrans/") # absolute path to aiowebtrans' folder
+from acl import AuthCoalescer
+from dbupdate import create_topics_and_perms
+from webtrans_broker import SQLDatabase
+from broker_app import PS
+
+
+DATABASE = "../sqlite/database.db" # schema of the clients, topics and perms tables
+
+
+async def authorize(ps: PS, user: str, topic: str, start: float, latencies: list) -> bool:
+    # what a subscriber coroutine awaits before it accepts the session, the
+    # QUIC handshake and the CONNECT itself are not part of it
+    allowed = await ps.check_subscriber(user, '1234', topic)
+    latencies.append(time.perf_counter() - start)
+    return allowed
+
+
+async def storm(name: str, dbpath: str, preload: int, coalesce: bool, sessions: list) -> None:
+    db = SQLDatabase(dbpath, preload)
+    await db.connect()
+    if not coalesce:
+        # one query per user, as every session awaiting its own lookup
+        db.coalescer = AuthCoalescer(db.fetch_perms, 0, 1)
+    ps = PS(db)
+    # the snapshot is loaded at startup by the broker, outside the timed storm
+    start = time.perf_counter()
+    await db.load_acl()
+    load = time.perf_counter() - start
+    latencies = []
+    start = time.perf_counter()
+    allowed = await asyncio.gather(*(authorize(ps, user, topic, start, latencies) for user, topic in sessions))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    n = len(latencies)
+    print("%-9s checks=%d allowed=%d p50=%.1fms p99=%.1fms total=%.2fs queries=%d deduplicated=%d acl_load=%.2fs" % (
+        name, n, sum(allowed), latencies[n//2]*1e3, latencies[int(n*0.99)]*1e3, elapsed, db.coalescer.batches, db.coalescer.deduplicated, load))
+    db.refresher.cancel()
+    await db.close()
+
+
+def main(sessions: int, users: int, topics: int, hosts: int, clients: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        dbpath = os.path.join(tmp, "acl.db")
+        shutil.copy(DATABASE, dbpath)
+        create_topics_and_perms(dbpath, topics, hosts, clients, hosts, clients, '1234')
+        # clients reconnecting with the same credentials share users
+        pool = ["h%s%d_%d" % (random.choice("ps"), random.randint(1, hosts), random.randint(1, clients)) for _ in range(users)]
+        storms = [(random.choice(pool), "topic%0*d" % (len(str(topics)), random.randint(1, topics))) for _ in range(sessions)]
+        asyncio.run(storm("preloaded", dbpath, pow(2, 30), True, storms))
+        asyncio.run(storm("per-user", dbpath, 0, False, storms))
+        asyncio.run(storm("coalesced", dbpath, 0, True, storms))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Authorization-check latency of a storm of concurrent CONNECTs, with and without coalesced ACL lookups")
+    parser.add_argument("--sessions", type=int, default=5000, help="sessions authorized at once")
+    parser.add_argument("--users", type=int, default=2000, help="distinct users among them")
+    parser.add_argument("--topics", type=int, default=100, help="topics of the perms ACL")
+    parser.add_argument("--hosts", type=int, default=50, help="publisher and subscriber hosts")
+    parser.add_argument("--clients", type=int, default=100, help="clients per host")
+    args = parser.parse_args()
+    main(args.sessions, args.users, args.topics, args.hosts, args.clients)
@@ -0,0 +1,90 @@
+import argparse, asyncio, sys, time, tracemalloc
+
+sys.path.append("../util/") # absolute path to util's folder
+sys.path.append("../aiowebtrans/") # absolute path to aiowebtrans' folder
+from broker_app import PS, Topic, SubscriberCursor
+
+
+TOPIC = "topic001"
+PAYLOAD = b'{"id": 53311, "answer": "Hot air", "value": 100, "category_id": 4282, "game_id": 217}'
+
+
+def legacy_copy(queues: list, retained: dict, message: dict) -> None:
+    # PS.copy and subscriber() as they were before the shared publication objects
+    message['type'] = 'webtransport.stream.pubs'
+    retained.update({'type': message['type'], 'data': message['data']})
+    for queue in queues:
+        queue.put_nowait(message.copy())
+
+
+def legacy_deliver(queue: asyncio.Queue, sink: list) -> None:
+    while not queue.empty():
+        message = queue.get_nowait()
+        sink.append({"data": message.get('data'), "type": 'webtransport.stream.send', "user": "user"})
+
+
+def shared_copy(ps: PS, message: dict) -> None:
+    ps.copy(TOPIC, message['data'])
+
+
+def shared_deliver(sub: SubscriberCursor, sink: list) -> None:
+    outgoing = {"data": None, "type": 'webtransport.stream.send', "user": "user"}
+    while (data := sub.next()) is not None:
+        outgoing["data"] = data
+        sink.append(outgoing)
+
+
+def legacy_setup(subscribers: int) -> tuple:
+    queues = [asyncio.Queue() for _ in range(subscribers)]
+    return (lambda message: legacy_copy(queues, {}, message)), legacy_deliver, queues
+
+
+def shared_setup(subscribers: int) -> tuple:
+    ps = PS(None)
+    ps.topics[TOPIC] = Topic()
+    ps.index.add_topic(TOPIC)
+    subs = [SubscriberCursor(ps.topics[TOPIC].ring) for _ in range(subscribers)]
+    for sub in subs:
+        ps.new_subscriber(TOPIC, sub, None)
+    return (lambda message: shared_copy(ps, message)), shared_deliver, subs
+
+
+def run(fanout: callable, deliver: callable, subscribers: list, publishes: int) -> tuple:
+    sink = []
+    start = time.perf_counter()
+    for _ in range(publishes):
+        fanout({"data": PAYLOAD, "stream": 3, "type": "webtransport.stream.receive"})
+    for sub in subscribers:
+        deliver(sub, sink)
+    return time.perf_counter() - start, sink
+
+
+def measure(name: str, setup: callable, subscribers: int, publishes: int, repeat: int) -> None:
+    # timed without tracemalloc, which slows down every allocation it traces,
+    # best of repeat runs; the allocations are traced in a run of their own
+    elapsed = min(run(*setup(subscribers), publishes)[0] for _ in range(repeat))
+    fanout, deliver, subs = setup(subscribers)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    _, sink = run(fanout, deliver, subs, publishes)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    delivered = len(sink)
+    print("%-8s delivered=%d blocks/msg=%.2f bytes/msg=%.1f usec/msg=%.3f" % (name, delivered, blocks/delivered, size/delivered, elapsed*1e6/delivered))
+
+
+def main(subscribers: int, publishes: int, repeat: int) -> None:
+    measure("before", legacy_setup, subscribers, publishes, repeat)
+    measure("after", shared_setup, subscribers, publishes, repeat)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Allocations and time per delivered message in the broker fan-out path")
+    parser.add_argument("--subscribers", type=int, default=10000, help="subscribers of the topic")
+    parser.add_argument("--publishes", type=int, default=10, help="publications to fan out")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs, the fastest one is reported")
+    args = parser.parse_args()
+    main(args.subscribers, args.publishes, args.repeat)
@@ -0,0 +1,68 @@
+import argparse, asyncio, json, random, sys, time
+
+sys.path.append("../util/") # absolute path to util's folder
+sys.path.append("../aiowebtrans/") # absolute path to aiowebtrans' folder
+from broker_app import PS, Topic, SubscriberCursor, OFFLOAD_THRESHOLD
+from codec import get_codec
+
+
+TOPIC = "topic001"
+TICK = 0.001
+
+
+def payload(size: int) -> bytes:
+    items = []
+    while sum(len(item) for item in items) < size:
+        items.append(json.dumps({"id": random.randint(0, 99999), "answer": "Hot air", "value": random.randint(0, 100), "category_id": random.randint(0, 9999), "game_id": 217}))
+    return ("[" + ", ".join(items) + "]").encode()
+
+
+async def ticker(lags: list, done: asyncio.Event) -> None:
+    # how late the loop wakes up a task that sleeps TICK seconds
+    loop = asyncio.get_running_loop()
+    while not done.is_set():
+        start = loop.time()
+        await asyncio.sleep(TICK)
+        lags.append(loop.time() - start - TICK)
+
+
+async def run(offload: int, groups: int, publishes: int, data: bytes) -> None:
+    ps = PS(None)
+    ps.topics[TOPIC] = Topic({'offload': str(offload)})
+    ps.index.add_topic(TOPIC)
+    zlib = get_codec('zlib')
+    for level in range(1, groups + 1):
+        ps.new_subscriber(TOPIC, SubscriberCursor(ps.topics[TOPIC].ring), zlib, {'level': str(level)})
+
+    lags = []
+    done = asyncio.Event()
+    task = asyncio.ensure_future(ticker(lags, done))
+    await asyncio.sleep(0.05)
+    lags.clear()
+    start = time.perf_counter()
+    for _ in range(publishes):
+        await ps.publish(TOPIC, data)
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    done.set()
+    await task
+
+    lags.sort()
+    name = "on" if offload else "off"
+    print("offload=%-3s publishes/s=%.1f lag p50=%.2fms p99=%.2fms max=%.2fms" % (
+        name, publishes / elapsed, lags[len(lags)//2]*1e3, lags[int(len(lags)*0.99)]*1e3, lags[-1]*1e3))
+
+
+def main(size: int, groups: int, publishes: int) -> None:
+    data = payload(size)
+    asyncio.run(run(0, groups, publishes, data))
+    asyncio.run(run(OFFLOAD_THRESHOLD, groups, publishes, data))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Event loop lag while large publications are compressed, inline or in worker threads")
+    parser.add_argument("--size", type=int, default=pow(2, 20), help="bytes per publication")
+    parser.add_argument("--groups", type=int, default=4, help="compression groups of the topic")
+    parser.add_argument("--publishes", type=int, default=20, help="publications to compress")
+    args = parser.parse_args()
+    main(args.size, args.groups, args.publishes)
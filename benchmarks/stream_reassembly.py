@@ -0,0 +1,56 @@
+import argparse, os, sys, time, tracemalloc
+
+sys.path.append("../util/") # absolute path to util's folder
+from reassembly import Reassembler
+
+
+STREAM_ID = 3
+
+
+def legacy_process(partial_pkts: dict, stream_id: int, data: bytes, ended: bool):
+    # WebTransportHandler.process_pkt as it was before the chunk lists
+    partial_event_data = partial_pkts.get(stream_id)
+    if not ended:
+        if not partial_event_data:
+            partial_pkts.update({stream_id: data})
+        else:
+            partial_event_data += data
+            partial_pkts.update({stream_id: partial_event_data})
+        return None
+    if partial_event_data:
+        data = partial_event_data + data
+        partial_pkts.pop(stream_id)
+    return data
+
+
+def measure(name: str, process: callable, frames: list, messages: int) -> None:
+    tracemalloc.start()
+    start = time.perf_counter()
+    received = 0
+    for _ in range(messages):
+        for i, frame in enumerate(frames):
+            data = process(STREAM_ID, frame, i == len(frames) - 1)
+            if data is not None:
+                received += len(data)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-8s messages=%d MB/s=%.1f msec/msg=%.3f peak=%.1f MB" % (name, messages, received/elapsed/2**20, elapsed*1e3/messages, peak/2**20))
+
+
+def main(size: int, frame: int, messages: int) -> None:
+    message = os.urandom(size)
+    frames = [message[i:i+frame] for i in range(0, size, frame)]
+    partial_pkts = {}
+    measure("before", lambda stream_id, data, ended: legacy_process(partial_pkts, stream_id, data, ended), frames, messages)
+    reassembler = Reassembler()
+    measure("after", reassembler.add, frames, messages)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reassembly cost of large messages received in small stream frames")
+    parser.add_argument("--size", type=int, default=2**20, help="message size in bytes")
+    parser.add_argument("--frame", type=int, default=1200, help="stream frame payload in bytes")
+    parser.add_argument("--messages", type=int, default=5, help="messages to reassemble")
+    args = parser.parse_args()
+    main(args.size, args.frame, args.messages)
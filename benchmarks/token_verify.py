@@ -0,0 +1,41 @@
+import argparse, sys, time
+
+sys.path.append("../util/") # absolute path to util's folder
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from tokens import TokenSigner, TokenVerifier
+
+
+def keys(algorithm: str):
+    # (signing key, verifying key)
+    if algorithm == 'hs256':
+        return b"secret", b"secret"
+    private = Ed25519PrivateKey.generate()
+    return (private.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()),
+            private.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+
+
+def run(algorithm: str, sessions: int, users: int) -> None:
+    signing, verifying = keys(algorithm)
+    signer = TokenSigner(algorithm, signing)
+    tokens = [signer.sign("hs%d" % (i), ["topic*"]) for i in range(users)]
+    verifier = TokenVerifier(algorithm, verifying)
+    start = time.perf_counter()
+    granted = 0
+    for i in range(sessions):
+        # each user reconnects sessions/users times with the same token
+        capability = verifier.verify(tokens[i % users])
+        granted += capability is not None and capability.allows('subscribe', "topic%03d" % (i % 1000))
+    elapsed = time.perf_counter() - start
+    print("%-7s sessions=%d users=%d granted=%d verified=%d cached=%d sessions/s=%.0f" % (
+        algorithm, sessions, users, granted, verifier.verified, verifier.hits, sessions / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sessions per second authorized by capability tokens")
+    parser.add_argument("--sessions", type=int, default=100000, help="sessions to authorize")
+    parser.add_argument("--users", type=int, default=5000, help="distinct tokens among them")
+    args = parser.parse_args()
+    for algorithm in ('hs256', 'ed25519'):
+        run(algorithm, args.sessions, args.users)
+        run(algorithm, args.users, args.users)
@@ -23,6 +23,9 @@ import shutil
 import psutil
 from contextlib import closing
 
+READY_FILE = "/tmp/broker.ready" # written by the WebTransport broker once it accepts sessions
+READY_TIMEOUT = 10 # seconds a server is given to start
+
 class TimerList:	
 	def __init__(self):
 		self.list = []
@@ -173,10 +176,12 @@ class Test:
 
 	def run(self):
 		if(not self.finalize):		
+			if(os.path.exists(READY_FILE)):
+				os.remove(READY_FILE)
 			self.popens[self.server.name] = self.server.popen(serverlaunch(self.idle_pubs.copy(), self.pubsperhost, self.idle_subs.copy(), self.subsperhost, self.server.name, self.serverIP), stderr=self.errorfile)
 			self.start_perf(self.server.name, None)
 			self.measure_perf(None, None)
-			time.sleep(10)
+			self.wait_ready()
 			if(self.lambda_in_pubhost > 0.):
 				t = random.expovariate(self.lambda_in_pubhost)
 				self.timer_list.insert(t, None, self.arrive_pub)
@@ -226,6 +231,16 @@ class Test:
 		if(len(self.idle_subs) > 0):
 			self.timer_list.insert(random.expovariate(self.lambda_in_subhost), None, self.arrive_sub)
 
+	def wait_ready(self):
+		# the other servers have no readiness signal and get the whole timeout
+		if(not args.servertype.startswith("wt")):
+			time.sleep(READY_TIMEOUT)
+			return
+		start = time.time()
+		while(not os.path.exists(READY_FILE) and time.time() - start < READY_TIMEOUT):
+			time.sleep(0.05)
+		logging.info("server ready after %.2fs" % (time.time() - start))
+
 	def start_perf(self, obj, t):
 		self.perfprocs[obj] = psutil.Process(self.popens[obj].pid)
 
@@ -360,6 +375,14 @@ if __name__ == '__main__':
         required=False,
     )
 
+	parser.add_argument(
+        "--acl",
+        type=str,
+        choices=["perms", "roles"],
+		default="perms",
+		help="one perms row per client and topic, or publisher and subscriber roles",
+    )
+
 	parser.add_argument(
         "--seed",
         type=int,
@@ -426,7 +449,7 @@ if __name__ == '__main__':
 			oscore_prepare(pubhosts, pubsperhost, subhosts, subsperhost, servername, serverIP)
 			extra = " --host %s -c /home/detraca/TFM/aiocoap/oscore/server/%s.json --topics %s" % (serverIP, servername, ' '.join(topics))
 		else:
-			extra = " --host %s /home/detraca/TFM/pubsubaio/app/serverapp.py:app" % (serverIP) 
+			extra = " --host %s --ready-file %s /home/detraca/TFM/pubsubaio/app/serverapp.py:app" % (serverIP, READY_FILE)
 		return serversdict[args.servertype] + extra
 	
 	def publaunch(n, user, serverIP):
@@ -557,9 +580,12 @@ if __name__ == '__main__':
 	import sys
 	from pcaptocsv import generate_pcap_csv
 	sys.path.append("../sqlite") # absolute path to sqlite's folder
-	from dbupdate import create_topics_and_perms
+	from dbupdate import create_topics_and_perms, create_topics_and_roles
 
-	create_topics_and_perms(args.topicsdatabase, args.ntopics, hp, cp, hs, cs, '1234')
+	if args.acl == "roles":
+		create_topics_and_roles(args.topicsdatabase, args.ntopics, hp, cp, hs, cs, '1234')
+	else:
+		create_topics_and_perms(args.topicsdatabase, args.ntopics, hp, cp, hs, cs, '1234')
 
 	topics = []
 	with closing(sqlite3.connect(args.topicsdatabase)) as connection:
@@ -1,17 +1,31 @@
-import sqlite3, math
+import sqlite3, math, sys
 from contextlib import closing
+from itertools import groupby
+from operator import itemgetter
+
+sys.path.append("../util/") # absolute path to util's folder
+from acl import ROLE_SCHEMA
 
 
 def clear_db(conn):
     with closing(conn.cursor()) as c:
+        c.executescript(ROLE_SCHEMA)
+        # a bulk load would log every row for the broker, which recreates the
+        # triggers when it connects and reloads the whole ACL anyway
+        for (name,) in c.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE 'aclchanges_%'").fetchall():
+            c.execute("DROP TRIGGER %s" % (name))
+        if c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='aclchanges'").fetchone():
+            c.execute("DELETE FROM aclchanges")
+            c.execute("INSERT INTO aclchanges(clientid, topicid) VALUES (NULL, NULL)")
+        c.execute("DELETE FROM rolegrants")
+        c.execute("DELETE FROM rolemembers")
+        c.execute("DELETE FROM roles")
         c.execute("DELETE FROM perms")
         c.execute("DELETE FROM topics")
         c.execute("DELETE FROM clients")
     conn.commit()
 
-def create_topics_and_perms(db, nt, hp, cp, hs, cs, password):
-    conn = sqlite3.connect(db)
-    clear_db(conn)
+def insert_clients_and_topics(conn, nt, hp, cp, hs, cs, password):
     clients = []
     for i in range(hp):
         for j in range(cp):
@@ -20,21 +34,75 @@ def create_topics_and_perms(db, nt, hp, cp, hs, cs, password):
         for j in range(cs):
             clients.append("hs%d_%d" % (i+1, j+1))
     digits = int(math.log10(nt))+1
-    inserts1 = []
-    inserts2 = []
+    format = 'topic%' + '0' + str(digits) + 'd'
+    with closing(conn.cursor()) as c:
+        c.executemany("INSERT INTO topics VALUES(?,?)", ((i, format % (i)) for i in range(1, nt+1)))
+        c.executemany("INSERT INTO clients VALUES(?,?,?)", ((i+1, clients[i], password) for i in range(len(clients))))
+    return len(clients)
+
+def create_topics_and_perms(db, nt, hp, cp, hs, cs, password):
+    # one perms row per (client, topic): nclients * nt rows
+    conn = sqlite3.connect(db)
+    clear_db(conn)
+    nclients = insert_clients_and_topics(conn, nt, hp, cp, hs, cs, password)
+    with closing(conn.cursor()) as c:
+        c.executemany("INSERT INTO perms VALUES(?,?,1,1)", ((i, j) for i in range(1, nclients+1) for j in range(1, nt+1)))
+    conn.commit()
+    conn.close()
+
+def create_topics_and_roles(db, nt, hp, cp, hs, cs, password):
+    # same clients and topics, authorized by two roles instead of perms rows
+    conn = sqlite3.connect(db)
+    clear_db(conn)
+    insert_clients_and_topics(conn, nt, hp, cp, hs, cs, password)
+    with closing(conn.cursor()) as c:
+        for name, members, subscribe, publish in (("publishers", "hp*", 0, 1), ("subscribers", "hs*", 1, 0)):
+            roleid = c.execute("INSERT INTO roles(name) VALUES(?)", (name,)).lastrowid
+            c.execute("INSERT INTO rolemembers VALUES(?,?)", (roleid, members))
+            c.execute("INSERT INTO rolegrants VALUES(?,?,?,?)", (roleid, "topic*", subscribe, publish))
+    conn.commit()
+    conn.close()
+
+def migrate_perms(db, keep=False):
+    # turns the perms table into roles: clients with the same rights share a
+    # role, named perms-N, whose grants list the topics (or '*' for all of them)
+    conn = sqlite3.connect(db)
+    with closing(conn.cursor()) as c:
+        c.executescript(ROLE_SCHEMA)
+        ntopics = c.execute("SELECT COUNT(*) FROM topics").fetchone()[0]
+        nclients = c.execute("SELECT COUNT(*) FROM clients").fetchone()[0]
+        rows = conn.execute("SELECT clients.user, topics.name, perms.subscribe, perms.publish FROM perms INNER JOIN clients ON perms.clientid=clients.id INNER JOIN topics ON perms.topicid=topics.id ORDER BY perms.clientid")
+        rights = {} # client -> frozenset of (topic, subscribe, publish)
+        for client, perms in groupby(rows, key=itemgetter(0)):
+            rights[client] = frozenset((topic, int(bool(subscribe)), int(bool(publish))) for _, topic, subscribe, publish in perms if subscribe or publish)
+        sets = {}
+        for client, rightset in rights.items():
+            sets.setdefault(rightset, []).append(client)
+        for (roleid,) in c.execute("SELECT id FROM roles WHERE name LIKE 'perms-%'").fetchall():
+            c.execute("DELETE FROM rolegrants WHERE roleid=?", (roleid,))
+            c.execute("DELETE FROM rolemembers WHERE roleid=?", (roleid,))
+            c.execute("DELETE FROM roles WHERE id=?", (roleid,))
+        for n, (rightset, members) in enumerate(sets.items()):
+            if not rightset:
+                continue
+            roleid = c.execute("INSERT INTO roles(name) VALUES(?)", ("perms-%d" % (n+1),)).lastrowid
+            c.executemany("INSERT INTO rolemembers VALUES(?,?)", [(roleid, "*")] if len(members) == nclients else ((roleid, member) for member in members))
+            grants = {}
+            for topic, subscribe, publish in sorted(rightset):
+                grants.setdefault((subscribe, publish), []).append(topic)
+            for (subscribe, publish), topics in grants.items():
+                c.executemany("INSERT INTO rolegrants VALUES(?,?,?,?)", [(roleid, "*", subscribe, publish)] if len(topics) == ntopics else ((roleid, topic, subscribe, publish) for topic in topics))
+        if not keep:
+            c.execute("DELETE FROM perms")
+    conn.commit()
+    conn.close()
+    return len(sets)
+
+def set_topic_options(db, topic, options):
+    conn = sqlite3.connect(db)
     with closing(conn.cursor()) as c:
-        for i in range(1, nt+1):
-            format = 'topic%' + '0' + str(digits) + 'd'
-            format = format % (i)
-            inserts1.append((i,format))
-        c.executemany("INSERT INTO topics VALUES(?,?)", inserts1)
-        inserts1 = []
-        for i in range(len(clients)):
-            user = clients[i]
-            inserts1.append((i+1,clients[i],password))
-            for j in range(1, nt+1):
-                inserts2.append((i+1,j))
-        c.executemany("INSERT INTO clients VALUES(?,?,?)", inserts1)
-        c.executemany("INSERT INTO perms VALUES(?,?,1,1)",inserts2)
+        c.execute("CREATE TABLE IF NOT EXISTS topicopts (topicid INTEGER NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, UNIQUE(topicid, name), FOREIGN KEY(topicid) REFERENCES topics(id))")
+        topicid = c.execute("SELECT id FROM topics WHERE name=?", (topic,)).fetchone()[0]
+        c.executemany("INSERT OR REPLACE INTO topicopts VALUES(?,?,?)", [(topicid, name, str(value)) for name, value in options.items()])
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
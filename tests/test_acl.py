@@ -0,0 +1,92 @@
+import os, sys, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+from acl import AclCache, PatternSet
+
+
+CLIENTS = [(1, "hp1_1", "1234"), (2, "hs1_1", "1234")]
+TOPICS = [(1, "topic001"), (2, "topic002")]
+PERMS = [(1, 1, 0, 1), (2, 1, 1, 0), (2, 2, 1, 0)] # clientid, topicid, subscribe, publish
+MEMBERS = [("readers", "hs*"), ("writers", "hp?_1")]
+GRANTS = [("readers", "topic*", 1, 0), ("writers", "topic00[1-5]", 0, 1), ("writers", "news", 1, 1)]
+
+
+class AclCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.acl = AclCache()
+        self.acl.load(CLIENTS, TOPICS, PERMS)
+
+    def test_perms(self) -> None:
+        self.assertTrue(self.acl.check('publish', "hp1_1", "1234", "topic001"))
+        self.assertFalse(self.acl.check('subscribe', "hp1_1", "1234", "topic001"))
+        self.assertTrue(self.acl.check('subscribe', "hs1_1", "1234", "topic002"))
+        self.assertFalse(self.acl.check('publish', "hs1_1", "1234", "topic002"))
+
+    def test_unknown_user_topic_or_password(self) -> None:
+        self.assertFalse(self.acl.check('subscribe', "hs1_1", "wrong", "topic001"))
+        self.assertFalse(self.acl.check('subscribe', "nobody", "1234", "topic001"))
+        self.assertFalse(self.acl.check('subscribe', "hs1_1", "1234", "topic003"))
+
+    def test_updates(self) -> None:
+        self.acl.setPerm(1, 2, (0, 1))
+        self.assertTrue(self.acl.check('publish', "hp1_1", "1234", "topic002"))
+        self.acl.setPerm(2, 1, None)
+        self.assertFalse(self.acl.check('subscribe', "hs1_1", "1234", "topic001"))
+        # rows of clients or topics the snapshot does not know are ignored
+        self.acl.setPerm(3, 1, (1, 1))
+        self.assertEqual(self.acl.updates, 2)
+
+    def test_reload_replaces(self) -> None:
+        self.acl.load(CLIENTS[:1], TOPICS, PERMS)
+        self.assertFalse(self.acl.check('subscribe', "hs1_1", "1234", "topic001"))
+        self.assertTrue(self.acl.check('publish', "hp1_1", "1234", "topic001"))
+        self.assertEqual(self.acl.loads, 2)
+
+
+class PatternSetTest(unittest.TestCase):
+    def test_names_and_globs(self) -> None:
+        patterns = PatternSet(["news", "topic*", "room?", "h[ps]1_*"])
+        for name in ("news", "topic", "topic123", "room1", "hp1_7", "hs1_1"):
+            self.assertTrue(patterns.match(name), name)
+        for name in ("new", "newsroom", "room12", "hx1_1", "atopic"):
+            self.assertFalse(patterns.match(name), name)
+
+    def test_empty(self) -> None:
+        self.assertFalse(PatternSet([]).match("topic001"))
+
+    def test_plain_names_are_not_regexes(self) -> None:
+        self.assertFalse(PatternSet(["topic.1"]).match("topicX1"))
+
+
+class RoleTest(unittest.TestCase):
+    def setUp(self) -> None:
+        clients = CLIENTS + [(3, "hs2_5", "1234"), (4, "hp2_1", "1234")]
+        self.acl = AclCache(size=2)
+        self.acl.load(clients, TOPICS, [], MEMBERS, GRANTS)
+
+    def test_grants(self) -> None:
+        self.assertTrue(self.acl.check('subscribe', "hs2_5", "1234", "topic999"))
+        self.assertFalse(self.acl.check('publish', "hs2_5", "1234", "topic001"))
+        self.assertTrue(self.acl.check('publish', "hp2_1", "1234", "topic005"))
+        self.assertFalse(self.acl.check('publish', "hp2_1", "1234", "topic006"))
+        self.assertTrue(self.acl.check('subscribe', "hp1_1", "1234", "news"))
+        self.assertFalse(self.acl.check('subscribe', "hp2_1", "wrong", "news"))
+
+    def test_perms_add_to_roles(self) -> None:
+        self.acl.setPerm(2, 1, (0, 1))
+        self.assertTrue(self.acl.check('publish', "hs1_1", "1234", "topic001"))
+        self.assertTrue(self.acl.check('subscribe', "hs1_1", "1234", "topic001"))
+
+    def test_decisions_cached(self) -> None:
+        for _ in range(3):
+            self.acl.check('subscribe', "hs2_5", "1234", "topic001")
+        self.assertEqual((self.acl.misses, self.acl.hits), (1, 2))
+        # the cache keeps size decisions, least recently used first out
+        self.acl.check('subscribe', "hs2_5", "1234", "topic002")
+        self.acl.check('subscribe', "hs2_5", "1234", "topic003")
+        self.assertEqual(len(self.acl.decisions), 2)
+        self.assertNotIn(('subscribe', "hs2_5", "topic001"), self.acl.decisions)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import asyncio, os, sys, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+from acl import AclCache, AuthCoalescer
+
+
+class AuthCoalescerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.fetched = []
+        self.error = None
+
+    async def fetch(self, keys) -> None:
+        self.fetched.append(list(keys))
+        await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+
+    async def test_one_fetch_per_window(self) -> None:
+        coalescer = AuthCoalescer(self.fetch, window=0.01)
+        await asyncio.gather(*(coalescer.wait("user%d" % (i % 3)) for i in range(10)))
+        self.assertEqual(self.fetched, [["user0", "user1", "user2"]])
+        self.assertEqual((coalescer.batches, coalescer.requests, coalescer.deduplicated), (1, 10, 7))
+        self.assertEqual(coalescer.futures, {})
+
+    async def test_batch_flushed_when_full(self) -> None:
+        coalescer = AuthCoalescer(self.fetch, window=10, batch=2)
+        await asyncio.wait_for(asyncio.gather(*(coalescer.wait("user%d" % i) for i in range(4))), 1)
+        self.assertEqual(self.fetched, [["user0", "user1"], ["user2", "user3"]])
+        self.assertIsNone(coalescer.timer)
+
+    async def test_key_in_flight_shared(self) -> None:
+        # a key asked for while its fetch runs does not start another one
+        coalescer = AuthCoalescer(self.fetch, window=0, batch=1)
+        first = coalescer.wait("user0")
+        await asyncio.sleep(0)
+        self.assertIs(coalescer.wait("user0"), first)
+        await first
+        self.assertEqual(self.fetched, [["user0"]])
+
+    async def test_error_reaches_every_waiter(self) -> None:
+        self.error = RuntimeError("database is locked")
+        coalescer = AuthCoalescer(self.fetch, window=0.001)
+        results = await asyncio.gather(coalescer.wait("user0"), coalescer.wait("user1"), return_exceptions=True)
+        self.assertEqual(results, [self.error, self.error])
+        # the next wait fetches again
+        self.error = None
+        await coalescer.wait("user0")
+        self.assertEqual(len(self.fetched), 2)
+
+
+class PerUserPermsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.acl = AclCache()
+        self.acl.load([(1, "hs1_1", "1234"), (2, "hs1_2", "1234")], [(1, "topic001")], None)
+
+    def test_loaded_on_demand(self) -> None:
+        self.assertFalse(self.acl.hasPerms("hs1_1"))
+        self.assertTrue(self.acl.hasPerms("nobody"))
+        self.acl.loadPerms(["hs1_1"], [(1, 1, 1, 0)])
+        self.assertTrue(self.acl.hasPerms("hs1_1"))
+        self.assertFalse(self.acl.hasPerms("hs1_2"))
+        self.assertTrue(self.acl.check('subscribe', "hs1_1", "1234", "topic001"))
+
+    def test_updates_of_users_not_loaded_ignored(self) -> None:
+        self.acl.setPerm(2, 1, (1, 0))
+        self.assertFalse(self.acl.check('subscribe', "hs1_2", "1234", "topic001"))
+        self.acl.loadPerms(["hs1_2"], [])
+        self.acl.setPerm(2, 1, (1, 0))
+        self.assertTrue(self.acl.check('subscribe', "hs1_2", "1234", "topic001"))
+
+
+if __name__ == "__main__":
+    unittest.main()
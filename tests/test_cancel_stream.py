@@ -0,0 +1,45 @@
+import os, sys, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "aiowebtrans"))
+from aioquic.quic.packet_builder import QuicDeliveryState
+from aioquic.quic.stream import QuicStream
+from webtrans_broker import drop_unsent
+
+
+DATA = bytes(range(256)) * 16
+
+
+class CancelStreamTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.stream = QuicStream(stream_id=3, readable=False)
+        self.sender = self.stream.sender
+        self.sender.write(DATA, end_stream=True)
+        # two frames sent out of the whole message
+        self.first = self.sender.get_frame(1000)
+        self.second = self.sender.get_frame(1000)
+        self.sender.reset(0x10c)
+        drop_unsent(self.sender)
+
+    def test_nothing_past_final_size(self) -> None:
+        self.assertEqual(self.sender.get_reset_frame().final_size, 2000)
+        self.assertIsNone(self.sender.get_frame(1000))
+        self.assertTrue(self.sender.buffer_is_empty)
+
+    def test_retransmission_after_cancel(self) -> None:
+        # the first frame is acknowledged, the second one is lost and queued again
+        self.sender.on_data_delivery(QuicDeliveryState.ACKED, 0, 1000)
+        self.sender.on_data_delivery(QuicDeliveryState.LOST, 1000, 2000)
+        frame = self.sender.get_frame(1000)
+        self.assertEqual(frame.offset, 1000)
+        self.assertEqual(frame.data, DATA[1000:2000])
+        self.assertFalse(frame.fin)
+        self.assertIsNone(self.sender.get_frame(1000))
+
+    def test_finished_once_reset_acked(self) -> None:
+        self.sender.on_reset_delivery(QuicDeliveryState.ACKED)
+        self.assertTrue(self.sender.is_finished)
+
+
+if __name__ == "__main__":
+    unittest.main()
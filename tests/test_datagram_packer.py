@@ -0,0 +1,58 @@
+import asyncio, os, sys, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "aiowebtrans"))
+from broker_app import DatagramPacker
+from util import decode_varint, encode_varint
+
+
+def unpack(data: bytes, tagged: bool) -> list:
+    # as the client's process_packed_datagram
+    parts = []
+    pos = 0
+    while pos < len(data):
+        id = None
+        if tagged:
+            id, pos = decode_varint(data, pos)
+        length, pos = decode_varint(data, pos)
+        parts.append((id, data[pos:pos+length]))
+        pos += length
+    return parts
+
+
+class DatagramPackerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_round_trip(self) -> None:
+        packer = DatagramPacker(0.01)
+        messages = [b"a", b"b" * 70, b""]
+        for data in messages:
+            packer.add(packer.prefix(data, None), data)
+        self.assertEqual(packer.count(), 3)
+        data = packer.flush()
+        # lengths of 64 and more take a two byte varint
+        self.assertEqual(len(data), 1 + 2 + 1 + 71)
+        self.assertEqual(unpack(data, False), [(None, message) for message in messages])
+        self.assertEqual(packer.size, 0)
+        self.assertEqual(packer.count(), 0)
+
+    async def test_tagged_round_trip(self) -> None:
+        packer = DatagramPacker(0.01)
+        for id, data in ((1, b"x"), (300, b"yy")):
+            packer.add(packer.prefix(data, encode_varint(id)), data)
+        self.assertEqual(unpack(packer.flush(), True), [(1, b"x"), (300, b"yy")])
+
+    async def test_fits(self) -> None:
+        packer = DatagramPacker(0.01)
+        packer.add(packer.prefix(b"a" * 10, None), b"a" * 10)
+        self.assertTrue(packer.fits(9, 20))
+        self.assertFalse(packer.fits(10, 20))
+
+    async def test_deadline_from_oldest(self) -> None:
+        packer = DatagramPacker(0.05)
+        packer.add(b"\x01", b"a")
+        await asyncio.sleep(0.03)
+        packer.add(b"\x01", b"b")
+        self.assertLess(packer.timeout(), 0.03)
+
+
+if __name__ == "__main__":
+    unittest.main()
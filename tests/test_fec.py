@@ -0,0 +1,71 @@
+import os, sys, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+from fec import FecDecoder, FecEncoder, FEC_GROUPS
+
+
+PAYLOADS = [b"first", b"second, longer", b"3", b""]
+
+
+def encode(encoder: FecEncoder, payloads: list) -> list:
+    datagrams = [encoder.encode(data) for data in payloads]
+    return datagrams + [encoder.flush()]
+
+
+class FecTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.encoder = FecEncoder(len(PAYLOADS))
+        self.decoder = FecDecoder()
+
+    def decode(self, datagrams: list) -> list:
+        payloads = []
+        for datagram in datagrams:
+            payloads += self.decoder.decode(datagram)
+        return payloads
+
+    def test_no_loss(self) -> None:
+        datagrams = encode(self.encoder, PAYLOADS)
+        self.assertTrue(self.encoder.group == 1 and not self.encoder.isPending())
+        self.assertEqual(self.decode(datagrams), PAYLOADS)
+        self.assertEqual(self.decoder.recovered, 0)
+
+    def test_single_loss_recovered(self) -> None:
+        for lost in range(len(PAYLOADS)):
+            with self.subTest(lost=lost):
+                self.setUp()
+                datagrams = encode(self.encoder, PAYLOADS)
+                del datagrams[lost]
+                payloads = self.decode(datagrams)
+                self.assertEqual(sorted(payloads), sorted(PAYLOADS))
+                self.assertEqual(payloads[-1], PAYLOADS[lost])
+                self.assertEqual(self.decoder.recovered, 1)
+
+    def test_parity_before_data(self) -> None:
+        datagrams = encode(self.encoder, PAYLOADS)
+        parity = datagrams.pop()
+        payloads = self.decode([parity] + datagrams[1:])
+        self.assertEqual(payloads, PAYLOADS[1:] + PAYLOADS[:1])
+
+    def test_double_loss_not_recovered(self) -> None:
+        datagrams = encode(self.encoder, PAYLOADS)
+        self.assertEqual(self.decode(datagrams[2:]), PAYLOADS[2:])
+        self.assertEqual(self.decoder.recovered, 0)
+
+    def test_partial_group(self) -> None:
+        # the parity of a group flushed before it was full
+        datagrams = encode(self.encoder, PAYLOADS[:2])
+        self.assertEqual(self.decode(datagrams[1:]), PAYLOADS[1:2] + PAYLOADS[:1])
+
+    def test_duplicate_ignored(self) -> None:
+        datagrams = encode(self.encoder, PAYLOADS)
+        self.assertEqual(self.decode(datagrams[:1] * 2), PAYLOADS[:1])
+
+    def test_groups_bounded(self) -> None:
+        for _ in range(FEC_GROUPS + 5):
+            self.decode([self.encoder.encode(b"x")])
+            self.encoder.flush()
+        self.assertEqual(len(self.decoder.groups), FEC_GROUPS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os, sys, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+from framing import create_parser, frame_header
+from util import Z_END_PATTERN
+
+
+MESSAGES = [b"", b"a", b"b" * 63, b"c" * 64, b"d" * 20000]
+
+
+def frames(parser) -> list:
+    return [bytes(frame) for frame in parser]
+
+
+class VarintParserTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.parser = create_parser('varint')
+        self.stream = b"".join(frame_header(message, 'varint') + message for message in MESSAGES)
+
+    def test_round_trip(self) -> None:
+        self.parser.feed(self.stream)
+        self.assertEqual(frames(self.parser), MESSAGES)
+
+    def test_byte_by_byte(self) -> None:
+        # lengths and messages split anywhere across feeds
+        received = []
+        for i in range(len(self.stream)):
+            self.parser.feed(self.stream[i:i+1])
+            received += frames(self.parser)
+        self.assertEqual(received, MESSAGES)
+
+    def test_incomplete_frame_kept(self) -> None:
+        self.parser.feed(self.stream[:-1])
+        self.assertEqual(frames(self.parser), MESSAGES[:-1])
+        self.parser.feed(self.stream[-1:])
+        self.assertEqual(frames(self.parser), MESSAGES[-1:])
+
+
+class PatternParserTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.parser = create_parser('pattern')
+        self.messages = [b"x" * n + Z_END_PATTERN for n in (0, 1, 100, 5000)]
+        self.stream = b"".join(frame_header(message, 'pattern') + message for message in self.messages)
+
+    def test_round_trip(self) -> None:
+        self.parser.feed(self.stream)
+        self.assertEqual(frames(self.parser), self.messages)
+
+    def test_pattern_split_across_feeds(self) -> None:
+        received = []
+        for i in range(0, len(self.stream), 3):
+            self.parser.feed(self.stream[i:i+3])
+            received += frames(self.parser)
+        self.assertEqual(received, self.messages)
+
+    def test_no_pattern_no_frame(self) -> None:
+        self.parser.feed(b"x" * 10 + Z_END_PATTERN[:3])
+        self.assertEqual(frames(self.parser), [])
+        self.parser.feed(Z_END_PATTERN[3:])
+        self.assertEqual(frames(self.parser), [b"x" * 10 + Z_END_PATTERN])
+
+
+if __name__ == "__main__":
+    unittest.main()
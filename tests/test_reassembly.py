@@ -0,0 +1,54 @@
+import os, sys, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+from reassembly import Reassembler
+
+
+class ReassemblerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.stopped = []
+        self.reassembler = Reassembler(limit=100, on_drop=self.stopped.append)
+
+    def test_whole_message_once_ended(self) -> None:
+        self.assertIsNone(self.reassembler.add(2, b"abc", False))
+        self.assertIsNone(self.reassembler.add(2, b"def", False))
+        self.assertEqual(self.reassembler.add(2, b"g", True), b"abcdefg")
+        self.assertEqual(self.reassembler.size, 0)
+        self.assertEqual(self.reassembler.partial, {})
+
+    def test_single_chunk_not_buffered(self) -> None:
+        self.assertEqual(self.reassembler.add(2, b"abc", True), b"abc")
+        self.assertEqual(self.reassembler.partial, {})
+
+    def test_interleaved_streams(self) -> None:
+        self.reassembler.add(2, b"a", False)
+        self.reassembler.add(6, b"x", False)
+        self.assertEqual(self.reassembler.add(6, b"y", True), b"xy")
+        self.assertEqual(self.reassembler.add(2, b"b", True), b"ab")
+
+    def test_batch(self) -> None:
+        self.assertIsNone(self.reassembler.add(2, b"ab", False, batch=4))
+        self.assertEqual(self.reassembler.add(2, b"cd", False, batch=4), b"abcd")
+        self.assertEqual(self.reassembler.add(2, b"e", True, batch=4), b"e")
+
+    def test_limit_drops_stream(self) -> None:
+        self.reassembler.add(2, b"a" * 60, False)
+        self.reassembler.add(6, b"b" * 30, False)
+        self.assertIsNone(self.reassembler.add(2, b"a" * 20, False))
+        self.assertEqual(self.stopped, [2])
+        self.assertEqual(self.reassembler.drops, 1)
+        self.assertEqual(self.reassembler.size, 30)
+        # the rest of the dropped stream is ignored until it ends
+        self.assertIsNone(self.reassembler.add(2, b"a", True))
+        self.assertEqual(self.reassembler.add(6, b"b", True), b"b" * 31)
+        self.assertEqual(self.reassembler.add(2, b"new", True), b"new")
+
+    def test_discard(self) -> None:
+        self.reassembler.add(2, b"abc", False)
+        self.reassembler.discard(2)
+        self.assertEqual(self.reassembler.size, 0)
+        self.assertEqual(self.reassembler.add(2, b"d", True), b"d")
+
+
+if __name__ == "__main__":
+    unittest.main()
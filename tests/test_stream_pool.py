@@ -0,0 +1,24 @@
+import os, sys, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "aiowebtrans"))
+from broker_app import StreamPool
+
+
+class StreamPoolTest(unittest.TestCase):
+    def test_round_robin(self) -> None:
+        pool = StreamPool(3)
+        self.assertEqual([pool.pick(publisher) for publisher in (7, 7, 7, 7, 8)], [0, 1, 2, 0, 1])
+
+    def test_by_publisher(self) -> None:
+        # every message of a publisher goes on the same stream
+        pool = StreamPool(4, 'publisher')
+        self.assertEqual([pool.pick(publisher) for publisher in (1, 6, 1, 6, 4)], [1, 2, 1, 2, 0])
+
+    def test_unknown_publisher_round_robin(self) -> None:
+        pool = StreamPool(2, 'publisher')
+        self.assertEqual([pool.pick(None) for _ in range(3)], [0, 1, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
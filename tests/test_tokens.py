@@ -0,0 +1,70 @@
+import os, sys, time, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from tokens import TokenSigner, TokenVerifier, b64decode, b64encode
+
+
+SECRET = b"secret"
+
+
+class TokenVerifierTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.signer = TokenSigner('hs256', SECRET)
+        self.verifier = TokenVerifier('hs256', SECRET, size=2)
+
+    def test_scope(self) -> None:
+        capability = self.verifier.verify(self.signer.sign("hs1_1", ["topic0*"], ["news"]))
+        self.assertEqual(capability.user, "hs1_1")
+        self.assertTrue(capability.allows('subscribe', "topic001"))
+        self.assertFalse(capability.allows('subscribe', "topic100"))
+        self.assertFalse(capability.allows('subscribe', "news"))
+        self.assertTrue(capability.allows('publish', "news"))
+        self.assertFalse(capability.allows('publish', "topic001"))
+
+    def test_expired(self) -> None:
+        self.assertIsNone(self.verifier.verify(self.signer.sign("hs1_1", ["topic*"], ttl=-1)))
+
+    def test_expires_while_cached(self) -> None:
+        token = self.signer.sign("hs1_1", ["topic*"], ttl=1)
+        capability = self.verifier.verify(token)
+        self.assertTrue(capability.allows('subscribe', "topic001"))
+        capability.expires = time.time() - 1
+        self.assertFalse(capability.allows('subscribe', "topic001"))
+        self.assertIsNone(self.verifier.verify(token))
+        self.assertEqual(self.verifier.hits, 1)
+
+    def test_tampered(self) -> None:
+        token = self.signer.sign("hs1_1", ["topic001"])
+        algorithm, claims, signature = token.split('.')
+        claims = b64encode(b64decode(claims).replace(b"topic001", b"topic*"))
+        self.assertIsNone(self.verifier.verify('.'.join((algorithm, claims, signature))))
+        self.assertIsNone(TokenVerifier('hs256', b"other").verify(token))
+        self.assertEqual(self.verifier.rejected, 1)
+
+    def test_malformed(self) -> None:
+        for token in ("", "hs256", "hs256.x.y", "hs256.e30.", "a.b.c.d", "hs256.\ufffd.x"):
+            self.assertIsNone(self.verifier.verify(token), token)
+
+    def test_algorithm_from_verifier(self) -> None:
+        # an ed25519 token is not checked with the HMAC secret, nor the reverse
+        private = Ed25519PrivateKey.generate()
+        pem = private.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        token = TokenSigner('ed25519', pem).sign("hs1_1", ["topic*"])
+        self.assertIsNone(self.verifier.verify(token))
+        public = private.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        verifier = TokenVerifier('ed25519', public)
+        self.assertTrue(verifier.verify(token).allows('subscribe', "topic001"))
+        self.assertIsNone(verifier.verify(self.signer.sign("hs1_1", ["topic*"])))
+
+    def test_cache(self) -> None:
+        tokens = [self.signer.sign("hs1_%d" % i, ["topic*"]) for i in range(3)]
+        for token in tokens + tokens[-1:]:
+            self.verifier.verify(token)
+        self.assertEqual((self.verifier.verified, self.verifier.hits), (3, 1))
+        self.assertEqual(list(self.verifier.cache), tokens[1:])
+
+
+if __name__ == "__main__":
+    unittest.main()
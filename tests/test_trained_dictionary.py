@@ -0,0 +1,65 @@
+import json, os, random, sys, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+from codec import DictionaryDecompressor, TrainedDictionary, DICT_MIN_SAMPLES, DICT_RETRAIN, DICT_SAMPLES, zstandard
+
+
+def sample(rng: random.Random) -> bytes:
+    return json.dumps({"id": rng.randint(0, 99999), "answer": rng.choice(["Hot air", "Cold water", "Warm wind"]), "value": rng.random()}).encode()
+
+
+@unittest.skipIf(zstandard is None, "zstandard is not installed")
+class TrainedDictionaryTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.rng = random.Random(1)
+        self.dictionary = TrainedDictionary()
+        self.decompressor = DictionaryDecompressor()
+
+    def train(self) -> None:
+        for _ in range(DICT_MIN_SAMPLES):
+            self.dictionary.countPublication()
+        self.assertTrue(self.dictionary.isDue())
+        self.assertTrue(self.dictionary.train([sample(self.rng) for _ in range(DICT_SAMPLES)]))
+
+    def test_plain_zstd_before_training(self) -> None:
+        data = sample(self.rng)
+        self.assertEqual(self.dictionary.version, 0)
+        self.assertEqual(self.dictionary.export(), b"")
+        self.assertEqual(self.decompressor.decompress(self.dictionary.encode(data)), data)
+
+    def test_round_trip_with_dictionary(self) -> None:
+        self.train()
+        self.assertEqual(self.dictionary.version, 1)
+        self.assertFalse(self.dictionary.isDue())
+        data = sample(self.rng)
+        self.assertEqual(self.decompressor.decompress(self.dictionary.export() + self.dictionary.encode(data)), data)
+        # the dictionary is only shipped once
+        data = sample(self.rng)
+        self.assertEqual(self.decompressor.decompress(self.dictionary.encode(data)), data)
+
+    def test_smaller_with_dictionary(self) -> None:
+        data = sample(self.rng)
+        plain = len(self.dictionary.encode(data))
+        self.train()
+        self.assertLess(len(self.dictionary.encode(data)), plain)
+
+    def test_missing_dictionary(self) -> None:
+        self.train()
+        self.assertIsNone(self.decompressor.decompress(self.dictionary.encode(sample(self.rng))))
+
+    def test_retrain_interval(self) -> None:
+        self.train()
+        for _ in range(DICT_RETRAIN - 1):
+            self.dictionary.countPublication()
+        self.assertFalse(self.dictionary.isDue())
+        self.dictionary.countPublication()
+        self.assertTrue(self.dictionary.isDue())
+
+    def test_failed_training_keeps_version(self) -> None:
+        self.assertFalse(self.dictionary.train([b"x"]))
+        self.assertEqual(self.dictionary.version, 0)
+        self.assertEqual(self.dictionary.published, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
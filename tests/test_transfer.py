@@ -0,0 +1,88 @@
+import asyncio, os, sys, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "aiowebtrans"))
+from broker_app import Transfer, relay
+
+
+class TransferTest(unittest.TestCase):
+    def test_window_keeps_last_chunks(self) -> None:
+        transfer = Transfer(window=10)
+        for chunk in (b"aaaa", b"bbbb", b"cccc"):
+            transfer.append(chunk, False)
+        self.assertEqual(transfer.base, 4)
+        self.assertIsNone(transfer.read(0))
+        self.assertEqual(transfer.read(4), [b"bbbb", b"cccc"])
+        self.assertEqual(transfer.read(8), [b"cccc"])
+
+    def test_whole_publication_kept(self) -> None:
+        transfer = Transfer(window=10)
+        transfer.append(b"aaaa", False)
+        transfer.append(b"bbbb", True)
+        self.assertTrue(transfer.isDone(8))
+        self.assertEqual(transfer.read(0), [b"aaaa", b"bbbb"])
+
+    def test_cut_publication_trimmed_after_readers(self) -> None:
+        transfer = Transfer(window=4)
+        transfer.addReader()
+        transfer.append(b"aaaa", False)
+        transfer.append(b"bbbb", True)
+        self.assertEqual(transfer.read(4), [b"bbbb"])
+        transfer.deleteReader()
+        self.assertEqual(transfer.read(4), [])
+
+    def test_abort(self) -> None:
+        transfer = Transfer()
+        transfer.append(b"aaaa", False)
+        transfer.abort()
+        self.assertIsNone(transfer.read(0))
+
+
+class RelayTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.sent = []
+        self.backlog = 0
+
+    async def send(self, message) -> None:
+        self.sent.append(dict(message))
+
+    def relay(self, transfer: Transfer) -> asyncio.Future:
+        return asyncio.ensure_future(relay(transfer, b"\x01", self.send, lambda: self.backlog, 100))
+
+    async def test_relayed_while_arriving(self) -> None:
+        transfer = Transfer()
+        task = self.relay(transfer)
+        transfer.append(b"aaaa", False)
+        await asyncio.sleep(0)
+        transfer.append(b"bbbb", False)
+        transfer.append(b"cccc", True)
+        self.assertTrue(await asyncio.wait_for(task, 1))
+        self.assertEqual(b"".join(chunk["data"] for chunk in self.sent), b"aaaabbbbcccc")
+        self.assertEqual([chunk["end"] for chunk in self.sent], [False] * (len(self.sent) - 1) + [True])
+        self.assertTrue(all(chunk["header"] == b"\x01" for chunk in self.sent))
+        self.assertEqual(transfer.readers, 0)
+
+    async def test_reader_left_behind_is_reset(self) -> None:
+        transfer = Transfer(window=8)
+        task = self.relay(transfer)
+        transfer.append(b"aaaa", False)
+        await asyncio.sleep(0)
+        # the session stops draining while the publication moves on
+        self.backlog = 1000
+        for chunk in (b"bbbb", b"cccc", b"dddd"):
+            transfer.append(chunk, False)
+        self.backlog = 0
+        self.assertFalse(await asyncio.wait_for(task, 1))
+        self.assertEqual(self.sent[-1]["type"], "webtransport.stream.reset")
+
+    async def test_cut_off_before_first_chunk(self) -> None:
+        # nothing was sent yet, so there is no stream to reset
+        transfer = Transfer(window=4)
+        transfer.append(b"aaaa", False)
+        transfer.append(b"bbbb", False)
+        self.assertFalse(await asyncio.wait_for(self.relay(transfer), 1))
+        self.assertEqual(self.sent, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
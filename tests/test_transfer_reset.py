@@ -0,0 +1,89 @@
+import asyncio, os, sys, time, unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "util"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "aiowebtrans"))
+import broker_app
+from broker_app import PS, Topic, SubscriberCursor, relay
+from tokens import Capability
+
+
+TOPIC = "topic001"
+
+
+class TransferResetTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        broker_app.ps = PS(None)
+        broker_app.ps.topics[TOPIC] = Topic({})
+        broker_app.ps.index.add_topic(TOPIC)
+        self.ring = broker_app.ps.topics[TOPIC].ring
+        self.queue = asyncio.Queue()
+        scope = {"user": None, "password": None, "capability": Capability({"exp": time.time() + 60, "publish": [TOPIC]})}
+        self.task = asyncio.ensure_future(broker_app.publisher(scope, {"topic": TOPIC, "streaming": "1"}, self.queue, self.send))
+        self.published = []
+        self.queue.put_nowait({"type": "webtransport.connect"})
+
+    async def asyncTearDown(self) -> None:
+        self.queue.put_nowait({"type": "webtransport.stream.end"})
+        await asyncio.wait_for(self.task, 1)
+        broker_app.ps = None
+
+    async def send(self, message) -> None:
+        self.published.append(message)
+
+    def receive(self, data: bytes, end: bool = False) -> None:
+        self.queue.put_nowait({"type": "webtransport.stream.receive", "data": data, "end": end, "stream": 2})
+
+    async def test_reset_during_relay(self) -> None:
+        cursor = SubscriberCursor(self.ring)
+        self.receive(b"a" * 100)
+        await asyncio.sleep(0.01)
+        transfer = cursor.next()
+        self.assertIsInstance(transfer, broker_app.Transfer)
+
+        sent = []
+        async def subscriber_send(message) -> None:
+            sent.append(message)
+        relaying = asyncio.ensure_future(relay(transfer, None, subscriber_send, lambda: 0, 1 << 20))
+        await asyncio.sleep(0.01)
+        self.assertEqual(sent[0]["data"], b"a" * 100)
+
+        self.queue.put_nowait({"type": "webtransport.stream.reset", "stream": 2})
+        # the relay stops without waiting for the publisher's session to end
+        self.assertFalse(await asyncio.wait_for(relaying, 1))
+        self.assertEqual(sent[-1]["type"], "webtransport.stream.reset")
+        self.assertEqual(transfer.readers, 0)
+
+        # and subscribers joining later skip it
+        late = SubscriberCursor(self.ring)
+        late.seq = transfer.seq
+        self.assertIsNone(late.next())
+        self.assertIsNone(self.ring.get(transfer.seq)['transfer'])
+
+    async def test_finished_transfer_kept(self) -> None:
+        cursor = SubscriberCursor(self.ring)
+        self.receive(b"b" * 10)
+        self.receive(b"b" * 10, True)
+        await asyncio.sleep(0.01)
+        transfer = cursor.next()
+        self.assertTrue(transfer.isDone(20))
+        self.assertIs(self.ring.get(transfer.seq)['transfer'], transfer)
+
+    async def test_single_batch_published_whole(self) -> None:
+        # a publication that fits in one batch is encoded like any other
+        cursor = SubscriberCursor(self.ring)
+        self.receive(b"c" * 10, True)
+        await asyncio.sleep(0.01)
+        self.assertEqual(cursor.next(), b"c" * 10)
+        self.assertIsNone(self.ring.get(self.ring.head - 1)['transfer'])
+
+    async def test_skipped_transfer_counted(self) -> None:
+        cursor = SubscriberCursor(self.ring)
+        cursor.stateless = (('zlib', 6), lambda data: data)
+        self.receive(b"d" * 10)
+        await asyncio.sleep(0.01)
+        self.assertIsNone(cursor.next())
+        self.assertEqual((cursor.drops, cursor.skipped), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,209 @@
+import asyncio, re
+from collections import OrderedDict
+from fnmatch import translate
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+ACL_REFRESH = 1.0 # seconds between two checks of the database for ACL changes
+ACL_CACHE_SIZE = pow(2, 16) # role decisions kept by the matcher
+ACL_PRELOAD = pow(2, 20) # perms rows loaded at startup, past it they are loaded per user on demand
+AUTH_WINDOW = 0.005 # seconds the users to load are collected for before one query loads them
+AUTH_BATCH = 512 # users loaded by a query at most
+ROLES = ('subscribe', 'publish')
+RIGHT = {rol: i for i, rol in enumerate(ROLES)} # position of a right in a perms row
+
+# roles grant rights on topic patterns to the clients matching their members,
+# e.g. members 'hs*' may subscribe to topics 'topic*'. Patterns are globs
+# (*, ?, [...]), anything else is a plain name. They add to the perms rows
+ROLE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS roles (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS rolemembers (roleid INTEGER NOT NULL, clients TEXT NOT NULL, UNIQUE(roleid, clients), FOREIGN KEY(roleid) REFERENCES roles(id));
+CREATE TABLE IF NOT EXISTS rolegrants (roleid INTEGER NOT NULL, topics TEXT NOT NULL, subscribe INTEGER NOT NULL, publish INTEGER NOT NULL, UNIQUE(roleid, topics), FOREIGN KEY(roleid) REFERENCES roles(id));
+"""
+
+
+def is_pattern(name: str) -> bool:
+    return any(char in name for char in '*?[')
+
+
+class PatternSet:
+    # names and globs compiled into a set and a single regex
+    def __init__(self, patterns: Iterable[str]) -> None:
+        patterns = list(patterns)
+        self.names = {pattern for pattern in patterns if not is_pattern(pattern)}
+        globs = [translate(pattern) for pattern in patterns if is_pattern(pattern)]
+        self.regex = re.compile('|'.join(globs)) if globs else None
+
+    def match(self, name: str) -> bool:
+        return name in self.names or (self.regex is not None and self.regex.match(name) is not None)
+
+
+class Role:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.members: List[str] = []
+        self.grants: Dict[str, List[str]] = {rol: [] for rol in ROLES} # topic patterns per right
+        self.clients = self.topics = None
+
+    def addGrant(self, topics: str, subscribe: int, publish: int) -> None:
+        for rol, allowed in zip(ROLES, (subscribe, publish)):
+            if allowed:
+                self.grants[rol].append(topics)
+
+    def compile(self) -> None:
+        self.clients = PatternSet(self.members)
+        self.topics = {rol: PatternSet(patterns) for rol, patterns in self.grants.items()}
+
+
+class AclCache:
+    # in-memory copy of the clients, topics, perms and role tables: a CONNECT is
+    # authorized with a few dict lookups instead of a JOIN on the database.
+    # Role decisions are cached per (right, user, topic)
+    def __init__(self, size: int = ACL_CACHE_SIZE) -> None:
+        self.passwords: Dict[str, str] = {}
+        self.perms: Dict[Tuple[str, str], Tuple[int, int]] = {} # (user, topic) -> (subscribe, publish)
+        self.clients: Dict[int, str] = {} # ids of the rows perms refer to
+        self.topics: Dict[int, str] = {}
+        self.roles: Dict[str, Role] = {}
+        self.memberships: Dict[str, List[Role]] = {} # roles of the users checked so far
+        self.decisions: OrderedDict[Tuple[str, str, str], bool] = OrderedDict()
+        self.loaded: Optional[Set[str]] = None # users whose perms rows are loaded, None for all of them
+        self.size = size
+        self.loads = 0
+        self.updates = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, clients: Iterable[Tuple[int, str, str]], topics: Iterable[Tuple[int, str]], perms: Optional[Iterable[Tuple[int, int, int, int]]], members: Iterable[Tuple[str, str]] = (), grants: Iterable[Tuple[str, str, int, int]] = ()) -> None:
+        # perms None: loaded later, user by user, with loadPerms
+        self.passwords.clear()
+        self.perms.clear()
+        self.clients.clear()
+        self.topics.clear()
+        self.roles.clear()
+        self.memberships.clear()
+        self.decisions.clear()
+        for id, user, password in clients:
+            self.clients[id] = user
+            self.passwords[user] = password
+        for id, name in topics:
+            self.topics[id] = name
+        self.loaded = None if perms is not None else set()
+        if perms is not None:
+            self.loadPerms((), perms)
+        for name, pattern in members:
+            self.getRole(name).members.append(pattern)
+        for name, pattern, subscribe, publish in grants:
+            self.getRole(name).addGrant(pattern, subscribe, publish)
+        for role in self.roles.values():
+            role.compile()
+        self.loads += 1
+
+    def getRole(self, name: str) -> Role:
+        if name not in self.roles:
+            self.roles[name] = Role(name)
+        return self.roles[name]
+
+    def hasPerms(self, user: str) -> bool:
+        # the perms rows of user are loaded, or it has none
+        return self.loaded is None or user in self.loaded or user not in self.passwords
+
+    def loadPerms(self, users: Iterable[str], perms: Iterable[Tuple[int, int, int, int]]) -> None:
+        # every perms row of users
+        clients, topics = self.clients, self.topics
+        for clientid, topicid, subscribe, publish in perms:
+            if clientid in clients and topicid in topics:
+                self.perms[(clients[clientid], topics[topicid])] = (subscribe, publish)
+        if self.loaded is not None:
+            self.loaded.update(users)
+
+    def setPerm(self, clientid: int, topicid: int, row: Optional[Tuple[int, int]]) -> None:
+        # row is (subscribe, publish), None once the perms row is deleted
+        key = (self.clients.get(clientid), self.topics.get(topicid))
+        if None in key or not self.hasPerms(key[0]):
+            # the rows of a user not loaded yet are read when it is
+            return
+        if row is None:
+            self.perms.pop(key, None)
+        else:
+            self.perms[key] = tuple(row)
+        self.updates += 1
+
+    def rolesOf(self, user: str) -> List[Role]:
+        roles = self.memberships.get(user)
+        if roles is None:
+            roles = self.memberships[user] = [role for role in self.roles.values() if role.clients.match(user)]
+        return roles
+
+    def check(self, rol: str, user: str, password: str, topic: str) -> bool:
+        if user not in self.passwords or self.passwords[user] != password:
+            return False
+        row = self.perms.get((user, topic))
+        if row is not None and row[RIGHT[rol]]:
+            return True
+        key = (rol, user, topic)
+        decision = self.decisions.get(key)
+        if decision is not None:
+            self.hits += 1
+            self.decisions.move_to_end(key)
+            return decision
+        self.misses += 1
+        decision = any(role.topics[rol].match(topic) for role in self.rolesOf(user))
+        self.decisions[key] = decision
+        if len(self.decisions) > self.size:
+            self.decisions.popitem(last=False)
+        return decision
+
+
+class AuthCoalescer:
+    # collects the keys awaited during AUTH_WINDOW seconds (or AUTH_BATCH of
+    # them) and resolves them with a single call of fetch. A key already
+    # waited for shares the pending future instead of being fetched again
+    def __init__(self, fetch: Callable[[List[str]], Awaitable[None]], window: float = AUTH_WINDOW, batch: int = AUTH_BATCH) -> None:
+        self.fetch = fetch
+        self.window = window
+        self.batch = batch
+        self.futures: Dict[str, asyncio.Future] = {} # keys queued or being fetched
+        self.queue: List[str] = []
+        self.timer = None
+        self.batches = 0
+        self.requests = 0
+        self.deduplicated = 0
+
+    def wait(self, key: str) -> asyncio.Future:
+        self.requests += 1
+        future = self.futures.get(key)
+        if future is not None:
+            self.deduplicated += 1
+            return future
+        loop = asyncio.get_running_loop()
+        future = self.futures[key] = loop.create_future()
+        self.queue.append(key)
+        if len(self.queue) >= self.batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return future
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.queue:
+            keys, self.queue = self.queue, []
+            self.batches += 1
+            asyncio.ensure_future(self.resolve(keys))
+
+    async def resolve(self, keys: List[str]) -> None:
+        try:
+            await self.fetch(keys)
+            error = None
+        except Exception as e:
+            error = e
+        for key in keys:
+            future = self.futures.pop(key)
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
@@ -0,0 +1,175 @@
+import asyncio, math, time
+from collections import Counter
+from typing import Dict, Optional
+
+from codec import Codec, ZlibCompressor
+
+# adaptive compression (adaptive=1, framing=varint only): every message starts
+# with a flags byte and is sent raw when compressing it would not pay off
+FLAG_RAW = 0x01 # the rest of the message is not compressed
+ADAPTIVE_MIN_SIZE = 64 # bytes, shorter messages grow with the flush trailer
+ADAPTIVE_ENTROPY = 6.5 # bits per byte of the sample, compressed or random data is above
+ENTROPY_SAMPLE = 256 # bytes of a message its entropy is estimated on
+DECISIONS = ('compressed', 'small', 'entropy', 'raw') # raw: skipped, seen by the receiver
+
+LOAD_SAMPLE = 0.1 # seconds between two samples of the loop lag and CPU use
+LAG_HIGH = 0.05 # seconds of loop lag above which compression levels drop
+CPU_HIGH = 0.9 # share of a CPU used by the process above which levels drop
+LEVEL_INTERVAL = 1.0 # seconds between two level changes of a compressor
+
+
+def entropy(data: bytes) -> float:
+    # bits per byte of the start of data
+    sample = data[:ENTROPY_SAMPLE]
+    n = len(sample)
+    return -sum(count / n * math.log2(count / n) for count in Counter(sample).values())
+
+
+class AdaptiveCompressor:
+    # compressor of a codec that tells what it did with the last message:
+    # decision and elapsed are read by the caller to fill its CompressionStats
+    def __init__(self, codec: Codec, level: Optional[int] = None, adaptive: bool = False, min_size: int = ADAPTIVE_MIN_SIZE, max_entropy: float = ADAPTIVE_ENTROPY, settings: Dict[str, int] = {}) -> None:
+        self.level = codec.level if level is None else level
+        self.compressor = codec.createCompressor(self.level, settings)
+        self.zlib = isinstance(self.compressor, ZlibCompressor)
+        self.window = pow(2, abs(self.compressor.wbits)) if self.zlib else codec.window
+        self.requested = self.level # the level only drops below it while loaded
+        self.lowest = codec.lowest
+        self.adaptive = adaptive
+        self.min_size = min_size
+        self.max_entropy = max_entropy
+        self.adjusted = time.monotonic()
+        self.decision = DECISIONS[0]
+        self.elapsed = 0.0
+
+    def compress(self, data: bytes, reset: bool = False) -> bytes:
+        # a keyframe is always compressed, it is where joiners start decompressing
+        start = time.perf_counter()
+        if not self.adaptive or reset:
+            self.decision = 'compressed'
+        elif len(data) < self.min_size:
+            self.decision = 'small'
+        elif entropy(data) > self.max_entropy:
+            self.decision = 'entropy'
+        else:
+            self.decision = 'compressed'
+        if self.decision != 'compressed':
+            # the context never sees it, nor does the receiver's
+            output = bytes((FLAG_RAW,)) + data
+        else:
+            output = self.compressor.compress(data, reset) if reset else self.compressor.compress(data)
+            if self.adaptive:
+                output = b'\x00' + output
+        self.elapsed = time.perf_counter() - start
+        return output
+
+    def adjust(self, loaded: bool) -> int:
+        # halves the level while the process is loaded and doubles it back up to
+        # the requested one once it is not, at a message boundary and at most once
+        # per LEVEL_INTERVAL; returns the change
+        if not self.adaptive or self.lowest is None or time.monotonic() - self.adjusted < LEVEL_INTERVAL:
+            return 0
+        if loaded and self.level > self.lowest:
+            level = max(self.lowest, self.level // 2)
+        elif not loaded and self.level < self.requested:
+            level = min(self.requested, max(1, self.level * 2))
+        else:
+            return 0
+        self.compressor.setLevel(level)
+        change, self.level = level - self.level, level
+        self.adjusted = time.monotonic()
+        return change
+
+    def memory(self) -> int:
+        # estimate of the zlib context, 0 for the other codecs
+        return self.compressor.memory() if self.zlib else 0
+
+    def release(self) -> None:
+        if self.zlib:
+            self.compressor.release()
+
+
+class AdaptiveDecompressor:
+    # receiving side of AdaptiveCompressor
+    def __init__(self, decompressor: 'ZlibDecompressor | ZstdDecompressor | Lz4Decompressor | BrotliDecompressor', adaptive: bool = False) -> None:
+        self.decompressor = decompressor
+        self.adaptive = adaptive
+        self.decision = DECISIONS[0]
+        self.elapsed = 0.0
+
+    def decompress(self, data: bytes) -> bytes:
+        start = time.perf_counter()
+        if self.adaptive and data[0] & FLAG_RAW:
+            self.decision = 'raw'
+            output = bytes(data[1:])
+        else:
+            self.decision = 'compressed'
+            output = self.decompressor.decompress(data[1:] if self.adaptive else data)
+        self.elapsed = time.perf_counter() - start
+        return output
+
+
+class CompressionStats:
+    # bytes and CPU time of the messages of a topic (or a session) by decision,
+    # the bytes/CPU trade-off of its compression
+    def __init__(self) -> None:
+        self.messages = dict.fromkeys(DECISIONS, 0)
+        self.size = 0 # bytes of the messages
+        self.output = 0 # bytes on the wire, flags included
+        self.seconds = 0.0 # spent deciding and (de)compressing
+        self.drops = 0 # level changes down
+        self.raises = 0 # and back up
+        self.reported = 0 # messages at the last hasChanged()
+
+    def record(self, decision: str, size: int, output: int, seconds: float) -> None:
+        self.messages[decision] += 1
+        self.size += size
+        self.output += output
+        self.seconds += seconds
+
+    def countChange(self, change: int) -> None:
+        if change < 0:
+            self.drops += 1
+        elif change > 0:
+            self.raises += 1
+
+    def ratio(self) -> float:
+        return self.output / max(self.size, 1)
+
+    def hasChanged(self) -> bool:
+        # messages were recorded since the last call
+        count = sum(self.messages.values())
+        changed, self.reported = count != self.reported, count
+        return changed
+
+    def report(self) -> str:
+        return "RATIO=%.3f CPU_US_PER_KB=%.2f COMPRESSED=%d SKIPPED_SMALL=%d SKIPPED_ENTROPY=%d RAW=%d LEVEL_DROPS=%d LEVEL_RAISES=%d" % (
+            self.ratio(), self.seconds * 1e6 / max(self.size / 1024, 1), self.messages['compressed'], self.messages['small'],
+            self.messages['entropy'], self.messages['raw'], self.drops, self.raises)
+
+
+class LoadMonitor:
+    # event loop lag and CPU use of the process, smoothed over a few samples
+    def __init__(self) -> None:
+        self.lag = 0.0
+        self.cpu = 0.0
+        self.task = None
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        cpu = time.process_time()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LOAD_SAMPLE)
+            elapsed = loop.time() - start
+            now = time.process_time()
+            self.lag = 0.7 * self.lag + 0.3 * max(0.0, elapsed - LOAD_SAMPLE)
+            self.cpu = 0.7 * self.cpu + 0.3 * (now - cpu) / elapsed
+            cpu = now
+
+    def isLoaded(self) -> bool:
+        return self.lag > LAG_HIGH or self.cpu > CPU_HIGH
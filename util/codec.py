@@ -0,0 +1,315 @@
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from util import Z_WBITS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block as lz4block
+except ImportError:
+    lz4block = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LZ4_WINDOW = pow(2, 12) # lz4 hashes its whole dictionary on every message
+DICT_SIZE = 4096 # bytes of a trained dictionary
+DICT_SAMPLES = 256 # recent publications a dictionary is trained on
+DICT_MIN_SAMPLES = 64 # publications needed before the first training
+DICT_RETRAIN = 4096 # publications between two trainings
+DICT_VERSIONS = 4 # dictionaries a subscriber keeps per topic for messages still in flight
+ZSTD_SKIPPABLE_MAGIC = b'\x50\x2a\x4d\x18'
+Z_MEMLEVEL = 8 # zlib's default, from 1 (least memory, worse ratio) to 9
+Z_MIN_WBITS = 9 # smallest raw deflate window zlib accepts
+Z_POOL_SIZE = 64 # idle zlib compressors kept for reuse
+
+
+def deflate_memory(wbits: int, memlevel: int) -> int:
+    # zconf.h: (1 << (windowBits+2)) + (1 << (memLevel+9)) bytes, plus a few KB of state
+    return (1 << (abs(wbits) + 2)) + (1 << (memlevel + 9))
+
+
+def inflate_memory(wbits: int) -> int:
+    # zconf.h: 1 << windowBits bytes, plus about 7 KB of state
+    return (1 << abs(wbits)) + 7 * 1024
+
+
+class ZlibPool:
+    # zlib contexts of a process: released compressors are reset with a full
+    # flush, after it their output never refers to what they compressed before.
+    # Inflaters cannot be reset, new ones are copied from a pristine one
+    def __init__(self, size: int = Z_POOL_SIZE) -> None:
+        self.idle: Dict[Tuple[int, int, int], List['zlib._Compress']] = {}
+        self.count = 0 # idle compressors
+        self.size = size
+        self.inflaters: Dict[int, 'zlib._Decompress'] = {}
+        self.reused = 0
+
+    def compressobj(self, level: int, wbits: int, memlevel: int) -> 'zlib._Compress':
+        contexts = self.idle.get((level, wbits, memlevel))
+        if contexts:
+            self.count -= 1
+            self.reused += 1
+            return contexts.pop()
+        return zlib.compressobj(level, zlib.DEFLATED, wbits, memlevel)
+
+    def release(self, context: 'zlib._Compress', level: int, wbits: int, memlevel: int) -> None:
+        if self.count < self.size:
+            context.flush(zlib.Z_FULL_FLUSH)
+            self.idle.setdefault((level, wbits, memlevel), []).append(context)
+            self.count += 1
+
+    def decompressobj(self, wbits: int) -> 'zlib._Decompress':
+        template = self.inflaters.get(wbits)
+        if template is None:
+            template = self.inflaters[wbits] = zlib.decompressobj(wbits)
+        return template.copy()
+
+    def memory(self) -> int:
+        # estimate for the idle compressors
+        return sum(len(contexts) * deflate_memory(key[1], key[2]) for key, contexts in self.idle.items())
+
+
+zlib_pool = ZlibPool()
+
+# streaming codecs negotiated with compression=<name>: every message is
+# flushed so that it can be decompressed as soon as it arrives, and the
+# context (and its history) is kept for the next one
+
+
+class ZlibCompressor:
+    def __init__(self, level: int, wbits: int = abs(Z_WBITS), memlevel: int = Z_MEMLEVEL) -> None:
+        # a window larger than Z_WBITS would not fit the peers' inflaters
+        self.wbits = -min(max(wbits, Z_MIN_WBITS), abs(Z_WBITS))
+        self.memlevel = min(max(memlevel, 1), 9)
+        self.level = level
+        self.context = zlib_pool.compressobj(level, self.wbits, self.memlevel)
+
+    def compress(self, data: bytes, reset: bool = False) -> bytes:
+        # with reset, the next message can be decompressed from scratch
+        return self.context.compress(data) + self.context.flush(zlib.Z_FULL_FLUSH if reset else zlib.Z_SYNC_FLUSH)
+
+    def setLevel(self, level: int) -> None:
+        # the level of a context is fixed, its successor starts with an empty
+        # window: it only refers to data the inflater already has, after a flush
+        self.release()
+        self.level = level
+        self.context = zlib_pool.compressobj(level, self.wbits, self.memlevel)
+
+    def release(self) -> None:
+        # the context goes back to the pool, the compressor is not used anymore
+        zlib_pool.release(self.context, self.level, self.wbits, self.memlevel)
+        self.context = None
+
+    def memory(self) -> int:
+        return deflate_memory(self.wbits, self.memlevel)
+
+
+class ZlibDecompressor:
+    def __init__(self) -> None:
+        self.context = zlib_pool.decompressobj(Z_WBITS)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.context.decompress(data) + self.context.flush()
+
+
+class ZstdCompressor:
+    def __init__(self, level: int) -> None:
+        self.context = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        # the frame is never ended, blocks keep referencing the earlier ones
+        return self.context.compress(data) + self.context.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+
+class ZstdDecompressor:
+    def __init__(self) -> None:
+        self.context = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.context.decompress(data)
+
+
+class Lz4History:
+    # blocks reference the previous LZ4_WINDOW bytes of the stream as their
+    # dictionary, lz4 frames can not be flushed at every message
+    def __init__(self) -> None:
+        self.history = b""
+
+    def update(self, data: bytes) -> None:
+        self.history = (self.history + data)[-LZ4_WINDOW:]
+
+
+class Lz4Compressor(Lz4History):
+    def __init__(self, level: int) -> None:
+        super().__init__()
+        self.mode = 'high_compression' if level > 0 else 'default'
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        block = lz4block.compress(data, mode=self.mode, compression=self.level, dict=self.history)
+        self.update(data)
+        return block
+
+    def setLevel(self, level: int) -> None:
+        self.mode = 'high_compression' if level > 0 else 'default'
+        self.level = level
+
+
+class Lz4Decompressor(Lz4History):
+    def decompress(self, data: bytes) -> bytes:
+        data = lz4block.decompress(data, dict=self.history)
+        self.update(data)
+        return data
+
+
+class BrotliCompressor:
+    def __init__(self, level: int) -> None:
+        self.context = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.context.process(data) + self.context.flush()
+
+
+class BrotliDecompressor:
+    def __init__(self) -> None:
+        self.context = brotli.Decompressor()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.context.process(data)
+
+
+def deflate_stored(data: bytes) -> bytes:
+    # raw deflate stored blocks: no context is needed to write them and any
+    # inflater reads them, until it can follow a context reset by a keyframe
+    # or for good when there is no context left for it. Ends with an empty
+    # block, like a sync flush
+    blocks = []
+    for pos in range(0, len(data), 0xffff):
+        size = min(len(data) - pos, 0xffff)
+        blocks.append(b'\x00' + size.to_bytes(2, 'little') + (size ^ 0xffff).to_bytes(2, 'little'))
+        blocks.append(data[pos:pos+size])
+    blocks.append(b'\x00\x00\x00\xff\xff')
+    return b''.join(blocks)
+
+
+def lz4_block(data: bytes) -> bytes:
+    # a block that does not refer to the history, any Lz4Decompressor reads it
+    return lz4block.compress(data)
+
+
+class Codec:
+    def __init__(self, name: str, compressor: Callable, decompressor: Callable, level: int, window: Optional[int] = None, keyframes: bool = False, lowest: Optional[int] = None, stateless: Optional[Tuple[str, Callable]] = None, settings: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+        self.level = level # default level
+        # bytes after which two contexts fed the same messages produce the
+        # same output, None when the context keeps state besides its window
+        self.window = window
+        self.keyframes = keyframes # compress() can reset the context, see deflate_stored()
+        # lowest level setLevel() can switch a running compressor to, None
+        # when the level is fixed for the whole stream
+        self.lowest = lowest
+        # (name, encode) of a stateless encoding the decompressor reads
+        # at any point of the stream, no context is needed to write it
+        self.stateless = stateless
+        self.settings = settings # integer options of createCompressor()
+
+    def createCompressor(self, level: Optional[int] = None, settings: Dict[str, int] = {}) -> 'ZlibCompressor | ZstdCompressor | Lz4Compressor | BrotliCompressor':
+        return self.compressor(self.level if level is None else level, **{name: value for name, value in settings.items() if name in self.settings})
+
+    def createDecompressor(self) -> 'ZlibDecompressor | ZstdDecompressor | Lz4Decompressor | BrotliDecompressor':
+        return self.decompressor()
+
+
+# codecs whose module is installed
+CODECS: Dict[str, Codec] = {
+    # 6 is Z_DEFAULT_COMPRESSION
+    'zlib': Codec('zlib', ZlibCompressor, ZlibDecompressor, 6, pow(2, abs(Z_WBITS)), True, 1, ('deflate-stored', deflate_stored), ('wbits', 'memlevel')),
+}
+if zstandard is not None:
+    CODECS['zstd'] = Codec('zstd', ZstdCompressor, ZstdDecompressor, 3)
+if lz4block is not None:
+    CODECS['lz4'] = Codec('lz4', Lz4Compressor, Lz4Decompressor, 0, LZ4_WINDOW, lowest=0, stateless=('lz4-block', lz4_block))
+if brotli is not None:
+    CODECS['brotli'] = Codec('brotli', BrotliCompressor, BrotliDecompressor, 5)
+
+
+def get_codec(name: Optional[str]) -> Optional[Codec]:
+    return CODECS.get(name)
+
+
+class TrainedDictionary:
+    # stateless zstd compression of a topic's publications with a dictionary
+    # trained from its recent ones: every publication is compressed once for
+    # all the subscribers, which only need the dictionary. Version 0 is
+    # plain zstd, used until there are enough samples to train
+    def __init__(self, level: int = 3) -> None:
+        self.level = level
+        self.version = 0
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.exported = b"" # current dictionary as shipped to the subscribers
+        self.published = 0 # publications since the last training
+        self.members = 0
+
+    def isDue(self) -> bool:
+        if self.version == 0:
+            return self.published >= DICT_MIN_SAMPLES
+        return self.published >= DICT_RETRAIN
+
+    def train(self, samples: List[bytes]) -> bool:
+        self.published = 0
+        try:
+            dictionary = zstandard.train_dictionary(DICT_SIZE, samples, level=self.level)
+        except zstandard.ZstdError:
+            # too few or too uniform samples, the current version is kept
+            return False
+        self.version += 1
+        self.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+        # shipped in a skippable frame ahead of the first message that needs it
+        data = dictionary.as_bytes()
+        self.exported = ZSTD_SKIPPABLE_MAGIC + len(data).to_bytes(4, 'little') + data
+        return True
+
+    def encode(self, data: bytes) -> bytes:
+        # compressed with the current version
+        return self.compressor.compress(data)
+
+    def countPublication(self) -> None:
+        self.published += 1
+
+    def export(self) -> bytes:
+        return self.exported
+
+    def addMember(self) -> None:
+        self.members += 1
+
+    def deleteMember(self) -> None:
+        self.members -= 1
+
+
+class DictionaryDecompressor:
+    # subscriber side of TrainedDictionary, one per session
+    def __init__(self) -> None:
+        self.decompressors: OrderedDict[int, 'zstandard.ZstdDecompressor'] = OrderedDict()
+        self.decompressors[0] = zstandard.ZstdDecompressor()
+
+    def decompress(self, data: bytes) -> Optional[bytes]:
+        # None when the message needs a dictionary that never arrived
+        if data[:4] == ZSTD_SKIPPABLE_MAGIC:
+            size = int.from_bytes(data[4:8], 'little')
+            dictionary = zstandard.ZstdCompressionDict(data[8:8+size])
+            self.decompressors[dictionary.dict_id()] = zstandard.ZstdDecompressor(dict_data=dictionary)
+            if len(self.decompressors) > DICT_VERSIONS * 4: # a session may follow several topics
+                self.decompressors.pop(next(id for id in self.decompressors if id != 0))
+            data = data[8+size:]
+        decompressor = self.decompressors.get(zstandard.get_frame_parameters(data).dict_id)
+        return None if decompressor is None else decompressor.decompress(data)
@@ -0,0 +1,108 @@
+from typing import Dict, List, Optional
+
+from util import encode_varint, decode_varint
+
+# XOR parity over groups of at most k datagrams: the receiver rebuilds any
+# single lost datagram of a group from the others and the parity datagram.
+# Every datagram starts with its type, group and index (data) or count (parity)
+FEC_DATA = 0
+FEC_PARITY = 1
+FEC_GROUPS = 32 # groups a decoder keeps waiting for their parity
+
+
+def xor_into(target: bytearray, data: bytes) -> None:
+    # data is prefixed with its length so that shorter datagrams can be padded
+    if len(data) > len(target):
+        target.extend(bytes(len(data) - len(target)))
+    n = len(data)
+    value = int.from_bytes(target[:n], 'big') ^ int.from_bytes(data, 'big')
+    target[:n] = value.to_bytes(n, 'big')
+
+
+class FecEncoder:
+    def __init__(self, k: int) -> None:
+        self.k = min(k, 255)
+        self.group = 0
+        self.count = 0
+        self.parity = bytearray()
+
+    def overhead(self) -> int:
+        # header and length prefix added to a payload, also room for the parity
+        return 2 + len(encode_varint(self.group)) + 2
+
+    def encode(self, data: bytes) -> bytes:
+        header = bytes((FEC_DATA,)) + encode_varint(self.group) + bytes((self.count,))
+        xor_into(self.parity, len(data).to_bytes(2, 'big') + data)
+        self.count += 1
+        return header + data
+
+    def isFull(self) -> bool:
+        return self.count >= self.k
+
+    def isPending(self) -> bool:
+        return self.count > 0
+
+    def flush(self) -> bytes:
+        # parity of the datagrams sent since the last one, closes the group
+        parity = bytes((FEC_PARITY,)) + encode_varint(self.group) + bytes((self.count,)) + bytes(self.parity)
+        self.group += 1
+        self.count = 0
+        self.parity = bytearray()
+        return parity
+
+
+class FecGroup:
+    def __init__(self) -> None:
+        self.received = set()
+        self.xor = bytearray()
+        self.parity: Optional[bytes] = None
+        self.count: Optional[int] = None
+        self.done = False
+
+
+class FecDecoder:
+    def __init__(self) -> None:
+        self.groups: Dict[int, FecGroup] = {}
+        self.recovered = 0
+
+    def decode(self, datagram: bytes) -> List[bytes]:
+        # payloads to deliver: the datagram's own, or a lost one it completes
+        if len(datagram) < 3:
+            return []
+        type = datagram[0]
+        id, pos = decode_varint(datagram, 1)
+        if id is None or pos >= len(datagram):
+            return []
+        index = datagram[pos]
+        data = datagram[pos+1:]
+        group = self.groups.get(id)
+        if group is None:
+            group = self.groups[id] = FecGroup()
+            if len(self.groups) > FEC_GROUPS:
+                self.groups.pop(min(self.groups))
+        if group.done:
+            return []
+        payloads = []
+        if type == FEC_DATA:
+            if index in group.received:
+                return []
+            group.received.add(index)
+            xor_into(group.xor, len(data).to_bytes(2, 'big') + data)
+            payloads.append(data)
+        elif type == FEC_PARITY:
+            group.parity = data
+            group.count = index
+        if group.count is not None:
+            if len(group.received) == group.count:
+                group.done = True
+            elif len(group.received) == group.count - 1 and group.parity is not None:
+                payloads.append(self.recover(group))
+        return payloads
+
+    def recover(self, group: FecGroup) -> bytes:
+        missing = bytearray(group.parity)
+        xor_into(missing, bytes(group.xor))
+        length = int.from_bytes(missing[:2], 'big')
+        group.done = True
+        self.recovered += 1
+        return bytes(missing[2:2+length])
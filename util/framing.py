@@ -0,0 +1,65 @@
+from typing import Iterator
+
+from util import encode_varint, decode_varint, Z_END_PATTERN
+
+# framing of messages on keep-alive streams: 'varint' prefixes every message
+# with its length, 'pattern' relies on the zlib sync flush trailer
+FRAMINGS = ('pattern', 'varint')
+
+
+class VarintParser:
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.pos = 0 # start of the first unparsed frame
+
+    def feed(self, data: bytes) -> None:
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        self.buffer += data
+
+    def __iter__(self) -> Iterator[memoryview]:
+        # frames are views over the buffer, only valid until the next frame
+        with memoryview(self.buffer) as view:
+            while True:
+                length, start = decode_varint(view, self.pos)
+                if length is None or start + length > len(view):
+                    break
+                self.pos = start + length
+                with view[start:self.pos] as frame:
+                    yield frame
+
+
+class PatternParser:
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.pos = 0 # start of the first unparsed frame
+        self.searched = 0 # the pattern is not found before this offset
+
+    def feed(self, data: bytes) -> None:
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.searched -= self.pos
+            self.pos = 0
+        self.buffer += data
+
+    def __iter__(self) -> Iterator[memoryview]:
+        # frames are views over the buffer, only valid until the next frame
+        with memoryview(self.buffer) as view:
+            while True:
+                index = self.buffer.find(Z_END_PATTERN, self.searched)
+                if index == -1:
+                    self.searched = max(self.pos, len(self.buffer) - len(Z_END_PATTERN) + 1)
+                    break
+                start = self.pos
+                self.pos = self.searched = index + len(Z_END_PATTERN)
+                with view[start:self.pos] as frame:
+                    yield frame
+
+
+def create_parser(framing: str) -> 'VarintParser | PatternParser':
+    return VarintParser() if framing == 'varint' else PatternParser()
+
+
+def frame_header(data: bytes, framing: str) -> bytes:
+    return encode_varint(len(data)) if framing == 'varint' else b''
@@ -0,0 +1,65 @@
+from typing import Callable, Dict, List, Optional
+
+# bytes a session may hold in partially received streams before they are dropped
+REASSEMBLY_LIMIT = 64 * 2**20
+
+
+class PartialStream:
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+        self.size = 0
+
+
+class Reassembler:
+    def __init__(self, limit: int = REASSEMBLY_LIMIT, on_drop: Optional[Callable[[int], None]] = None) -> None:
+        self.partial: Dict[int, PartialStream] = {}
+        self.dropped = set() # streams over the limit, ignored until they end
+        self.size = 0 # bytes held by all partial streams of the session
+        self.limit = limit
+        self.on_drop = on_drop
+        self.drops = 0
+
+    def add(self, stream_id: int, data: bytes, ended: bool, batch: Optional[int] = None) -> Optional[bytes]:
+        # returns the whole message once the stream ends, chunks are joined only once;
+        # with batch, the bytes received so far are returned once there are that many
+        if stream_id in self.dropped:
+            if ended:
+                self.dropped.discard(stream_id)
+            return None
+        stream = self.partial.get(stream_id)
+        if stream is None:
+            if ended or (batch is not None and len(data) >= batch):
+                return data
+            stream = self.partial[stream_id] = PartialStream()
+        if self.size + len(data) > self.limit:
+            self.discard(stream_id)
+            self.drops += 1
+            if not ended:
+                self.dropped.add(stream_id)
+                if self.on_drop is not None:
+                    self.on_drop(stream_id)
+            return None
+        if data:
+            stream.chunks.append(data)
+            stream.size += len(data)
+            self.size += len(data)
+        if ended:
+            self.partial.pop(stream_id)
+        elif batch is None or stream.size < batch:
+            return None
+        data = b''.join(stream.chunks)
+        self.size -= stream.size
+        stream.chunks.clear()
+        stream.size = 0
+        return data
+
+    def discard(self, stream_id: int) -> None:
+        stream = self.partial.pop(stream_id, None)
+        if stream is not None:
+            self.size -= stream.size
+        self.dropped.discard(stream_id)
+
+    def clear(self) -> None:
+        self.partial.clear()
+        self.dropped.clear()
+        self.size = 0
@@ -9,7 +9,7 @@ async def webtransport_subscribe(receive: callable, debug: dict = None) -> None:
         recv_data = message.get('data')
         if recv_data is not None:
             if debug:
-                printflush("**%s, %s, RECIEVED, %s, %d" % (time.time_ns(), debug.get('topic'), fnvhash32(recv_data), len(recv_data)))
+                printflush("**%s, %s, RECIEVED, %s, %d" % (time.time_ns(), message.get('topic', debug.get('topic')), fnvhash32(recv_data), len(recv_data)))
         elif message['type'] == 'webtransport.stream.end':
             break
 
@@ -0,0 +1,134 @@
+import argparse, base64, hashlib, hmac, json, time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+
+from acl import PatternSet, ROLES
+
+# capability tokens: <alg>.<claims>.<signature>, claims and signature in
+# base64url. The claims are {"user", "exp", "subscribe": [topics], "publish": [topics]},
+# topics are names or globs like the role grants
+ALGORITHMS = ('hs256', 'ed25519')
+TOKEN_CACHE_SIZE = pow(2, 14) # tokens whose verification is kept, rejected ones included
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class Capability:
+    # rights carried by a verified token
+    def __init__(self, claims: Dict) -> None:
+        self.user = claims.get('user')
+        self.expires = float(claims['exp'])
+        self.topics = {rol: PatternSet(claims.get(rol, [])) for rol in ROLES}
+
+    def isExpired(self) -> bool:
+        return time.time() >= self.expires
+
+    def allows(self, rol: str, topic: str) -> bool:
+        return not self.isExpired() and self.topics[rol].match(topic)
+
+
+class TokenSigner:
+    def __init__(self, algorithm: str, key: bytes) -> None:
+        # key: the HMAC secret, or an Ed25519 private key in PEM
+        self.algorithm = algorithm
+        self.key = key if algorithm == 'hs256' else serialization.load_pem_private_key(key, None)
+
+    def sign(self, user: str, subscribe: List[str] = [], publish: List[str] = [], ttl: float = 3600) -> str:
+        claims = {"user": user, "exp": int(time.time() + ttl), "subscribe": subscribe, "publish": publish}
+        message = self.algorithm + "." + b64encode(json.dumps(claims, separators=(',', ':')).encode())
+        if self.algorithm == 'hs256':
+            signature = hmac.new(self.key, message.encode(), hashlib.sha256).digest()
+        else:
+            signature = self.key.sign(message.encode())
+        return message + "." + b64encode(signature)
+
+
+class TokenVerifier:
+    # checks the signature of a token once, later sessions presenting the same
+    # token are answered from an LRU until it expires
+    def __init__(self, algorithm: str, key: bytes, size: int = TOKEN_CACHE_SIZE) -> None:
+        # key: the HMAC secret, or an Ed25519 public key in PEM
+        if algorithm not in ALGORITHMS:
+            raise ValueError("unknown token algorithm %s" % (algorithm))
+        self.algorithm = algorithm
+        self.key = key if algorithm == 'hs256' else serialization.load_pem_public_key(key)
+        if algorithm == 'ed25519' and not isinstance(self.key, Ed25519PublicKey):
+            raise ValueError("not an Ed25519 public key")
+        self.cache: OrderedDict[str, Optional[Capability]] = OrderedDict()
+        self.size = size
+        self.verified = 0
+        self.rejected = 0
+        self.hits = 0
+
+    def verify(self, token: str) -> Optional[Capability]:
+        # the capability of a valid, unexpired token, None otherwise
+        if token in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(token)
+            capability = self.cache[token]
+        else:
+            capability = self.check(token)
+            self.cache[token] = capability
+            if len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+            if capability is None:
+                self.rejected += 1
+            else:
+                self.verified += 1
+        if capability is None or capability.isExpired():
+            return None
+        return capability
+
+    def check(self, token: str) -> Optional[Capability]:
+        try:
+            message, signature = token.rsplit('.', 1)
+            algorithm, claims = message.split('.')
+            if algorithm != self.algorithm:
+                # never let the token choose how it is verified
+                return None
+            signature = b64decode(signature)
+            if self.algorithm == 'hs256':
+                if not hmac.compare_digest(hmac.new(self.key, message.encode(), hashlib.sha256).digest(), signature):
+                    return None
+            else:
+                self.key.verify(signature, message.encode())
+            return Capability(json.loads(b64decode(claims)))
+        except (ValueError, KeyError, TypeError, InvalidSignature):
+            return None
+
+
+def load_key(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read().strip()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Issue a capability token for the broker")
+    parser.add_argument("--algorithm", type=str, choices=ALGORITHMS, default='hs256', help="hs256 (shared secret) or ed25519")
+    parser.add_argument("--key", type=str, help="file with the HMAC secret or the Ed25519 private key (PEM)")
+    parser.add_argument("--genkey", type=str, help="write a new Ed25519 private key to this file and its public key next to it (.pub)")
+    parser.add_argument("--user", type=str, help="user the token is issued to")
+    parser.add_argument("--subscribe", type=str, nargs='*', default=[], help="topics or patterns the user may subscribe to")
+    parser.add_argument("--publish", type=str, nargs='*', default=[], help="topics or patterns the user may publish to")
+    parser.add_argument("--ttl", type=float, default=3600, help="seconds the token is valid (defaults to 3600)")
+    args = parser.parse_args()
+
+    if args.genkey is not None:
+        private = Ed25519PrivateKey.generate()
+        with open(args.genkey, "wb") as file:
+            file.write(private.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+        with open(args.genkey + ".pub", "wb") as file:
+            file.write(private.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+    else:
+        if args.key is None or args.user is None:
+            parser.error("--key and --user are required to issue a token")
+        print(TokenSigner(args.algorithm, load_key(args.key)).sign(args.user, args.subscribe, args.publish, args.ttl))
@@ -9,3 +9,28 @@ Z_END_PATTERN = bytearray(b'\x00\x00\xff\xff')
 def printflush(msg):
     print(msg)
     sys.stdout.flush()
+
+
+def encode_varint(value: int) -> bytes:
+    # QUIC variable-length integer (RFC 9000, section 16)
+    if value < 0x40:
+        return bytes((value,))
+    elif value < 0x4000:
+        return (value | 0x4000).to_bytes(2, 'big')
+    elif value < 0x40000000:
+        return (value | 0x80000000).to_bytes(4, 'big')
+    else:
+        return (value | 0xC000000000000000).to_bytes(8, 'big')
+
+
+def decode_varint(data, pos: int = 0):
+    # returns (value, next position), value is None while the integer is incomplete
+    if pos >= len(data):
+        return None, pos
+    length = 1 << (data[pos] >> 6)
+    if pos + length > len(data):
+        return None, pos
+    value = data[pos] & 0x3F
+    for i in range(pos + 1, pos + length):
+        value = (value << 8) | data[i]
+    return value, pos + length